@@ -0,0 +1,96 @@
+#!/usr/bin/python
+'''
+	Jitter of a 50 Hz control tick while Pupil messages arrive at a
+	high rate, comparing the threaded setup (one thread blocking on
+	the SUB socket, one sleeping between ticks) with a single
+	threaded control_loop.ControlLoop.
+
+		python control_loop_benchmark.py [seconds] [message rate]
+'''
+import os
+import sys
+import time
+import threading
+import zmq
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import metrics
+import pupil_stream
+import control_loop
+
+TICK = 1 / 50.
+PUPIL = 'Pupil\nnorm_pos:(0.41, 0.58)\ndiameter:54.2\nconfidence:0.91\ntimestamp:%r\nid:0\n'
+
+
+def publish(context, address, seconds, rate, done):
+	socket = context.socket(zmq.PUB)
+	socket.bind(address)
+	time.sleep(0.3)
+	end = time.time() + seconds
+	batch = max(1, int(rate / 1000.))
+	while time.time() < end:
+		for i in range(batch):
+			socket.send(PUPIL % time.time())
+		time.sleep(batch / rate)
+	done.set()
+	socket.close()
+
+
+def subscriber(context, address):
+	socket = context.socket(zmq.SUB)
+	socket.connect(address)
+	pupil_stream.subscribe(socket, ['Pupil'])
+	return socket
+
+
+def threaded(context, address, done):
+	socket = subscriber(context, address)
+	decoder = pupil_stream.PupilDecoder('Pupil')
+	jitter = metrics.LatencyStats('threaded tick jitter')
+	socket.setsockopt(zmq.RCVTIMEO, 100)
+
+	def intake():
+		while not done.is_set():
+			try:
+				decoder.decode(socket.recv())
+			except zmq.Again:
+				pass
+
+	reader = threading.Thread(target = intake)
+	reader.start()
+	due = time.time() + TICK
+	while not done.is_set():
+		time.sleep(max(0., due - time.time()))
+		jitter.add(time.time() - due)
+		due += TICK
+	reader.join()
+	socket.close()
+	return jitter
+
+
+def single_loop(context, address, done):
+	socket = subscriber(context, address)
+	loop = control_loop.ControlLoop()
+	control_loop.PupilIntake(loop, socket, pupil_stream.PupilDecoder('Pupil'), lambda pupil: None)
+	loop.call_every(TICK, lambda: done.is_set() and loop.stop())
+	loop.run()
+	socket.close()
+	loop.jitter.name = 'control loop tick jitter'
+	return loop.jitter
+
+
+def main():
+	seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 5.
+	rate = float(sys.argv[2]) if len(sys.argv) > 2 else 2000.
+	for port, run in ((5611, threaded), (5612, single_loop)):
+		context = zmq.Context()
+		address = 'tcp://127.0.0.1:%d' % port
+		done = threading.Event()
+		publisher = threading.Thread(target = publish, args = (context, address, seconds, rate, done))
+		publisher.start()
+		print run(context, address, done)
+		publisher.join()
+		context.term()
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,72 @@
+#!/usr/bin/python
+'''
+	Cost of decoding data streaming packets with every field of
+	STRM_MASK1 and STRM_MASK2 enabled, comparing the old per field
+	parsing with the compiled frame decoders, and the share of one
+	core they need at the full 400 Hz sensor rate.
+
+		python data_strm_benchmark.py [packets]
+'''
+import os
+import sys
+import time
+import struct
+import random
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import sphero_driver
+
+SENSOR_RATE = 400.
+
+
+class NullLink(object):
+	def send(self, data):
+		pass
+
+
+def make_packet(n_fields, frames):
+	values = [random.randint(-32768, 32767) for i in range(n_fields * frames)]
+	data = struct.pack('>' + 'h' * len(values), *values)
+	body = [ord(sphero_driver.IDCODE['DATA_STRM'])] + list(divmod(len(data) + 1, 256)) + [ord(c) for c in data]
+	checksum = ~sum(body) % 256
+	return ''.join(chr(x) for x in [0xff, 0xfe] + body + [checksum])
+
+
+def legacy(sphero, packet, data_length):
+	# parsing as done before the compiled decoders, on a list of chars
+	data = list(packet)
+	output = {}
+	for i in range((data_length-1)/2):
+		unpack = struct.unpack_from('>h', ''.join(data[5+2*i:]))
+		output[sphero.mask_list[i % len(sphero.mask_list)]] = unpack[0]
+	return output
+
+
+def bench(func, count):
+	start = time.time()
+	for i in xrange(count):
+		func()
+	return (time.time() - start) / count
+
+
+def main():
+	count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+	sphero = sphero_driver.Sphero()
+	sphero.bt = NullLink()
+	for frames in (1, 4, 10):
+		sphero.set_all_data_strm(1, frames, 0, False)
+		packet = make_packet(len(sphero.mask_list), frames)
+		data_length = len(packet) - 5
+		view = memoryview(bytearray(packet))
+		results = [
+			('per field', bench(lambda: legacy(sphero, packet, data_length), count / 10)),
+			('struct dicts', bench(lambda: sphero.parse_data_strm(view, data_length), count)),
+			('numpy frames', bench(lambda: sphero.decode_data_strm(view, data_length), count))]
+		print '%d fields, %d frames per packet' % (len(sphero.mask_list), frames)
+		for name, per_packet in results:
+			# packets per second needed for 400 Hz samples
+			load = per_packet * SENSOR_RATE / frames
+			print '  %-13s %8.1f us/packet  %6.2f%% of a core at 400 Hz' % (name, 1e6 * per_packet, 100 * load)
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,144 @@
+#!/usr/bin/python
+'''
+	Downstream command volume with and without the gaze_filter
+	stages, on synthetic 120 Hz eye tracker data: the user looks
+	at random targets for 0.3 to 2 seconds each, samples carry
+	gaussian noise and the odd outlier.
+
+	Steering counts roll commands of pupil_driver, once per
+	heading change as with the scheduler and once per change at
+	a COMMAND_RATE tick as in steer_loop. Tapping counts the taps
+	of get_gaze_location, with the dwell check it used before and
+	with the I-DT filter, against the number of long dwells.
+
+		python gaze_filter_benchmark.py [seconds]
+'''
+import os
+import sys
+import math
+import time
+import random
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import gaze_filter
+import pupil_driver
+
+RATE = 120.
+DATA_RANGE = (0.5, 0.5, 0.08)
+CON_LEVEL = 0.65
+# smoother and I-DT threshold of get_gaze_location --fixation, in pixels
+TAP_MIN_CUTOFF = 1.
+TAP_BETA = 0.01
+TAP_DISPERSION = 130
+
+
+def gaze(seconds, center, spread, noise, seed = 0):
+	'''
+		Timestamped positions and the list of dwells as
+		(start, end) intervals.
+	'''
+	rand = random.Random(seed)
+	samples = []
+	dwells = []
+	timestamp = 0.
+	while timestamp < seconds:
+		x = center[0] + rand.uniform(-spread, spread)
+		y = center[1] + rand.uniform(-spread, spread)
+		dwell = rand.uniform(0.3, 2.)
+		dwells.append((timestamp, timestamp + dwell))
+		end = timestamp + dwell
+		while timestamp < end:
+			if rand.random() < 0.01:
+				# blink or detection glitch
+				sample = x + rand.gauss(0, 10 * noise), y + rand.gauss(0, 10 * noise)
+			else:
+				sample = x + rand.gauss(0, noise), y + rand.gauss(0, noise)
+			samples.append((timestamp,) + sample)
+			timestamp += 1 / RATE
+	return samples, dwells
+
+
+def steering_commands(samples, smoother):
+	table = pupil_driver.HeadingTable(DATA_RANGE, CON_LEVEL)
+	changes = ticks = 0
+	last = sent = None
+	next_tick = 0.
+	start = time.time()
+	for timestamp, x, y in samples:
+		if smoother is not None:
+			x, y = smoother.filter(timestamp, x, y)
+		heading = table.heading(1., x, y)
+		if heading != last:
+			changes += 1
+			last = heading
+		if timestamp >= next_tick:
+			next_tick += 1. / pupil_driver.COMMAND_RATE
+			if heading != sent:
+				ticks += 1
+				sent = heading
+	return changes, ticks, (time.time() - start) / len(samples)
+
+
+def spurious(taps, dwells, duration):
+	'''
+		Taps not preceded by duration of looking at the
+		same target.
+	'''
+	count = 0
+	dwell = iter(dwells)
+	start, end = next(dwell)
+	for timestamp in taps:
+		while timestamp >= end:
+			start, end = next(dwell)
+		if timestamp - start < duration:
+			count += 1
+	return count
+
+
+def legacy_taps(samples, radius, duration):
+	# the dwell check of get_gaze_location before gaze_filter
+	taps = []
+	anchor = None
+	for timestamp, x, y in samples:
+		if anchor is None:
+			anchor = timestamp, x, y
+		elif math.sqrt((anchor[1] - x) ** 2 + (anchor[2] - y) ** 2) < radius:
+			if timestamp - anchor[0] > duration:
+				taps.append(timestamp)
+				anchor = None
+		else:
+			anchor = timestamp, x, y
+	return taps
+
+
+def filtered_taps(samples, dispersion, duration):
+	smoother = gaze_filter.OneEuroSmoother(TAP_MIN_CUTOFF, TAP_BETA)
+	fixation_filter = gaze_filter.DispersionFixation(dispersion, duration)
+	taps = []
+	start = time.time()
+	for timestamp, x, y in samples:
+		x, y = smoother.filter(timestamp, x, y)
+		if fixation_filter.add(timestamp, x, y) is not None:
+			taps.append(timestamp)
+			fixation_filter.reset()
+	return taps, (time.time() - start) / len(samples)
+
+
+def main():
+	seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 600.
+	samples, dwells = gaze(seconds, DATA_RANGE[:2], 0.2, 0.01)
+	for title, smoother in (('raw', None), ('exponential', gaze_filter.ExponentialSmoother(0.2)),
+			('one euro', gaze_filter.OneEuroSmoother(pupil_driver.SMOOTH_MIN_CUTOFF, pupil_driver.SMOOTH_BETA))):
+		changes, ticks, cost = steering_commands(samples, smoother)
+		print 'steering %-12s %6d heading changes %6d tick commands %5.2f us/sample' % (title, changes, ticks, 1e6 * cost)
+	# nexus pixels, noise of about a degree of visual angle
+	samples, dwells = gaze(seconds, (960, 600), 800, 25, seed = 1)
+	long_dwells = sum(1 for start, end in dwells if end - start > 1.)
+	print 'tapping  %d dwells longer than 1 s' % long_dwells
+	taps = legacy_taps(samples, math.sqrt(105 ** 2 + 105 ** 2), 1.)
+	print 'tapping  legacy dwell  %6d taps %4d spurious' % (len(taps), spurious(taps, dwells, 1.))
+	taps, cost = filtered_taps(samples, TAP_DISPERSION, 1.)
+	print 'tapping  I-DT          %6d taps %4d spurious  %5.2f us/sample' % (len(taps), spurious(taps, dwells, 1.), 1e6 * cost)
+
+if __name__ == '__main__':
+	main()
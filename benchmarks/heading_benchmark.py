@@ -0,0 +1,55 @@
+#!/usr/bin/python
+'''
+	Per sample cost of the steering heading, computed with
+	det_angle_xy or looked up in a HeadingTable, and how far the
+	table headings are from the computed ones for a few grid
+	resolutions.
+
+		python heading_benchmark.py [samples]
+'''
+import os
+import sys
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import pupil_driver
+
+DATA_RANGE = (0.48, 0.52, 0.08)
+CON_LEVEL = 0.65
+
+
+def bench(heading, samples):
+	start = time.time()
+	for confidence, norm_x, norm_y in samples:
+		heading(confidence, norm_x, norm_y)
+	return (time.time() - start) / len(samples)
+
+
+def main():
+	count = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+	random = np.random.RandomState(0)
+	samples = zip(random.uniform(0.5, 1, count).tolist(), random.uniform(0, 1, count).tolist(), random.uniform(0, 1, count).tolist())
+	computed = lambda confidence, norm_x, norm_y: pupil_driver.det_heading(confidence, norm_x, norm_y, CON_LEVEL, DATA_RANGE)
+	base = bench(computed, samples)
+	expected = [computed(*sample) for sample in samples]
+	print 'det_angle_xy     %6.2f us/sample' % (1e6 * base)
+	for resolution in (64, 128, 256, 512):
+		start = time.time()
+		table = pupil_driver.HeadingTable(DATA_RANGE, CON_LEVEL, resolution)
+		build = time.time() - start
+		per_sample = bench(table.heading, samples)
+		errors = []
+		dead_zone = 0
+		for sample, heading in zip(samples, expected):
+			looked_up = table.heading(*sample)
+			if (looked_up is None) != (heading is None):
+				dead_zone += 1
+			elif heading is not None:
+				difference = abs(looked_up - heading) % 360
+				errors.append(min(difference, 360 - difference))
+		print 'table %4d       %6.2f us/sample  %4.1fx  build %5.0f ms  max error %d deg  mean %.2f deg  dead zone mismatch %.3f%%' % (
+			resolution, 1e6 * per_sample, base / per_sample, 1000 * build, max(errors), np.mean(errors), 100. * dead_zone / count)
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,55 @@
+#!/usr/bin/python
+'''
+	Time to import the driver modules in a fresh interpreter, best
+	of a few runs, and which heavy modules the import pulled in.
+	The last line is the start of the drivers up to the Sphero being
+	usable: import, connect and set_raw_data_strm.
+
+		python import_benchmark.py [runs]
+'''
+import os
+import sys
+import subprocess
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+MODULES = ('sphero_driver', 'pupil_stream', 'control_loop', 'calibration',
+	'pupil_driver', 'pupil_driver_v2', 'get_gaze_location')
+HEAVY = ('numpy', 'matplotlib', 'zmq', 'lightblue', 'pyadb')
+# what the drivers do before steering, over a loopback link
+STARTUP = 'sphero_driver; import sphero_transport; sphero = sphero_driver.Sphero(); ' \
+	'sphero.connect(sphero_transport.LoopbackTransport()); sphero.set_raw_data_strm(40, 1, 0, False)'
+
+PROBE = '''
+import sys, time
+start = time.time()
+try:
+	import %s
+	error = ''
+except ImportError, e:
+	error = str(e)
+elapsed = time.time() - start
+print elapsed, ','.join(m for m in %r if m in sys.modules) or '-', error
+'''
+
+
+def measure(module, runs):
+	best = None
+	for r in range(runs):
+		output = subprocess.check_output([sys.executable, '-c', PROBE % (module, HEAVY)], cwd = ROOT)
+		elapsed, loaded, error = (output.strip().split(' ', 2) + [''])[:3]
+		elapsed = float(elapsed)
+		best = elapsed if best is None else min(best, elapsed)
+	return best, loaded, error
+
+
+def main():
+	runs = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+	for name, module in zip(MODULES + ('driver startup',), MODULES + (STARTUP,)):
+		elapsed, loaded, error = measure(module, runs)
+		if error:
+			print '%-18s %s' % (name, error)
+		else:
+			print '%-18s %7.1f ms  loads %s' % (name, 1000 * elapsed, loaded)
+
+if __name__ == '__main__':
+	main()
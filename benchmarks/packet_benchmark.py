@@ -0,0 +1,68 @@
+#!/usr/bin/python
+'''
+	Roll packets per second, comparing the old per byte packing with
+	the precompiled CommandTemplate: building the message alone, and
+	Sphero.roll through send to a link that discards it.
+
+		python packet_benchmark.py [packets]
+'''
+import os
+import sys
+import time
+import struct
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import sphero_driver
+
+REQ = sphero_driver.REQ
+
+
+class NullLink(object):
+	def send(self, data):
+		pass
+
+
+def legacy_build(sphero, speed, heading, state):
+	# packing as done before the templates
+	data = sphero.pack_cmd(REQ['CMD_ROLL'], [sphero.clamp(speed, 0, 255), (heading >> 8), (heading & 0xff), state])
+	checksum = ~ sum(data) % 256
+	output = REQ['WITHOUT_RESPONSE'] + data + [checksum]
+	return ''.join(struct.pack('B', x) for x in output)
+
+
+def template_build(sphero, speed, heading, state):
+	sphero.seq = (sphero.seq + 1) & 0xff
+	return sphero._templates['CMD_ROLL'].pack(False, sphero.seq, sphero.clamp(speed, 0, 255), heading, state)
+
+
+def legacy_roll(sphero, speed, heading, state):
+	sphero._dispatch(legacy_build(sphero, speed, heading, state), sphero.seq, False)
+
+
+def template_roll(sphero, speed, heading, state):
+	sphero.roll(speed, heading, state, False)
+
+
+def bench(roll, count, repeat = 5):
+	# best of several runs, the machine is rarely quiet
+	sphero = sphero_driver.Sphero()
+	sphero.bt = NullLink()
+	best = None
+	for r in range(repeat):
+		start = time.time()
+		for i in xrange(count):
+			roll(sphero, 80, i % 360, 1)
+		elapsed = time.time() - start
+		best = elapsed if best is None else min(best, elapsed)
+	return count / best
+
+
+def main():
+	count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+	for title, legacy, template in (('build message', legacy_build, template_build), ('roll to link', legacy_roll, template_roll)):
+		base = bench(legacy, count)
+		rate = bench(template, count)
+		print '%-14s per byte %9.0f packets/s  template %9.0f packets/s  %5.2fx' % (title, base, rate, rate / base)
+
+if __name__ == '__main__':
+	main()
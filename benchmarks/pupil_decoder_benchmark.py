@@ -0,0 +1,106 @@
+#!/usr/bin/python
+'''
+	Compare PupilDecoder against the split/dict parsing the drivers
+	used before, over a corpus of Pupil Server messages.
+
+	Record a corpus from a running Pupil Server:
+		python pupil_decoder_benchmark.py record tcp://127.0.0.1:5000 corpus.pkl 20000
+	Run the benchmark on it (a synthetic corpus is used without a file):
+		python pupil_decoder_benchmark.py [corpus.pkl]
+'''
+import os
+import sys
+import time
+import random
+import cPickle
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import pupil_stream
+
+
+def record_corpus(address, path, count):
+	import zmq
+	context = zmq.Context()
+	socket = context.socket(zmq.SUB)
+	socket.connect(address)
+	socket.setsockopt(zmq.SUBSCRIBE, '')
+	corpus = [socket.recv() for i in range(count)]
+	with open(path, 'wb') as f:
+		cPickle.dump(corpus, f, cPickle.HIGHEST_PROTOCOL)
+	print 'recorded %d messages to %s' % (count, path)
+
+
+def synthetic_corpus(count):
+	# mix of pupil and gaze messages shaped like Pupil Server output
+	rand = random.Random(0)
+	corpus = []
+	ts = 1000.
+	for i in range(count):
+		ts += 1 / 120.
+		x, y, c = rand.random(), rand.random(), rand.random()
+		if i % 3:
+			msg = 'Pupil\nnorm_pos:(%r, %r)\ndiameter:%r\nconfidence:%r\ntimestamp:%r\nid:%d\n' \
+				'ellipse:{\'axes\': (44.1, 52.9), \'angle\': 81.2, \'center\': (312.5, 240.1)}\n' \
+				% (x, y, rand.uniform(30, 80), c, ts, i % 2)
+		else:
+			msg = 'Gaze\nnorm_pos:(%r, %r)\nconfidence:%r\ntimestamp:%r\nrealtime gaze on nexus:(%r, %r)\n' \
+				% (x, y, c, ts, x, y)
+		corpus.append(msg)
+	return corpus
+
+
+def legacy(corpus):
+	# parsing as done by pupil_driver.main before PupilDecoder
+	n = 0
+	for msg in corpus:
+		items = msg.split("\n")
+		msg_type = items.pop(0)
+		items = dict([ i.split(':', 1) for i in items[: -1] ])
+		if msg_type == 'Pupil':
+			confidence = float(items['confidence'])
+			norm_x, norm_y = map(float, items['norm_pos'][1:-1].split(','))
+			n += 1
+	return n
+
+
+def decoded(corpus):
+	decoder = pupil_stream.PupilDecoder('Pupil')
+	decode = decoder.decode
+	n = 0
+	for msg in corpus:
+		pupil = decode(msg)
+		if pupil is not None:
+			n += 1
+	return n
+
+
+def bench(func, corpus, repeat = 5):
+	best = None
+	for i in range(repeat):
+		start = time.time()
+		func(corpus)
+		elapsed = time.time() - start
+		if best is None or elapsed < best:
+			best = elapsed
+	return best
+
+
+def main():
+	if len(sys.argv) > 1 and sys.argv[1] == 'record':
+		record_corpus(sys.argv[2], sys.argv[3], int(sys.argv[4]))
+		return
+	if len(sys.argv) > 1:
+		with open(sys.argv[1], 'rb') as f:
+			corpus = cPickle.load(f)
+	else:
+		corpus = synthetic_corpus(100000)
+	assert legacy(corpus) == decoded(corpus)
+	t_legacy = bench(legacy, corpus)
+	t_decoded = bench(decoded, corpus)
+	print '%d messages' % len(corpus)
+	print 'split/dict : %8.0f msg/s  %6.2f us/msg' % (len(corpus) / t_legacy, 1e6 * t_legacy / len(corpus))
+	print 'decoder    : %8.0f msg/s  %6.2f us/msg' % (len(corpus) / t_decoded, 1e6 * t_decoded / len(corpus))
+	print 'speedup    : %.2fx' % (t_legacy / t_decoded)
+
+if __name__ == '__main__':
+	main()
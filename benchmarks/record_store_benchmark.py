@@ -0,0 +1,74 @@
+#!/usr/bin/python
+'''
+	Memory and stop time of recording pupil positions, kept in a
+	list of tuples and saved with np.save at stop as the Recorder
+	did before, or streamed with record_store.PositionWriter. Every
+	run happens in its own process so the peak memory is its own.
+
+		python record_store_benchmark.py [minutes ...]
+'''
+import os
+import sys
+import time
+import shutil
+import resource
+import tempfile
+import subprocess
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import record_store
+
+RATE = 120
+
+
+def rows(count):
+	for i in xrange(count):
+		yield i / float(RATE), 0.9, 0., 0.5, 0.5, 50.
+
+
+def legacy(path, count):
+	start = time.time()
+	pupil_list = []
+	for row in rows(count):
+		pupil_list.append(row)
+	record = time.time() - start
+	start = time.time()
+	np.save(path, np.asarray(pupil_list))
+	return record, time.time() - start
+
+
+def streamed(path, count):
+	start = time.time()
+	writer = record_store.PositionWriter(path, len(record_store.PUPIL_COLUMNS))
+	for row in rows(count):
+		writer.append(row)
+	record = time.time() - start
+	start = time.time()
+	writer.close()
+	return record, time.time() - start
+
+
+def run(method, minutes):
+	count = int(minutes * 60 * RATE)
+	directory = tempfile.mkdtemp()
+	try:
+		base = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+		record, stop = globals()[method](os.path.join(directory, 'pupil_positions.npy'), count)
+		peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - base
+	finally:
+		shutil.rmtree(directory)
+	print '%-8s %5.0f min %9d rows  %5.2f us/row  stop %7.1f ms  memory +%6.1f MB' % (
+		method, minutes, count, 1e6 * record / count, 1000 * stop, peak / 1024.)
+
+
+def main():
+	if len(sys.argv) > 1 and sys.argv[1] == '--run':
+		run(sys.argv[2], float(sys.argv[3]))
+		return
+	for minutes in sys.argv[1:] or ['10', '60']:
+		for method in ('legacy', 'streamed'):
+			subprocess.check_call([sys.executable, __file__, '--run', method, minutes])
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,176 @@
+#!/usr/bin/python
+'''
+	Throughput of the steering pipeline of pupil_driver on a
+	replayed recording, headless against the simulated Sphero.
+
+	Stages alone: decoding, smoothing, heading lookup and roll
+	packets, in samples per second. End to end: replay.Replay
+	publishing at 10x, 100x and as fast as possible to a
+	PupilIntake, and to steer_loop driving the simulator.
+
+		python replay_benchmark.py [recording directory]
+
+	Without a directory one minute of synthetic 120 Hz pupil and
+	gaze data is recorded first.
+'''
+import os
+import sys
+import time
+import shutil
+import tempfile
+import threading
+import numpy as np
+import zmq
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import calibration
+import control_loop
+import gaze_filter
+import pupil_driver
+import pupil_stream
+import replay
+import sphero_driver
+import sphero_sim
+
+ADDRESS = 'ipc://%s/replay_benchmark' % tempfile.gettempdir()
+CON_LEVEL = 0.65
+SPEEDS = (10., 100., 0.)
+
+
+class NullLink(object):
+	def send(self, data):
+		pass
+
+
+def synthesize(directory, seconds = 60., rate = 120.):
+	random = np.random.RandomState(0)
+	count = int(seconds * rate)
+	timestamps = np.arange(count) / rate
+	# the pupil wanders between the corners of a 0.4 wide square
+	corner = random.randint(0, 4, count // 60).repeat(60)
+	centre = 0.3 + 0.4 * np.column_stack([corner % 2, corner // 2])[:count]
+	positions = centre + random.normal(0, 0.01, (count, 2))
+	pupil = np.column_stack([timestamps, random.uniform(0.6, 1, count), np.zeros(count), positions, np.full(count, 50.)])
+	gaze = np.column_stack([timestamps, random.uniform(0.6, 1, count), positions])
+	np.save(os.path.join(directory, replay.PUPIL_FILE), pupil)
+	np.save(os.path.join(directory, replay.GAZE_FILE), gaze)
+
+
+def rate(count, start):
+	return count / (time.time() - start)
+
+
+def stages(messages, data_range):
+	decoder = pupil_stream.PupilDecoder('Pupil', (pupil_stream.CONFIDENCE, pupil_stream.TIMESTAMP, pupil_stream.NORM_POS))
+	start = time.time()
+	samples = []
+	for timestamp, msg in messages:
+		pupil = decoder.decode(msg)
+		if pupil is not None:
+			samples.append((pupil.timestamp, pupil.confidence, pupil.norm_x, pupil.norm_y))
+	print 'stage decode      %9.0f messages/s' % rate(len(messages), start)
+	smoother = gaze_filter.OneEuroSmoother(pupil_driver.SMOOTH_MIN_CUTOFF, pupil_driver.SMOOTH_BETA)
+	start = time.time()
+	smoothed = [(timestamp, confidence) + smoother.filter(timestamp, x, y) for timestamp, confidence, x, y in samples]
+	print 'stage smooth      %9.0f samples/s' % rate(len(samples), start)
+	table = pupil_driver.HeadingTable(data_range, CON_LEVEL)
+	start = time.time()
+	headings = [table.heading(confidence, x, y) for timestamp, confidence, x, y in smoothed]
+	print 'stage heading     %9.0f samples/s' % rate(len(samples), start)
+	sphero = sphero_driver.Sphero()
+	sphero.bt = NullLink()
+	start = time.time()
+	for heading in headings:
+		if heading is None:
+			sphero.roll(100, 0, 0, False)
+		else:
+			sphero.roll(100, heading, 1, False)
+	print 'stage roll        %9.0f samples/s' % rate(len(headings), start)
+
+
+def publish(messages, speed, socket):
+	player = replay.Replay(messages, speed)
+	# give the subscriber time to connect
+	time.sleep(0.2)
+	thread = threading.Thread(target = player.publish, args = (socket,))
+	thread.start()
+	return player, thread
+
+
+def stop_when_done(loop, player, thread):
+	def check():
+		if not thread.is_alive():
+			# let the last messages through
+			loop.call_later(0.1, loop.stop)
+			timer.cancel()
+	timer = loop.call_every(0.01, check)
+
+
+def intake(messages, speed, context, pub):
+	sub = context.socket(zmq.SUB)
+	sub.connect(ADDRESS)
+	pupil_stream.subscribe(sub, ('Pupil',))
+	loop = control_loop.ControlLoop()
+	decoder = pupil_stream.PupilDecoder('Pupil', (pupil_stream.CONFIDENCE, pupil_stream.TIMESTAMP, pupil_stream.NORM_POS))
+	received = []
+	control_loop.PupilIntake(loop, sub, decoder, lambda pupil: received.append(pupil.timestamp))
+	player, thread = publish(messages, speed, pub)
+	stop_when_done(loop, player, thread)
+	loop.run()
+	sub.close()
+	expected = sum(1 for timestamp, msg in messages if msg.startswith('Pupil\n'))
+	print 'intake   %-6s  %s, %d of %d pupil messages handled' % (speed or 'max', player, len(received), expected)
+
+
+def steering(messages, speed, context, pub, data_range):
+	transport, sim = sphero_sim.loopback()
+	pupil_driver.sphero = sphero_driver.Sphero()
+	pupil_driver.sphero.connect(transport)
+	pupil_driver.sphero.start()
+	sub = context.socket(zmq.SUB)
+	sub.connect(ADDRESS)
+	pupil_stream.subscribe(sub, ('Pupil',))
+	loop = control_loop.ControlLoop()
+	table = pupil_driver.HeadingTable(data_range, CON_LEVEL)
+	player, thread = publish(messages, speed, pub)
+	stop_when_done(loop, player, thread)
+	pupil_driver.steer_loop(sub, CON_LEVEL, data_range, 100, table = table, loop = loop)
+	pupil_driver.sphero.ping(True).result(1)
+	print 'steering %-6s  %s, %d rolls handled by the simulator' % (
+		speed or 'max', player, sim.commands[tuple(sphero_driver.REQ['CMD_ROLL'])])
+	pupil_driver.sphero.disconnect()
+	sim.stop()
+	sub.close()
+
+
+def main():
+	directory = sys.argv[1] if len(sys.argv) > 1 else None
+	temporary = directory is None
+	if temporary:
+		directory = tempfile.mkdtemp()
+		synthesize(directory)
+	try:
+		messages = replay.load(directory)
+	finally:
+		if temporary:
+			shutil.rmtree(directory)
+	calibrator = calibration.SpaceCalibrator(CON_LEVEL, max_samples = len(messages))
+	decoder = pupil_stream.PupilDecoder('Pupil')
+	for timestamp, msg in messages:
+		pupil = decoder.decode(msg)
+		if pupil is not None and calibrator.add(pupil.confidence, pupil.norm_x, pupil.norm_y):
+			break
+	data_range = calibrator.data_range()
+	print '%d messages over %.0f seconds, data range %s' % (len(messages), messages[-1][0] - messages[0][0], data_range)
+	stages(messages, data_range)
+	context = zmq.Context()
+	pub = replay.bind(ADDRESS, context)
+	for speed in SPEEDS:
+		intake(messages, speed, context, pub)
+	for speed in SPEEDS:
+		steering(messages, speed, context, pub, data_range)
+	pub.close()
+	context.term()
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,82 @@
+#!/usr/bin/python
+'''
+	Measure how many useful messages per second a driver loop handles
+	when it subscribes to every message and discards the unwanted
+	topics in Python, compared to subscribing only to its topics.
+
+	A publisher thread sends a Pupil Server like stream in which only
+	one message out of every `ratio` is a Pupil message.
+
+		python subscription_benchmark.py [count] [ratio]
+'''
+import os
+import sys
+import time
+import threading
+import zmq
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import pupil_stream
+
+PUPIL = 'Pupil\nnorm_pos:(0.41, 0.58)\ndiameter:54.2\nconfidence:0.91\ntimestamp:1534.207\nid:0\n'
+OTHERS = ['Gaze\nnorm_pos:(0.3, 0.6)\nconfidence:0.8\ntimestamp:1534.210\n',
+	'Surface\nname:nexus\nuid:1534.1\nm_to_screen:[[1.0, 0.0, 0.0], [0.0, 1.0, 0.0], [0.0, 0.0, 1.0]]\n',
+	'Blink\nconfidence:0.2\ntimestamp:1534.211\n']
+
+
+def publish(context, address, count, ratio, ready):
+	socket = context.socket(zmq.PUB)
+	socket.setsockopt(zmq.SNDHWM, 0)
+	socket.bind(address)
+	ready.wait()
+	# give the subscription time to reach the publisher
+	time.sleep(0.5)
+	for i in xrange(count):
+		if i % ratio == 0:
+			socket.send(PUPIL)
+		else:
+			socket.send(OTHERS[i % len(OTHERS)])
+	socket.send('Pupil\nstop:1\n')
+	socket.close()
+
+
+def run(topics, count, ratio, port):
+	context = zmq.Context()
+	address = 'tcp://127.0.0.1:%d' % port
+	ready = threading.Event()
+	publisher = threading.Thread(target = publish, args = (context, address, count, ratio, ready))
+	publisher.start()
+	socket = context.socket(zmq.SUB)
+	socket.setsockopt(zmq.RCVHWM, 0)
+	socket.connect(address)
+	pupil_stream.subscribe(socket, topics)
+	ready.set()
+	decoder = pupil_stream.PupilDecoder('Pupil')
+	received = 0
+	handled = 0
+	start = None
+	while True:
+		msg = socket.recv()
+		if start is None:
+			start = time.time()
+		received += 1
+		if msg.startswith('Pupil\nstop'):
+			break
+		if decoder.decode(msg) is not None:
+			handled += 1
+	elapsed = time.time() - start
+	publisher.join()
+	socket.close()
+	context.term()
+	return received, handled, elapsed
+
+
+def main():
+	count = int(sys.argv[1]) if len(sys.argv) > 1 else 400000
+	ratio = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+	for name, topics, port in (('subscribe all', [], 5601), ('subscribe Pupil', ['Pupil'], 5602)):
+		received, handled, elapsed = run(topics, count, ratio, port)
+		print '%-16s received %8d  handled %7d  %8.0f handled msg/s' % (name, received, handled, handled / elapsed)
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,67 @@
+#!/usr/bin/python
+'''
+	Time of one sanity pass of sanitize_timestamps over world
+	timestamps of recordings of several lengths at 60 fps, with the
+	former per timestamp loops and with the vectorized clean_mask.
+	The masks are compared for every length. Then the cost per frame
+	of the TimestampMonitor while recording, and, with scipy, the
+	stop time of sanitize_timestamps against TimestampMonitor.repair.
+
+		python timestamps_benchmark.py [minutes ...]
+'''
+import os
+import sys
+import time
+import logging
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import timestamps
+
+FPS = 60
+
+
+def recording(minutes):
+	random = np.random.RandomState(0)
+	count = int(minutes * 60 * FPS)
+	ts = np.arange(count) / float(FPS) + random.uniform(0, 0.002, count)
+	# a capture hiccup every few minutes
+	for index in random.randint(0, count, max(1, int(minutes / 5))):
+		ts[index] -= 0.1
+	return ts
+
+
+def best(function, ts, repeat = 3):
+	elapsed = []
+	for r in range(repeat):
+		start = time.time()
+		mask = function(ts)
+		elapsed.append(time.time() - start)
+	return min(elapsed), mask
+
+
+def main():
+	logging.disable(logging.WARNING)
+	for minutes in map(float, sys.argv[1:] or ['1', '10', '60', '120']):
+		ts = recording(minutes)
+		loop, loop_mask = best(timestamps.clean_mask_loop, ts, 1)
+		vectorized, mask = best(timestamps.clean_mask, ts)
+		print '%5.0f min %8d timestamps  loops %8.1f ms  vectorized %6.2f ms  %6.0fx  identical %s' % (
+			minutes, len(ts), 1000 * loop, 1000 * vectorized, loop / vectorized, np.array_equal(mask, loop_mask))
+		start = time.time()
+		monitor = timestamps.TimestampMonitor()
+		for t in ts:
+			monitor.add(t)
+		print '          monitor %6.2f us/frame  %d glitches  same mask %s' % (
+			1e6 * (time.time() - start) / len(ts), monitor.glitches, np.array_equal(monitor.bad_mask(len(ts)), ~mask))
+		try:
+			import scipy
+		except ImportError:
+			continue
+		full, fixed_full = best(timestamps.sanitize_timestamps, ts, 1)
+		windows, fixed = best(monitor.repair, ts, 1)
+		print '          stop: whole series %8.1f ms  flagged windows %6.1f ms  max difference %.2e s' % (
+			1000 * full, 1000 * windows, np.abs(fixed - fixed_full).max())
+
+if __name__ == '__main__':
+	main()
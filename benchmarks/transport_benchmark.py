@@ -0,0 +1,84 @@
+#!/usr/bin/python
+'''
+	Throughput and latency of the Sphero driver against the simulated
+	Sphero of sphero_sim, over an in-process loopback link, a pty or
+	TCP (using sphero_sim.serve_tcp started with python sphero_sim.py).
+
+		python transport_benchmark.py [loopback|pty|tcp] [commands]
+'''
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import sphero_driver
+import sphero_sim
+import sphero_transport
+
+ROLL = tuple(sphero_driver.REQ['CMD_ROLL'])
+
+
+def start(link, **kwargs):
+	if link == 'pty':
+		path, sim = sphero_sim.open_pty(**kwargs)
+		transport = sphero_transport.SerialTransport(path)
+	elif link == 'tcp':
+		transport, sim = sphero_transport.TCPTransport(), None
+	else:
+		transport, sim = sphero_sim.loopback(**kwargs)
+	sphero = sphero_driver.Sphero()
+	sphero.connect(transport)
+	sphero.start()
+	return sphero, sim
+
+
+def stop(sphero, sim):
+	sphero.disconnect()
+	if sim is not None:
+		sim.stop()
+	sphero.join(1)
+
+
+def commands(link, count):
+	sphero, sim = start(link)
+	start_time = time.time()
+	for i in xrange(count):
+		sphero.roll(i % 256, i % 360, 1, False)
+	# the response to the ping comes after every roll was handled
+	sphero.ping(True).result(10)
+	elapsed = time.time() - start_time
+	handled = sim.commands[ROLL] if sim is not None else count
+	print 'commands   %8d sent  %8d handled  %8.0f commands/s' % (count, handled, count / elapsed)
+	stop(sphero, sim)
+
+
+def responses(link, count):
+	sphero, sim = start(link)
+	for i in xrange(count):
+		sphero.ping(True).result(1)
+	print 'responses  %s' % sphero.response_rtt
+	stop(sphero, sim)
+
+
+def streaming(link, seconds, corrupt_rate):
+	sphero, sim = start(link, sensor_rate = 20000., corrupt_rate = corrupt_rate, seed = 1)
+	sphero.enable_telemetry(1 << 16)
+	sphero.set_all_data_strm(1, 1, 0, False)
+	time.sleep(seconds)
+	samples = sphero.telemetry.count
+	print 'streaming  %5.1f%% corrupt  %8.0f samples/s of %d fields  bad checksums %d  skipped bytes %d' % (
+		100 * corrupt_rate, samples / seconds, len(sphero.mask_list), sphero.framer.bad_checksum, sphero.framer.skipped_bytes)
+	stop(sphero, sim)
+
+
+def main():
+	link = sys.argv[1] if len(sys.argv) > 1 else 'loopback'
+	count = int(sys.argv[2]) if len(sys.argv) > 2 else 20000
+	commands(link, count)
+	responses(link, count / 20)
+	if link != 'tcp':
+		for corrupt_rate in (0., 0.01):
+			streaming(link, 1., corrupt_rate)
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,194 @@
+'''
+	Online space calibration of the pupil driver.
+
+	The user looks at the four extreme regions of the observation
+	space while SpaceCalibrator follows the robust extents of the
+	confident pupil positions with streaming quantiles, so single
+	outliers do not stretch the range. Calibration finishes once
+	all four quadrants around the estimated middle were looked at
+	and the extents stopped moving, instead of after a fixed number
+	of samples, and memory stays bounded however long it takes.
+
+	The positions can be kept for an offline look at the
+	calibration, plotted with
+
+		python calibration.py calibration.npz
+'''
+
+import sys
+from collections import deque
+
+
+class P2Quantile(object):
+	'''
+		P-square estimate of the q-th quantile (0 < q < 1) of a
+		stream (Jain and Chlamtac 1985), five markers whose
+		heights are moved with piecewise parabolic interpolation.
+	'''
+	def __init__(self, q):
+		self.q = q
+		self.count = 0
+		self.heights = []
+		self.positions = [1, 2, 3, 4, 5]
+		self.desired = [1, 1 + 2 * q, 1 + 4 * q, 3 + 2 * q, 5]
+		self.increments = [0, q / 2., q, (1 + q) / 2., 1]
+
+	def add(self, x):
+		self.count += 1
+		heights = self.heights
+		if self.count <= 5:
+			heights.append(x)
+			heights.sort()
+			return
+		positions = self.positions
+		if x < heights[0]:
+			heights[0] = x
+			k = 0
+		elif x >= heights[4]:
+			heights[4] = x
+			k = 3
+		else:
+			k = 0
+			while x >= heights[k + 1]:
+				k += 1
+		for i in range(k + 1, 5):
+			positions[i] += 1
+		desired = self.desired
+		for i in range(5):
+			desired[i] += self.increments[i]
+		for i in (1, 2, 3):
+			d = desired[i] - positions[i]
+			if (d >= 1 and positions[i + 1] - positions[i] > 1) or (d <= -1 and positions[i - 1] - positions[i] < -1):
+				d = 1 if d > 0 else -1
+				height = self.parabolic(i, d)
+				if not heights[i - 1] < height < heights[i + 1]:
+					height = heights[i] + d * (heights[i + d] - heights[i]) / float(positions[i + d] - positions[i])
+				heights[i] = height
+				positions[i] += d
+
+	def parabolic(self, i, d):
+		heights = self.heights
+		n = self.positions
+		return heights[i] + d / float(n[i + 1] - n[i - 1]) * (
+			(n[i] - n[i - 1] + d) * (heights[i + 1] - heights[i]) / float(n[i + 1] - n[i]) +
+			(n[i + 1] - n[i] - d) * (heights[i] - heights[i - 1]) / float(n[i] - n[i - 1]))
+
+	def value(self):
+		'''
+			Current estimate, None before the first sample.
+		'''
+		if self.count == 0:
+			return None
+		if self.count <= 5:
+			return self.heights[int(round(self.q * (self.count - 1)))]
+		return self.heights[2]
+
+
+class SpaceCalibrator(object):
+	'''
+		Robust extents of the observation space from a stream of
+		pupil positions. The x axis is flipped like in the driver.
+
+		Extents are the low and high quantiles of each axis.
+		Every check samples the extents are compared with the
+		previous check, the calibration is done when none moved
+		by more than tolerance, at least min_quadrant samples
+		fell in every quadrant around the middle (away from the
+		middle by an eighth of the larger extent on both axes)
+		and min_samples were seen, or after max_samples in any
+		case. keep is the
+		number of the latest positions kept for dump.
+	'''
+	def __init__(self, con_level, low = 0.02, high = 0.98, min_samples = 100, max_samples = 2000,
+			check = 50, tolerance = 0.005, min_quadrant = 10, keep = 0):
+		self.con_level = con_level
+		self.min_samples = min_samples
+		self.max_samples = max_samples
+		self.check = check
+		self.tolerance = tolerance
+		self.min_quadrant = min_quadrant
+		self.quantiles = [P2Quantile(low), P2Quantile(high), P2Quantile(low), P2Quantile(high)]
+		self.quadrants = [0, 0, 0, 0]
+		self.count = 0
+		self.last_extents = None
+		self.converged = False
+		self.points = deque(maxlen = keep) if keep else None
+
+	@property
+	def done(self):
+		return self.converged or self.count >= self.max_samples
+
+	def extents(self):
+		'''
+			x_min, x_max, y_min and y_max.
+		'''
+		return [quantile.value() for quantile in self.quantiles]
+
+	def add(self, confidence, norm_x, norm_y):
+		'''
+			Feed one pupil position, returns done.
+		'''
+		if confidence <= self.con_level:
+			return self.done
+		x = 1 - norm_x
+		y = norm_y
+		x_min, x_max, y_min, y_max = self.quantiles
+		x_min.add(x)
+		x_max.add(x)
+		y_min.add(y)
+		y_max.add(y)
+		if self.points is not None:
+			self.points.append((x, y))
+		self.count += 1
+		# a quadrant counts samples clearly off the middle on
+		# both axes, noise around a line does not fill two
+		x_low, x_high, y_low, y_high = x_min.value(), x_max.value(), y_min.value(), y_max.value()
+		diff_x = x - (x_low + x_high) / 2.
+		diff_y = y - (y_low + y_high) / 2.
+		margin = max(x_high - x_low, y_high - y_low) / 8.
+		if abs(diff_x) >= margin and abs(diff_y) >= margin:
+			self.quadrants[(diff_x > 0) + 2 * (diff_y > 0)] += 1
+		if self.count % self.check == 0:
+			extents = self.extents()
+			if self.last_extents is not None and self.count >= self.min_samples and min(self.quadrants) >= self.min_quadrant:
+				moved = max(abs(e - last) for e, last in zip(extents, self.last_extents))
+				self.converged = moved <= self.tolerance
+			self.last_extents = extents
+		return self.done
+
+	def data_range(self):
+		'''
+			middle_x, middle_y and inner radius of the steering
+			dead zone, a quarter of the smaller extent.
+		'''
+		x_min, x_max, y_min, y_max = self.extents()
+		t_range = min(abs(x_min - x_max), abs(y_min - y_max))
+		return (x_min + x_max) / 2., (y_min + y_max) / 2., t_range / 4.
+
+	def dump(self, path):
+		'''
+			Save the kept positions and the extents for plot.
+		'''
+		import numpy as np
+		points = np.array(self.points if self.points is not None else [], dtype = float).reshape(-1, 2)
+		np.savez(path, points = points, extents = self.extents(), data_range = self.data_range())
+
+
+def plot(path):
+	'''
+		Scatter plot of a calibration saved by dump, with the
+		extents and the dead zone.
+	'''
+	import numpy as np
+	import matplotlib.pyplot as plt
+	saved = np.load(path)
+	points = saved['points']
+	x_min, x_max, y_min, y_max = saved['extents']
+	middle_x, middle_y, inner_radius = saved['data_range']
+	plt.scatter(points[:, 0], points[:, 1])
+	plt.plot([x_min, x_max, x_max, x_min, x_min], [y_min, y_min, y_max, y_max, y_min], 'y')
+	plt.gca().add_patch(plt.Circle((middle_x, middle_y), inner_radius, color = 'r', fill = False))
+	plt.show()
+
+if __name__ == '__main__':
+	plot(sys.argv[1])
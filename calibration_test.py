@@ -0,0 +1,89 @@
+#!/usr/bin/python
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import calibration
+
+# corners of the observation space in pupil coordinates,
+# looked at one after the other during calibration
+CORNERS = [(0.3, 0.4), (0.7, 0.4), (0.3, 0.6), (0.7, 0.6)]
+
+def corner_stream(corners, count, noise = 0.01, seed = 0):
+	random = np.random.RandomState(seed)
+	for i in range(count):
+		x, y = corners[(i // 40) % len(corners)]
+		yield 0.9, x + random.normal(0, noise), y + random.normal(0, noise)
+
+class TestP2Quantile(unittest.TestCase):
+	'''
+		Streaming quantiles are close to the exact ones.
+	'''
+	def test_normal(self):
+		values = np.random.RandomState(1).normal(size = 5000)
+		for q in (0.02, 0.5, 0.98):
+			quantile = calibration.P2Quantile(q)
+			for value in values:
+				quantile.add(value)
+			self.assertAlmostEqual(quantile.value(), np.percentile(values, 100 * q), 1)
+
+	def test_few_samples(self):
+		quantile = calibration.P2Quantile(0.5)
+		self.assertEqual(quantile.value(), None)
+		for value in (3., 1., 2.):
+			quantile.add(value)
+		self.assertEqual(quantile.value(), 2.)
+
+	def test_outlier(self):
+		quantile = calibration.P2Quantile(0.98)
+		for value in np.random.RandomState(2).uniform(size = 1000):
+			quantile.add(value)
+		quantile.add(100.)
+		self.assertTrue(quantile.value() < 1.)
+
+class TestSpaceCalibrator(unittest.TestCase):
+	'''
+		Calibration stops once the extents settle after all
+		corners were looked at.
+	'''
+	def calibrate(self, stream, **kwargs):
+		calibrator = calibration.SpaceCalibrator(0.65, **kwargs)
+		for sample in stream:
+			if calibrator.add(*sample):
+				break
+		return calibrator
+
+	def test_converges(self):
+		calibrator = self.calibrate(corner_stream(CORNERS, 5000))
+		self.assertTrue(calibrator.converged)
+		self.assertTrue(calibrator.count < 2000)
+		middle_x, middle_y, inner_radius = calibrator.data_range()
+		self.assertAlmostEqual(middle_x, 0.5, 1)
+		self.assertAlmostEqual(middle_y, 0.5, 1)
+		self.assertTrue(0.04 < inner_radius < 0.07)
+
+	def test_needs_every_quadrant(self):
+		calibrator = self.calibrate(corner_stream(CORNERS[:2], 5000))
+		self.assertFalse(calibrator.converged)
+		self.assertEqual(calibrator.count, calibrator.max_samples)
+
+	def test_not_confident(self):
+		calibrator = calibration.SpaceCalibrator(0.65)
+		calibrator.add(0.5, 0.5, 0.5)
+		self.assertEqual(calibrator.count, 0)
+
+	def test_dump(self):
+		directory = tempfile.mkdtemp()
+		try:
+			calibrator = self.calibrate(corner_stream(CORNERS, 5000), keep = 100)
+			path = os.path.join(directory, 'calibration.npz')
+			calibrator.dump(path)
+			saved = np.load(path)
+			self.assertEqual(saved['points'].shape, (100, 2))
+			self.assertEqual(list(saved['data_range']), list(calibrator.data_range()))
+		finally:
+			shutil.rmtree(directory)
+
+if __name__ == '__main__':
+	unittest.main()
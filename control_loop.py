@@ -0,0 +1,165 @@
+'''
+	Single threaded event loop to drive sphero with the pupil
+	headset.
+
+	Python 2 has no asyncio, so the loop is built on zmq.Poller,
+	which polls ZeroMQ sockets and plain file descriptors such as
+	the bluetooth socket of sphero together. Pupil intake, sphero
+	input and timers all run as callbacks on one thread, instead of
+	blocking loops in several threads sharing locks.
+'''
+
+import heapq
+import time
+import zmq
+import metrics
+
+
+class Timer(object):
+	'''
+		Handle of a callback scheduled on the ControlLoop.
+	'''
+	__slots__ = ('when', 'interval', 'callback', 'cancelled')
+
+	def __init__(self, when, interval, callback):
+		self.when = when
+		self.interval = interval
+		self.callback = callback
+		self.cancelled = False
+
+	def cancel(self):
+		self.cancelled = True
+
+
+class ControlLoop(object):
+	'''
+		Poll readers and run due timers until stop is called.
+		How late timers run is collected in self.jitter.
+	'''
+	def __init__(self):
+		self.poller = zmq.Poller()
+		self.running = False
+		self.jitter = metrics.LatencyStats('timer jitter')
+		self._readers = {}
+		self._timers = []
+		self._timer_count = 0
+
+	def add_reader(self, source, callback):
+		'''
+			Call callback whenever source is readable. source is a
+			ZeroMQ socket, a file descriptor or an object with a
+			fileno method.
+		'''
+		self._readers[source] = callback
+		self.poller.register(source, zmq.POLLIN)
+
+	def remove_reader(self, source):
+		self.poller.unregister(source)
+		del self._readers[source]
+
+	def call_later(self, delay, callback, interval = None):
+		'''
+			Run callback after delay seconds, and then every interval
+			seconds when an interval is given. Returns a Timer.
+		'''
+		timer = Timer(time.time() + delay, interval, callback)
+		self._push(timer)
+		return timer
+
+	def call_every(self, interval, callback):
+		return self.call_later(interval, callback, interval)
+
+	def _push(self, timer):
+		# the counter keeps timers due at the same time in order
+		self._timer_count += 1
+		heapq.heappush(self._timers, (timer.when, self._timer_count, timer))
+
+	def run_once(self):
+		timeout = None
+		if self._timers:
+			timeout = max(0., (self._timers[0][0] - time.time()) * 1000.)
+		for source, event in self.poller.poll(timeout):
+			self._readers[source]()
+		now = time.time()
+		while self._timers and self._timers[0][0] <= now:
+			when, count, timer = heapq.heappop(self._timers)
+			if timer.cancelled:
+				continue
+			self.jitter.add(now - when)
+			if timer.interval is not None:
+				# keep the schedule, skip runs that are already missed
+				missed = int((now - when) / timer.interval)
+				timer.when = when + (missed + 1) * timer.interval
+				self._push(timer)
+			timer.callback()
+			now = time.time()
+
+	def run(self):
+		self.running = True
+		while self.running:
+			self.run_once()
+
+	def stop(self):
+		self.running = False
+
+
+class PupilIntake(object):
+	'''
+		Hand decoded Pupil messages arriving on a SUB socket to
+		callback, from the ControlLoop. With conflate only the
+		newest message queued on the socket is handed on.
+	'''
+	def __init__(self, loop, socket, decoder, callback, conflate = False):
+		self.socket = socket
+		self.decoder = decoder
+		self.callback = callback
+		self.conflate = conflate
+		self.skipped = 0
+		self._prefix = decoder.topic + '\n'
+		loop.add_reader(socket, self._on_readable)
+
+	def _on_readable(self):
+		latest = None
+		while True:
+			try:
+				msg = self.socket.recv(zmq.NOBLOCK)
+			except zmq.Again:
+				break
+			if not self.conflate:
+				self._handle(msg)
+			elif msg.startswith(self._prefix):
+				if latest is not None:
+					self.skipped += 1
+				latest = msg
+		if latest is not None:
+			self._handle(latest)
+
+	def _handle(self, msg):
+		try:
+			record = self.decoder.decode(msg)
+		except KeyError:
+			return
+		if record is not None:
+			self.callback(record)
+
+
+def attach_sphero(loop, sphero, num_bytes = 1024):
+	'''
+		Read and dispatch sphero packets from the ControlLoop
+		instead of the receive thread of sphero. While sphero
+		reconnects the link is watched until it is back.
+	'''
+	def on_readable():
+		sphero.recv_once(num_bytes)
+		if not sphero.is_connected:
+			loop.remove_reader(sphero)
+			if sphero.state == 'reconnecting':
+				loop.call_later(0.1, watch)
+
+	def watch():
+		if sphero.is_connected:
+			loop.add_reader(sphero, on_readable)
+		elif sphero.state == 'reconnecting':
+			loop.call_later(0.1, watch)
+
+	loop.add_reader(sphero, on_readable)
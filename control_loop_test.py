@@ -0,0 +1,75 @@
+#!/usr/bin/python
+import time
+import unittest
+import zmq
+import control_loop
+import pupil_stream
+
+class TestControlLoop(unittest.TestCase):
+	'''
+		Timers and readers run from one thread.
+	'''
+	def setUp(self):
+		self.loop = control_loop.ControlLoop()
+		self.calls = []
+
+	def test_timer_order(self):
+		self.loop.call_later(0.02, lambda: self.calls.append('late'))
+		self.loop.call_later(0.01, lambda: self.calls.append('early'))
+		self.loop.call_later(0.03, self.loop.stop)
+		self.loop.run()
+		self.assertEqual(self.calls, ['early', 'late'])
+
+	def test_repeat_and_cancel(self):
+		def repeat():
+			self.calls.append('repeat')
+			if len(self.calls) == 4:
+				self.loop.stop()
+		self.loop.call_every(0.005, repeat)
+		cancelled = self.loop.call_later(0.01, lambda: self.calls.append('cancelled'))
+		cancelled.cancel()
+		self.loop.run()
+		self.assertEqual(self.calls, ['repeat'] * 4)
+
+class TestPupilIntake(unittest.TestCase):
+	'''
+		Queued messages are decoded and handed on,
+		only the newest one with conflate.
+	'''
+	def setUp(self):
+		self.context = zmq.Context()
+		self.pull = self.context.socket(zmq.PULL)
+		self.pull.bind('inproc://intake')
+		self.push = self.context.socket(zmq.PUSH)
+		self.push.connect('inproc://intake')
+		self.loop = control_loop.ControlLoop()
+		self.seen = []
+
+	def tearDown(self):
+		self.push.close()
+		self.pull.close()
+		self.context.term()
+
+	def run_intake(self, conflate):
+		decoder = pupil_stream.PupilDecoder('Pupil', (pupil_stream.TIMESTAMP,))
+		intake = control_loop.PupilIntake(self.loop, self.pull, decoder,
+			lambda pupil: self.seen.append(pupil.timestamp), conflate)
+		for i in range(3):
+			self.push.send('Pupil\ntimestamp:%d\n' % i)
+		self.push.send('Gaze\ntimestamp:9\n')
+		time.sleep(0.05)
+		self.loop.call_later(0.01, self.loop.stop)
+		self.loop.run()
+		return intake
+
+	def test_every_message(self):
+		self.run_intake(False)
+		self.assertEqual(self.seen, [0., 1., 2.])
+
+	def test_conflate(self):
+		intake = self.run_intake(True)
+		self.assertEqual(self.seen, [2.])
+		self.assertEqual(intake.skipped, 2)
+
+if __name__ == '__main__':
+	unittest.main()
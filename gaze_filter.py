@@ -0,0 +1,229 @@
+'''
+	Streaming filters for gaze and pupil positions.
+
+	The drivers act on every single sample of the Pupil Server, so
+	the noise of the eye tracker turns into heading jitter and
+	spurious taps. The filters here sit between the decoder and the
+	steering decision and do a constant amount of work per sample:
+
+		ExponentialSmoother	exponential moving average
+		OneEuroSmoother		One Euro filter, smooths strongly while
+					the gaze rests and follows saccades
+		VelocityFixation	I-VT, a fixation is a run of samples
+					moving slower than a velocity threshold
+		DispersionFixation	I-DT, a fixation is a window of samples
+					spread less than a dispersion threshold
+
+	Smoothers return the filtered (x, y) of each sample. Fixation
+	detectors return a Fixation once per fixation, when it has lasted
+	min_duration, and None for every other sample.
+'''
+
+import math
+from collections import deque
+
+
+class ExponentialSmoother(object):
+	'''
+		Exponential moving average of positions, alpha is the
+		weight of the newest sample.
+	'''
+	def __init__(self, alpha = 0.3):
+		self.alpha = alpha
+		self.reset()
+
+	def reset(self):
+		self.x = None
+		self.y = None
+
+	def filter(self, timestamp, x, y):
+		if self.x is None:
+			self.x, self.y = x, y
+		else:
+			alpha = self.alpha
+			self.x += alpha * (x - self.x)
+			self.y += alpha * (y - self.y)
+		return self.x, self.y
+
+
+def smoothing_factor(elapsed, cutoff):
+	tau = 1. / (2 * math.pi * cutoff)
+	return 1. / (1. + tau / elapsed)
+
+class OneEuroSmoother(object):
+	'''
+		One Euro filter (Casiez et al. 2012) of positions. The
+		cutoff frequency in Hz grows with the filtered speed, from
+		min_cutoff for a resting gaze by beta per unit of speed,
+		so fixations are smoothed hard and saccades lag little.
+		derivative_cutoff smooths the speed estimate itself.
+	'''
+	def __init__(self, min_cutoff = 1., beta = 1., derivative_cutoff = 1.):
+		self.min_cutoff = min_cutoff
+		self.beta = beta
+		self.derivative_cutoff = derivative_cutoff
+		self.reset()
+
+	def reset(self):
+		self.x = None
+		self.y = None
+		self.dx = 0.
+		self.dy = 0.
+		self.timestamp = None
+
+	def filter(self, timestamp, x, y):
+		if self.x is None:
+			self.x, self.y, self.timestamp = x, y, timestamp
+			return x, y
+		elapsed = timestamp - self.timestamp
+		if elapsed <= 0:
+			# repeated or out of order sample, nothing to learn from
+			return self.x, self.y
+		self.timestamp = timestamp
+		alpha = smoothing_factor(elapsed, self.derivative_cutoff)
+		self.dx += alpha * ((x - self.x) / elapsed - self.dx)
+		self.dy += alpha * ((y - self.y) / elapsed - self.dy)
+		speed = math.sqrt(self.dx * self.dx + self.dy * self.dy)
+		alpha = smoothing_factor(elapsed, self.min_cutoff + self.beta * speed)
+		self.x += alpha * (x - self.x)
+		self.y += alpha * (y - self.y)
+		return self.x, self.y
+
+
+class Fixation(object):
+	'''
+		Centroid, start and duration of a detected fixation.
+	'''
+	__slots__ = ('x', 'y', 'start', 'duration')
+
+	def __init__(self, x, y, start, duration):
+		self.x = x
+		self.y = y
+		self.start = start
+		self.duration = duration
+
+	def __repr__(self):
+		return 'Fixation(x=%g, y=%g, start=%g, duration=%g)' % (self.x, self.y, self.start, self.duration)
+
+
+class VelocityFixation(object):
+	'''
+		I-VT fixation detection. Samples moving slower than
+		max_velocity (position units per second) since the
+		previous sample belong to the current fixation, a faster
+		one starts over. The centroid is kept as running sums.
+	'''
+	def __init__(self, max_velocity, min_duration):
+		self.max_velocity = max_velocity
+		self.min_duration = min_duration
+		self.reset()
+
+	def reset(self):
+		self.last = None
+		self.start = None
+		self.count = 0
+		self.sum_x = 0.
+		self.sum_y = 0.
+		self.reported = False
+
+	def restart(self, timestamp, x, y):
+		self.start = timestamp
+		self.count = 1
+		self.sum_x = x
+		self.sum_y = y
+		self.reported = False
+
+	def add(self, timestamp, x, y):
+		last = self.last
+		self.last = timestamp, x, y
+		if last is None:
+			self.restart(timestamp, x, y)
+			return None
+		elapsed = timestamp - last[0]
+		if elapsed <= 0:
+			return None
+		distance = math.sqrt((x - last[1]) ** 2 + (y - last[2]) ** 2)
+		if distance / elapsed > self.max_velocity:
+			self.restart(timestamp, x, y)
+			return None
+		self.count += 1
+		self.sum_x += x
+		self.sum_y += y
+		duration = timestamp - self.start
+		if self.reported or duration < self.min_duration:
+			return None
+		self.reported = True
+		return Fixation(self.sum_x / self.count, self.sum_y / self.count, self.start, duration)
+
+
+class DispersionFixation(object):
+	'''
+		I-DT fixation detection over a sliding window. The
+		dispersion of the window is (max x - min x) + (max y -
+		min y); a sample raising it above max_dispersion drops the
+		oldest samples until it fits again, which ends the current
+		fixation. Minimum and maximum come from monotonic queues,
+		so every sample is added and dropped once. The window
+		keeps at most size samples, older ones only leave the
+		centroid, the fixation itself goes on.
+	'''
+	def __init__(self, max_dispersion, min_duration, size = 256):
+		self.max_dispersion = max_dispersion
+		self.min_duration = min_duration
+		self.size = size
+		self.reset()
+
+	def reset(self):
+		# samples of the window as (index, timestamp, x, y)
+		self.window = deque()
+		# indices of window samples with increasing x, decreasing
+		# x, increasing y and decreasing y
+		self.min_x = deque()
+		self.max_x = deque()
+		self.min_y = deque()
+		self.max_y = deque()
+		self.index = 0
+		self.sum_x = 0.
+		self.sum_y = 0.
+		self.start = None
+		self.reported = False
+
+	def dispersion(self):
+		if not self.window:
+			return 0.
+		return self.max_x[0][1] - self.min_x[0][1] + self.max_y[0][1] - self.min_y[0][1]
+
+	def drop_oldest(self):
+		index, timestamp, x, y = self.window.popleft()
+		self.sum_x -= x
+		self.sum_y -= y
+		for extreme in (self.min_x, self.max_x, self.min_y, self.max_y):
+			if extreme[0][0] == index:
+				extreme.popleft()
+
+	def add(self, timestamp, x, y):
+		index = self.index
+		self.index += 1
+		self.window.append((index, timestamp, x, y))
+		self.sum_x += x
+		self.sum_y += y
+		for extreme, value, smaller in ((self.min_x, x, True), (self.max_x, x, False),
+				(self.min_y, y, True), (self.max_y, y, False)):
+			while extreme and (extreme[-1][1] >= value if smaller else extreme[-1][1] <= value):
+				extreme.pop()
+			extreme.append((index, value))
+		if self.start is None:
+			self.start = timestamp
+		if self.dispersion() > self.max_dispersion:
+			while self.dispersion() > self.max_dispersion:
+				self.drop_oldest()
+			self.start = self.window[0][1]
+			self.reported = False
+		elif len(self.window) > self.size:
+			self.drop_oldest()
+		duration = timestamp - self.start
+		if self.reported or duration < self.min_duration:
+			return None
+		self.reported = True
+		count = len(self.window)
+		return Fixation(self.sum_x / count, self.sum_y / count, self.start, duration)
@@ -0,0 +1,95 @@
+#!/usr/bin/python
+import random
+import unittest
+import gaze_filter
+
+RATE = 120.
+
+def samples(points, seconds, noise = 0., seed = 0):
+	'''
+		Timestamped samples resting on each of points for
+		seconds, with gaussian noise.
+	'''
+	rand = random.Random(seed)
+	result = []
+	timestamp = 0.
+	for x, y in points:
+		for i in range(int(seconds * RATE)):
+			result.append((timestamp, x + rand.gauss(0, noise), y + rand.gauss(0, noise)))
+			timestamp += 1 / RATE
+	return result
+
+class TestSmoothers(unittest.TestCase):
+	'''
+		Smoothers reduce noise and settle on a new position.
+	'''
+	def spread(self, smoother):
+		filtered = [smoother.filter(*sample)[0] for sample in samples([(0.5, 0.5)], 2., 0.01)]
+		# skip the first samples while the filter settles
+		return max(filtered[60:]) - min(filtered[60:])
+
+	def test_noise_is_reduced(self):
+		raw = self.spread(gaze_filter.ExponentialSmoother(1.))
+		self.assertTrue(self.spread(gaze_filter.ExponentialSmoother(0.1)) < raw / 2)
+		self.assertTrue(self.spread(gaze_filter.OneEuroSmoother(1., 2.)) < raw / 2)
+
+	def test_follows_jump(self):
+		for smoother in (gaze_filter.ExponentialSmoother(0.3), gaze_filter.OneEuroSmoother(1., 2.)):
+			for sample in samples([(0.2, 0.2), (0.8, 0.6)], 0.5):
+				x, y = smoother.filter(*sample)
+			self.assertAlmostEqual(x, 0.8, 2)
+			self.assertAlmostEqual(y, 0.6, 2)
+
+	def test_repeated_timestamp(self):
+		smoother = gaze_filter.OneEuroSmoother()
+		smoother.filter(1., 0.5, 0.5)
+		self.assertEqual(smoother.filter(1., 0.9, 0.9), (0.5, 0.5))
+
+class TestFixation(unittest.TestCase):
+	'''
+		Both detectors report every fixation once, with its
+		centroid, and nothing for saccades.
+	'''
+	points = [(0.2, 0.2), (0.8, 0.3), (0.5, 0.9)]
+
+	def detect(self, detector, data):
+		return [f for f in (detector.add(*sample) for sample in data) if f is not None]
+
+	def check(self, detector):
+		fixations = self.detect(detector, samples(self.points, 1., 0.005))
+		self.assertEqual(len(fixations), 3)
+		for fixation, (x, y) in zip(fixations, self.points):
+			self.assertAlmostEqual(fixation.x, x, 2)
+			self.assertAlmostEqual(fixation.y, y, 2)
+			self.assertTrue(0.5 <= fixation.duration < 0.6)
+
+	def test_velocity(self):
+		self.check(gaze_filter.VelocityFixation(5., 0.5))
+
+	def test_dispersion(self):
+		self.check(gaze_filter.DispersionFixation(0.1, 0.5))
+
+	def test_too_short(self):
+		data = samples(self.points, 0.4)
+		self.assertEqual(self.detect(gaze_filter.VelocityFixation(5., 0.5), data), [])
+		self.assertEqual(self.detect(gaze_filter.DispersionFixation(0.1, 0.5), data), [])
+
+	def test_dispersion_window(self):
+		detector = gaze_filter.DispersionFixation(0.1, 10., size = 16)
+		data = samples([(0.5, 0.5)], 1., 0.01) + [(1., 0.9, 0.5)]
+		self.detect(detector, data)
+		self.assertEqual(len(detector.window), 1)
+		self.assertEqual(detector.dispersion(), 0.)
+		self.assertEqual(detector.start, 1.)
+
+	def test_dispersion_minimum_and_maximum(self):
+		detector = gaze_filter.DispersionFixation(10., 10., size = 8)
+		data = samples([(0.5, 0.5)], 1., 0.05, seed = 3)
+		for sample in data:
+			detector.add(*sample)
+			xs = [s[2] for s in detector.window]
+			ys = [s[3] for s in detector.window]
+			self.assertAlmostEqual(detector.dispersion(), max(xs) - min(xs) + max(ys) - min(ys))
+
+if __name__ == '__main__':
+	unittest.main()
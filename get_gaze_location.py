@@ -17,55 +17,144 @@ debugging
 import zmq
 import math
 import signal
-from pyadb import ADB
-from sys import stdin, exit
+import pupil_stream
+import control_loop
+import gaze_filter
+from sys import stdin, exit, argv
 
-adb = ADB()
+# the adb client, constructed in __main__ so the tap logic can be
+# imported and replayed without pyadb
+adb = None
 
-def signal_handler(signal, frame):
-	adb.kill_server()
-	exit(0)
+# Pupil Server message topics the driver subscribes to
+TOPICS = ('Gaze',)
 
-def main():
+# dictionary key of the gaze position on the reference surface
+SURFACE = 'realtime gaze on nexus'
 
-	# reference surface we are going to track
-	surface_name = 'nexus'
-	# error message constant
-	error_message = 'Error occur in extracing gaze locataion'
+# set up the global value for printing message
+CMD_OUT = 'input tap {} {}'
 
-	# lowest acceptant level
-	con_level = 0.65
+def signal_handler(signal, frame):
+	adb.kill_server()
+	exit(0)
 
+class GazeTapper(object):
+	'''
+		Turns gaze positions on the nexus surface into taps,
+		sent as CMD_OUT with shell_command. By default a tap
+		is sent when the gaze stayed within radius of a point
+		for duration, with fixation for every dwell found by
+		the I-DT fixation filter on the smoothed gaze locations.
+		The sent commands are kept in taps.
+	'''
 	# resolution of nexus
-	y_pixel = 1200
 	x_pixel = 1920
-
+	y_pixel = 1200
 	# minimal radius for the range of the
 	# gaze location
 	radius = math.sqrt(105 ** 2 + 105 ** 2)
-
-	# time check is two seconds
+	# largest spread in pixels, horizontal plus vertical,
+	# of the gaze locations of one dwell, tuned with
+	# benchmarks/gaze_filter_benchmark.py
+	dispersion = 130
+	# time check is one second
 	duration = 1.0
 
-	# Setup three global variables, x, y and timestamp.
-	# So we can compare different between
-	# those messages
-	x = -1.0
-	y = -1.0
-	timestamp = -1
+	def __init__(self, shell_command, fixation = False, con_level = 0.65, debug = False):
+		self.shell_command = shell_command
+		self.fixation = fixation
+		self.con_level = con_level
+		self.debug = debug
+		self.taps = []
+		self.decoder = pupil_stream.PupilDecoder('Gaze', (pupil_stream.CONFIDENCE, pupil_stream.TIMESTAMP), surfaces = (SURFACE,))
+		# Setup three variables, x, y and timestamp.
+		# So we can compare different between
+		# those messages
+		self.x = -1.0
+		self.y = -1.0
+		self.timestamp = -1
+		if fixation:
+			self.smoother = gaze_filter.OneEuroSmoother(1., 0.01)
+			self.fixation_filter = gaze_filter.DispersionFixation(self.dispersion, self.duration)
+
+	def tap(self, x, y):
+		result = CMD_OUT.format(x, y)
+		if self.debug:
+			print result
+		self.shell_command(result)
+		self.taps.append(result)
+
+	def add(self, gaze):
+		'''
+			Handle one decoded gaze message.
+		'''
+		confidence = gaze.confidence
+		temp_timestamp = gaze.timestamp
+		gp = gaze.surfaces[SURFACE]
+		if not (confidence > self.con_level and gp is not None):
+			# case: confidence less than lowest confident level
+			return
+		# Check the confidence level then check two gp with timestamp.
+		gp_x, gp_y = gp
+		if not (0 <= gp_x <= 1 and 0 <= gp_y <= 1):
+			return
+		# denormalized the x and y position with pixel
+		# values in the reference surface
+		temp_x = gp_x * self.x_pixel
+		temp_y = (1 - gp_y) * self.y_pixel
+
+		if self.fixation:
+			fx, fy = self.smoother.filter(temp_timestamp, temp_x, temp_y)
+			dwell = self.fixation_filter.add(temp_timestamp, fx, fy)
+			if dwell is not None:
+				# case: the gaze dwelled long enough within
+				# range, tap the centre of the dwell
+				self.tap(int(dwell.x), int(dwell.y))
+				# the next tap needs a new dwell
+				self.fixation_filter.reset()
+			return
+
+		x, y, timestamp = self.x, self.y, self.timestamp
+		if self.debug:
+			print 'x: {}, y: {}, timestamp: {}'.format(x, y, timestamp)
+			print 'temp_x: {}, temp_y: {}, temp_timestamp: {}'.format(temp_x, temp_y, temp_timestamp)
+		if x == -1.0 or y == -1.0:
+			# case: get new x and y
+			self.x, self.y, self.timestamp = temp_x, temp_y, temp_timestamp
+		else:
+			# computation on checking the difference and timestamp
+			x_diff = abs(x - temp_x)
+			y_diff = abs(y - temp_y)
+			distance = math.sqrt((x_diff ** 2) + (y_diff ** 2))
+			if distance < self.radius:
+				# case: new gaze location is within range of
+				# standard point of gaze_location
+				if (temp_timestamp - timestamp) > self.duration:
+					self.tap(x, y)
+					self.x, self.y, self.timestamp = -1.0, -1.0, -1.0
+			else:
+				# case: new gaze locataion is outside range
+				# replace the standard point to new gaze_location
+				self.x, self.y, self.timestamp = temp_x, temp_y, temp_timestamp
+
+def main(topics = TOPICS, fixation = False):
 
-	# set up the global value for printing message
-	cmd_out = 'input tap {} {}'
-	# dictionary key
-	key = 'realtime gaze on nexus'
+	# reference surface we are going to track
+	surface_name = 'nexus'
+	# error message constant
+	error_message = 'Error occur in extracing gaze locataion'
+
+	# lowest acceptant level
+	con_level = 0.65
 
 	# set up network connection with pupil eye tracker
 	port = '5000'
 	context = zmq.Context()
 	socket = context.socket(zmq.SUB)
 	socket.connect('tcp://127.0.0.1:' + port)
-	# filter by message by stating string "STRING". '' receives all messages
-	socket.setsockopt(zmq.SUBSCRIBE, '')
+	# only receive the message topics used by the driver
+	pupil_stream.subscribe(socket, topics)
 
 
 	# # build up an adb object
@@ -154,71 +243,35 @@ def main():
 
  	print "Check"
 
+	tapper = GazeTapper(adb.shell_command, fixation, con_level, debug = True)
 	# accepting connection from pupil head set
 	while True:
 		msg = socket.recv()
-
-		items = msg.split("\n")
-		msg_type = items.pop(0)
-		items = dict([i.split(':', 1) for i in items[: -1] ])
-		# check the message type, if the message is from gaze
-		if msg_type == 'Gaze':
-			try:
-				# extract confidence and timestamp
-				confidence = float(items['confidence'])
-				temp_timestamp = float(items['timestamp'])
-				if (confidence > con_level and key in items):
-					gp = items[key]
-					# Check the confidence level then check two gp with timestamp.
-					gp_x, gp_y = map(float, gp[1:-1].split(','))
-					if (0 <= gp_x <= 1 and 0 <= gp_y <= 1):
-						# denormalized the x and y position with pixel
-						# values in the reference surface
-						temp_x = gp_x * x_pixel
-						temp_y = (1 - gp_y) * y_pixel
-
-						# debugging aid
-						print 'x: {}, y: {}, timestamp: {}'.format(x, y, timestamp)
-						print 'temp_x: {}, temp_y: {}, temp_timestamp: {}'.format(temp_x, temp_y, temp_timestamp)
-						# debugging aid
-						if x == -1.0 or y == -1.0:
-							# case: get new x and y
-							x = temp_x
-							y = temp_y
-							timestamp = temp_timestamp
-						else:
-							# computation on checking the difference and timestamp
-							x_diff = abs(x - temp_x)
-							y_diff = abs(y - temp_y)
-							distance = math.sqrt((x_diff ** 2) + (y_diff ** 2))
-							if distance < radius:
-								# case: new gaze location is within range of
-								# standard point of gaze_location
-								if (temp_timestamp - timestamp) > duration:
-									# need to change to write to bash file
-									result =  cmd_out.format(x, y)
-									# debugging aid
-									print result
-									adb.shell_command(result)
-									x = -1.0
-									y = -1.0
-									timestamp = -1.0
-							else:
-								# case: new gaze locataion is outside range
-								# replace the standard point to new gaze_location
-								x = temp_x
-								y = temp_y
-								timestamp = temp_timestamp
-				else:
-					# case: confidence less than lowest confident level
-					pass
-			except KeyError:
-				print error_message
-				break
-		else:
-			# pass on other messages not related to gaze position
-			pass
+		try:
+			# messages not related to gaze position decode to None
+			gaze = tapper.decoder.decode(msg)
+			if gaze is not None:
+				tapper.add(gaze)
+		except KeyError:
+			print error_message
+			break
+
+def tap_loop(socket, tapper, conflate = False, loop = None):
+	'''
+		Feed the gaze messages of socket to tapper from a
+		control_loop.ControlLoop, a new one when loop is
+		None, until the loop is stopped.
+	'''
+	if loop is None:
+		loop = control_loop.ControlLoop()
+	control_loop.PupilIntake(loop, socket, tapper.decoder, tapper.add, conflate)
+	loop.run()
 
 if __name__ == "__main__":
-	main()
+	# pyadb is only needed to talk to the device
+	from pyadb import ADB
+	adb = ADB()
+	# --fixation taps dwells found by the I-DT fixation filter
+	# instead of the dwell check
+	main(fixation = '--fixation' in argv)
 	signal.signal(signal.SIGINT, signal_handler)
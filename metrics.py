@@ -0,0 +1,76 @@
+'''
+	Small helpers for collecting runtime metrics in the drivers.
+'''
+
+import math
+import threading
+
+
+class LatencyStats(object):
+	'''
+		Running count, mean, minimum, maximum and histogram of
+		latencies given in seconds. Histogram bucket 0 counts values
+		below 1 ms, bucket i values below 2**i ms and the last bucket
+		everything larger. Safe to update from several threads.
+	'''
+	def __init__(self, name, buckets = 14):
+		self.name = name
+		self.buckets = buckets
+		self._lock = threading.Lock()
+		self.reset()
+
+	def reset(self):
+		with self._lock:
+			self.count = 0
+			self.total = 0.0
+			self.min = None
+			self.max = None
+			self.histogram = [0] * (self.buckets + 1)
+
+	def add(self, seconds):
+		ms = seconds * 1000.
+		if ms < 1:
+			bucket = 0
+		else:
+			bucket = min(int(math.log(ms, 2)) + 1, self.buckets)
+		with self._lock:
+			self.count += 1
+			self.total += seconds
+			if self.min is None or seconds < self.min:
+				self.min = seconds
+			if self.max is None or seconds > self.max:
+				self.max = seconds
+			self.histogram[bucket] += 1
+
+	def mean(self):
+		if self.count == 0:
+			return None
+		return self.total / self.count
+
+	def percentile(self, q):
+		'''
+			Upper bound in seconds of the histogram bucket holding
+			the q-th percentile (0 < q <= 100), None for the last,
+			unbounded bucket or when nothing was recorded.
+		'''
+		if self.count == 0:
+			return None
+		needed = self.count * q / 100.
+		seen = 0
+		for bucket, n in enumerate(self.histogram):
+			seen += n
+			if seen >= needed:
+				break
+		if bucket == self.buckets:
+			return None
+		return 2 ** bucket / 1000.
+
+	def __str__(self):
+		if self.count == 0:
+			return '%s: no samples' % self.name
+		p50 = self.percentile(50)
+		p99 = self.percentile(99)
+		return '%s: n=%d mean=%.1fms min=%.1fms max=%.1fms p50<%s p99<%s' % (
+			self.name, self.count, 1000 * self.mean(), 1000 * self.min, 1000 * self.max,
+			'%gms' % (1000 * p50) if p50 is not None else 'inf',
+			'%gms' % (1000 * p99) if p99 is not None else 'inf')
@@ -13,17 +13,42 @@
 import zmq
 import math
 import signal
+import logging
 import sphero_driver
+import pupil_stream
+import control_loop
+import gaze_filter
+import calibration
 import time
-import matplotlib.pyplot as plt
-import numpy as np
-from sys import stdin, exit
+from sys import stdin, exit, argv
 
+# the Sphero being steered, constructed in __main__ before connecting
+sphero = None
 
-sphero = sphero_driver.Sphero();
+# maximum number of roll commands sent per second
+COMMAND_RATE = 20
+
+# Pupil Server message topics the driver subscribes to
+TOPICS = ('Pupil',)
+
+# cells per axis of the HeadingTable, 0 steers with det_angle_xy
+HEADING_GRID = 256
+
+# One Euro filter of --smooth, cutoff in Hz while the pupil rests
+# and its increase per normalized unit per second of pupil speed
+SMOOTH_MIN_CUTOFF = 1.
+SMOOTH_BETA = 2.
+
+# pupil positions kept for --calibration-dump
+CALIBRATION_KEEP = 2000
 
 def signal_handler(signal, frame):
 	print 'Exiting the program right now'
+	if sphero.scheduler is not None:
+		print sphero.scheduler
+	if sphero.send_queue is not None:
+		print sphero.send_queue
+	print '%s, reconnects: %d, dropped while reconnecting: %d' % (sphero.connect_time, sphero.reconnects, sphero.dropped_while_down)
 	sphero.set_back_led(0, False)
 	sphero.disconnect();
 	exit(0)
@@ -36,12 +61,23 @@ def det_angle(confidence, norm_pos, con_level, data_range):
         it is considered as 0 degree. The minimum is 0
         degree. The maximum is 359 degree.
 	'''
+	if confidence > con_level:
+		norm_x, norm_y = map(float, norm_pos[1:-1].split(','))
+		return det_angle_xy(confidence, norm_x, norm_y, con_level, data_range)
+	else:
+		# confidence is too small to make a decision
+		return None;
+
+def det_angle_xy(confidence, norm_x, norm_y, con_level, data_range):
+	'''
+		Same as det_angle, but takes the pupil position
+		as already parsed floats.
+	'''
 	middle_x = data_range[0]
 	middle_y = data_range[1]
 	inner_radius = data_range[2]
 	if confidence > con_level:
 		# case: confidence is large enough for consideration
-		norm_x, norm_y = map(float, norm_pos[1:-1].split(','))
 		# flip the x axis
 		norm_x = 1 - norm_x
 		diff_x = norm_x - middle_x
@@ -69,6 +105,94 @@ def det_angle(confidence, norm_pos, con_level, data_range):
 		# confidence is too small to make a decision
 		return None;
 
+def squared(values):
+	'''
+		values ** 2 computed with pow like Python floats do,
+		numpy squares arrays with a multiplication which can
+		differ in the last bit.
+	'''
+	import numpy as np
+	return np.power(values, np.full_like(values, 2.0))
+
+def det_angle_array(confidence, norm_x, norm_y, con_level, data_range):
+	'''
+		Vectorized det_angle_xy for arrays of pupil positions.
+		Returns an array of headings with NaN where no decision
+		is made, i.e. where det_angle_xy returns None. The
+		headings are bit for bit the ones of det_angle_xy.
+	'''
+	import numpy as np
+	middle_x = data_range[0]
+	middle_y = data_range[1]
+	inner_radius = data_range[2]
+	confidence = np.asarray(confidence, dtype = float)
+	# flip the x axis
+	diff_x = (1 - np.asarray(norm_x, dtype = float)) - middle_x
+	diff_y = np.asarray(norm_y, dtype = float) - middle_y
+	hypotenuse = np.sqrt(squared(diff_x) + squared(diff_y))
+	decided = (confidence > con_level) & (hypotenuse >= inner_radius)
+	with np.errstate(divide = 'ignore', invalid = 'ignore'):
+		# arcsin as in det_angle_xy, arctan2 would differ in the last bits
+		degrees = np.degrees(np.arcsin(diff_y / hypotenuse))
+	# quadrants tested in the order of det_angle_xy
+	second = (diff_x <= 0) & (diff_y >= 0)
+	third = (diff_x < 0) & (diff_y <= 0) & ~second
+	# first and fourth quadrant share the formula
+	angle = np.where(second, 270 + degrees, np.where(third, 180 - degrees, 90 - degrees))
+	return np.where(decided, angle, np.nan)
+
+class HeadingTable(object):
+	'''
+		Integer headings of det_angle_xy precomputed on a grid
+		over normalized pupil space, so steering looks up a
+		cell instead of doing the trigonometry per sample. The
+		heading of a cell is the one of its center, None in the
+		dead zone. Positions outside [0, 1] use the border cells.
+	'''
+	def __init__(self, data_range, con_level, resolution = HEADING_GRID):
+		# numpy is only needed once calibration is done, importing
+		# it here keeps it out of the driver startup
+		import numpy as np
+		self.con_level = con_level
+		self.resolution = resolution
+		centers = (np.arange(resolution) + 0.5) / resolution
+		norm_x, norm_y = np.meshgrid(centers, centers)
+		angles = det_angle_array(np.ones_like(norm_x), norm_x, norm_y, 0, data_range)
+		# round half up like round does for the positive headings
+		headings = np.floor(angles + 0.5)
+		# flat list indexed by row * resolution + column
+		self.cells = [None if np.isnan(h) else int(h) for h in headings.ravel()]
+
+	def heading(self, confidence, norm_x, norm_y):
+		'''
+			Heading for a pupil position, None when no
+			decision is made.
+		'''
+		if confidence <= self.con_level:
+			return None
+		resolution = self.resolution
+		column = int(norm_x * resolution)
+		row = int(norm_y * resolution)
+		if column < 0:
+			column = 0
+		elif column >= resolution:
+			column = resolution - 1
+		if row < 0:
+			row = 0
+		elif row >= resolution:
+			row = resolution - 1
+		return self.cells[row * resolution + column]
+
+def det_heading(confidence, norm_x, norm_y, con_level, data_range):
+	'''
+		Integer heading of det_angle_xy, None when no
+		decision is made.
+	'''
+	angle = det_angle_xy(confidence, norm_x, norm_y, con_level, data_range)
+	if angle == None:
+		return None
+	return int(round(angle))
+
 def make_calibration(socket, con_level, data_range):
 	'''
 		Calibrate Sphero at the beginning of
@@ -77,28 +201,24 @@ def make_calibration(socket, con_level, data_range):
 	'''
 	calibrated = False
 	msg_count = 0
+	decoder = pupil_stream.PupilDecoder('Pupil')
 	sphero.set_back_led(255, False)
 	while calibrated != True:
 		msg = socket.recv()
-		items = msg.split("\n")
-		msg_type = items.pop(0)
-		items = dict([ i.split(':', 1) for i in items[: -1] ])
-		# check the message type, if the message is from
-		# pupil infomation
-		if msg_type == 'Pupil':
-			print msg_count
-			try:
-				# extract confidence level of pupil position
-				confidence = float(items['confidence'])
-				norm_pos = items['norm_pos']
-				pupil_angle = det_angle(confidence, norm_pos, con_level, data_range)
-				print " pupil_angle = {}, confidence = {} ".format(pupil_angle, confidence)
+		try:
+			# extract confidence level and position of pupil,
+			# other message types decode to None
+			pupil = decoder.decode(msg)
+			if pupil is not None:
+				print msg_count
+				pupil_angle = det_angle_xy(pupil.confidence, pupil.norm_x, pupil.norm_y, con_level, data_range)
+				print " pupil_angle = {}, confidence = {} ".format(pupil_angle, pupil.confidence)
 				if pupil_angle == None:
 					msg_count += 1;
 				else:
 					msg_count = 0
-			except KeyError:
-				pass
+		except KeyError:
+			pass
 		# check the msg_count
 		if msg_count == 0:
 			sphero.roll(0, 6, 1, False)
@@ -111,65 +231,87 @@ def make_calibration(socket, con_level, data_range):
 	sphero.set_back_led(0, False)
 	sphero.set_rgb_led(0, 0, 255, 0, False)
 
-def collect_data(socket, con_level):
-	# Helper function for collecting data of pupil
-	# positions in different regions
-	ret = []
-	count = 0
-	while count < 200:
-		msg = socket.recv()
-		items = msg.split('\n')
-		msg_type = items.pop(0)
-		items = dict([ i.split(':', 1) for i in items[: -1] ])
-		# check the message type
-		if msg_type == 'Pupil':
-			try:
-				# check confident level of pupil position
-				confidence = float(items['confidence'])
-				norm_pos = items['norm_pos']
-				if confidence > con_level:
-					norm_x, norm_y = map(float, norm_pos[1:-1].split(','))
-					norm_x = 1 - norm_x
-					data_pt = norm_x, norm_y
-					ret.append(data_pt)
-					count += 1
-			except KeyError:
-				pass
-	return ret
-
-
-def space_calibration(socket, con_level):
+def space_calibration(socket, con_level, dump = None):
 	'''
 	Let the user to look at top left, top right, bottom left, and bottom right
 	four extreme points. Through these four points to decide the observation
-	region
+	region. Samples are fed to a calibration.SpaceCalibrator until its extents
+	settle, with dump the positions are saved there for calibration.plot.
 	'''
-	inter_socket = socket
 	print "Please look at four extreme region(top_left, top_right, bottom_left"
 	print "and bottom_right) with your pupil."
 	print "Beging collecting data......."
-	pt_cloud = collect_data(inter_socket, con_level)
-	print "Finished data collecting"
-	# convert data into np array
-	data_pt_cloud = np.array(pt_cloud)
-	# convert to X and Y
-	X = data_pt_cloud[:,0]
-	Y = data_pt_cloud[:,1]
-	plt.scatter(X, Y)
-	plt.show()
-	# get the min and max for X and Y
-	x_min = np.amin(X)
-	x_max = np.amax(X)
-	y_min = np.amin(Y)
-	y_max = np.amax(Y)
-	middle_x = (x_min + x_max) / 2.
-	middle_y = (y_min + y_max) / 2.
-	x_range = abs(x_min - x_max)
-	y_range = abs(y_min - y_max)
-	t_range = min(x_range, y_range)
-	return middle_x, middle_y, (t_range/4.)
-
-def main():
+	calibrator = calibration.SpaceCalibrator(con_level, keep = CALIBRATION_KEEP if dump else 0)
+	decoder = pupil_stream.PupilDecoder('Pupil')
+	done = False
+	while not done:
+		msg = socket.recv()
+		try:
+			pupil = decoder.decode(msg)
+			if pupil is not None:
+				done = calibrator.add(pupil.confidence, pupil.norm_x, pupil.norm_y)
+		except KeyError:
+			pass
+	print "Finished data collecting after %d samples" % calibrator.count
+	if dump:
+		calibrator.dump(dump)
+	return calibrator.data_range()
+
+def steer_loop(socket, con_level, data_range, speed, conflate = False, table = None, smoother = None, loop = None):
+	'''
+		Single threaded version of the steering loop of main.
+		Pupil intake, sphero input and a command tick running at
+		COMMAND_RATE share one control_loop.ControlLoop, the tick
+		only sends a roll command when the heading changed.
+		Headings come from table when given, positions are
+		smoothed by smoother when given. Runs on loop, a new
+		ControlLoop when None, until the loop is stopped.
+	'''
+	if loop is None:
+		loop = control_loop.ControlLoop()
+	latency = pupil_stream.GazeLatency()
+	decoder = pupil_stream.PupilDecoder('Pupil', (pupil_stream.CONFIDENCE, pupil_stream.TIMESTAMP, pupil_stream.NORM_POS))
+	# latest command, last sent command and timestamp of its sample
+	state = {'command': None, 'sent': None, 'timestamp': None}
+
+	def on_pupil(pupil):
+		latency.received(pupil.timestamp)
+		norm_x, norm_y = pupil.norm_x, pupil.norm_y
+		if smoother is not None and pupil.confidence > con_level:
+			norm_x, norm_y = smoother.filter(pupil.timestamp, norm_x, norm_y)
+		if table is not None:
+			heading = table.heading(pupil.confidence, norm_x, norm_y)
+		else:
+			heading = det_heading(pupil.confidence, norm_x, norm_y, con_level, data_range)
+		if heading == None:
+			state['command'] = speed, 0, 0
+		else:
+			state['command'] = speed, heading, 1
+		state['timestamp'] = pupil.timestamp
+
+	def tick():
+		if state['command'] is not None and state['command'] != state['sent']:
+			roll_speed, heading, roll_state = state['command']
+			sphero.roll(roll_speed, heading, roll_state, False)
+			state['sent'] = state['command']
+			latency.sent(state['timestamp'])
+
+	control_loop.PupilIntake(loop, socket, decoder, on_pupil, conflate)
+	control_loop.attach_sphero(loop, sphero)
+	loop.call_every(1. / COMMAND_RATE, tick)
+	loop.run()
+
+def main(topics = TOPICS, conflate = False, single_loop = False, grid = HEADING_GRID, smoother = None, calibration_dump = None):
+	'''
+		Steer sphero with the pupil position. With conflate
+		the driver always steers on the newest sample and skips
+		samples queued up while a command was being sent. With
+		single_loop steering runs in steer_loop. Headings are
+		looked up in a HeadingTable with grid cells per axis,
+		or computed per sample when grid is 0. A smoother from
+		gaze_filter filters confident positions before steering.
+		The space calibration is saved to calibration_dump.
+	'''
 
 	# lowest acceptant level
 	con_level = 0.65
@@ -182,48 +324,72 @@ def main():
 	ip_addr = raw_input("Enter the ip address for Pupil Server: ")
 	# whole ip address
 	socket.connect('%s:%s' % (ip_addr, port))
-	# filter message by stating string "String", '' receives all messages
-	socket.setsockopt(zmq.SUBSCRIBE, '')
+	# only receive the message topics used by the driver
+	pupil_stream.subscribe(socket, topics)
 
 	# find the middle point and get the range
-	middle_x, middle_y, inner_radius = space_calibration(socket, con_level)
+	middle_x, middle_y, inner_radius = space_calibration(socket, con_level, calibration_dump)
 	print middle_x, middle_y, inner_radius
 	data_range = [middle_x, middle_y, inner_radius]
 	# Beging calibration process
 	make_calibration(socket, con_level, data_range)
 	# set up speed
 	speed = 100
+	# data_range is fixed from here on
+	table = HeadingTable(data_range, con_level, grid) if grid else None
+	if single_loop:
+		steer_loop(socket, con_level, data_range, speed, conflate, table, smoother)
+		return
 
+	decoder = pupil_stream.PupilDecoder('Pupil', (pupil_stream.CONFIDENCE, pupil_stream.TIMESTAMP, pupil_stream.NORM_POS))
+	latency = pupil_stream.GazeLatency()
 	# accepting connection from pupil head set
 	while True:
-		msg = socket.recv()
-
-		items = msg.split("\n")
-		msg_type = items.pop(0)
-		items = dict([ i.split(':', 1) for i in items[: -1] ])
-		# check the message type, if the message is from 
-		# Gaze type
-		if msg_type == 'Pupil':
-			try:
-				# extract confidence level of pupil position
-				confidence = float(items['confidence'])
-				# norm_pos is a attribute in the dictionary as string
-				norm_pos = items['norm_pos']
-				heading = det_angle(confidence, norm_pos, con_level, data_range)
+		skipped = 0
+		if conflate:
+			msg, skipped = pupil_stream.recv_latest(socket, 'Pupil')
+		else:
+			msg = socket.recv()
+		try:
+			# extract confidence level and position of pupil,
+			# messages not related to pupil position decode to None
+			pupil = decoder.decode(msg)
+			if pupil is not None:
+				latency.received(pupil.timestamp, skipped)
+				norm_x, norm_y = pupil.norm_x, pupil.norm_y
+				if smoother is not None and pupil.confidence > con_level:
+					norm_x, norm_y = smoother.filter(pupil.timestamp, norm_x, norm_y)
+				if table is not None:
+					heading = table.heading(pupil.confidence, norm_x, norm_y)
+				else:
+					heading = det_heading(pupil.confidence, norm_x, norm_y, con_level, data_range)
 				if heading == None:
 					sphero.roll(speed, 0, 0, False);
 				else:
-					sphero.roll(speed, int(round(heading)), 1, False);
-			except KeyError:
-				pass
-		else:
-			# pass on other messages not related to pupil position
+					sphero.roll(speed, heading, 1, False);
+				latency.sent(pupil.timestamp)
+		except KeyError:
 			pass
 
 if __name__ == "__main__":
 	# general set-up of sphero
+	sphero = sphero_driver.Sphero()
 	# set up sphero connection
-	sphero.connect();
+	try:
+		sphero.connect();
+	except sphero_driver.ConnectError as error:
+		print "Could not connect to Sphero: %s" % error
+		exit(1)
+	# reopen the link when it drops instead of ending the run
+	sphero.enable_reconnect()
+	# run everything from one thread with --loop
+	single_loop = '--loop' in argv
+	if not single_loop:
+		# drop repeated roll commands and limit the command rate
+		sphero.enable_scheduler(COMMAND_RATE)
+		# write commands from a separate thread so steering never
+		# waits for the bluetooth link
+		sphero.enable_send_queue()
 	# abstract from mannually set up sphero
 	sphero.set_raw_data_strm(40, 1, 0, False)
 	# time slepp
@@ -238,4 +404,18 @@ if __name__ == "__main__":
 	sphero.set_rgb_led(0,0,0,0,False)
 	sphero.set_stablization(1, False)
 	signal.signal(signal.SIGINT, signal_handler)
-	main()
+	logging.basicConfig(level = logging.INFO)
+	# --grid=N sets the heading table resolution, 0 disables it
+	# --calibration-dump=PATH saves the space calibration for
+	# python calibration.py PATH
+	grid = HEADING_GRID
+	calibration_dump = None
+	for arg in argv:
+		if arg.startswith('--grid='):
+			grid = int(arg[len('--grid='):])
+		elif arg.startswith('--calibration-dump='):
+			calibration_dump = arg[len('--calibration-dump='):]
+	# --smooth steers on One Euro filtered pupil positions
+	smoother = gaze_filter.OneEuroSmoother(SMOOTH_MIN_CUTOFF, SMOOTH_BETA) if '--smooth' in argv else None
+	main(conflate = '--conflate' in argv, single_loop = single_loop, grid = grid, smoother = smoother,
+		calibration_dump = calibration_dump)
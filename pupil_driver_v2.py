@@ -9,16 +9,44 @@
 import zmq
 import math
 import sphero_driver
-import numpy as np
+import pupil_stream
+import control_loop
+import gaze_filter
 import signal
+import logging
 import time
-import matplotlib.pyplot as plt
-from sys import stdin, exit
+from sys import stdin, exit, argv
 
-sphero = sphero_driver.Sphero()
+# the Sphero drawing the paths, constructed in __main__ before connecting
+sphero = None
+
+# maximum number of roll commands sent per second
+COMMAND_RATE = 20
+
+# Pupil Server message topics the driver subscribes to,
+# pupil positions for calibration and gaze for drawing paths
+TOPICS = ('Pupil', 'Gaze')
+
+# speed of the path macros, at which sphero travels
+# around 66 cm per second
+ROLL_SPEED = 50
+CM_PER_SECOND = 66.
+
+# with --macro, gaze drawn paths are collected into a PathMacro
+path_macro = None
+
+# One Euro filter of --smooth, cutoff in Hz while the gaze rests
+# and its increase per normalized unit per second of gaze speed
+SMOOTH_MIN_CUTOFF = 1.
+SMOOTH_BETA = 2.
 
 def signal_handler(signal, frame):
 	print 'Exiting the program right now'
+	if sphero.scheduler is not None:
+		print sphero.scheduler
+	if sphero.send_queue is not None:
+		print sphero.send_queue
+	print '%s, reconnects: %d, dropped while reconnecting: %d' % (sphero.connect_time, sphero.reconnects, sphero.dropped_while_down)
 	sphero.set_back_led(0, False)
 	sphero.disconnect();
 	exit(0)
@@ -44,6 +72,98 @@ def det_angle(start_point, end_point):
 		else:
 			return 180 - tmp_angle
 
+def det_angle_array(start_points, end_points):
+	'''
+	Vectorized det_angle for arrays of point pairs, given as
+	(n, 2) arrays. Returns an array of angles, bit for bit the
+	ones of det_angle, with NaN where start and end point are
+	the same
+	'''
+	# imported here so the driver starts up without numpy
+	import numpy as np
+	start_points = np.asarray(start_points, dtype = float)
+	end_points = np.asarray(end_points, dtype = float)
+	x_diff = end_points[..., 0] - start_points[..., 0]
+	y_diff = end_points[..., 1] - start_points[..., 1]
+	# square through pow like det_angle does on floats, numpy
+	# multiplies for ** 2 which may round the other way
+	two = np.full_like(x_diff, 2.0)
+	hypotenuse = np.sqrt(np.power(x_diff, two) + np.power(y_diff, two))
+	with np.errstate(divide = 'ignore', invalid = 'ignore'):
+		tmp_angle = np.degrees(np.arcsin(x_diff / hypotenuse))
+	return np.where(tmp_angle >= 0,
+		np.where(y_diff >= 0, tmp_angle, 180 - tmp_angle),
+		np.where(y_diff > 0, 359 + tmp_angle, 180 - tmp_angle))
+
+def path_segment(start_point, end_point):
+	'''
+	Heading, length in pixels and travel distance in cm
+	of the path segment between two gaze points
+	'''
+	angle = det_angle(start_point, end_point)
+	x_diff = abs(start_point[0] - end_point[0])
+	y_diff = abs(start_point[1] - end_point[1])
+	x_diff *= 1920
+	y_diff *= 1080
+	travel_pixel = math.sqrt(math.pow(x_diff, 2) + math.pow(y_diff, 2))
+	# set 1 pixel in screen is equal to 2 cm in real world
+	travel_distance = travel_pixel * 2.
+	return angle, travel_pixel, travel_distance
+
+class PathMacro(object):
+	'''
+		Collects the segments of a gaze drawn path into one
+		temporary macro, which sphero runs on its own once
+		the gaze rests, instead of receiving a roll command
+		per step.
+	'''
+	# roll with its delay, and the final stop
+	SEGMENT_SIZE = 5 + 3
+	STOP_SIZE = 5
+
+	def __init__(self, sphero, speed = ROLL_SPEED):
+		self.sphero = sphero
+		self.speed = speed
+		self.macros = 0
+		self.reset()
+
+	def reset(self):
+		self.macro = sphero_driver.MacroBuilder()
+		self.heading = 0
+		self.segments = 0
+
+	def add(self, angle, travel_distance):
+		'''
+			Append a segment, running the path so far first
+			when the macro is full.
+		'''
+		ms = int(1000 * travel_distance / CM_PER_SECOND)
+		# a delay step is at most 65535 ms
+		delays = max(1, int(math.ceil(ms / 65535.)))
+		size = 5 + 3 * delays + self.STOP_SIZE
+		if size > self.macro.space():
+			self.run()
+		self.heading = int(angle) % 360
+		self.macro.roll(self.speed, self.heading)
+		for i in range(delays):
+			self.macro.delay(min(ms, 65535))
+			ms -= 65535
+		self.segments += 1
+
+	def run(self):
+		'''
+			Upload the path as the temporary macro and run it.
+		'''
+		if self.segments == 0:
+			return
+		self.macro.roll(0, self.heading)
+		# a new path replaces the one still running
+		self.sphero.abort_macro(False)
+		self.sphero.save_temp_macro(self.macro, False)
+		self.sphero.run_macro(sphero_driver.TEMP_MACRO_ID, False)
+		self.macros += 1
+		self.reset()
+
 def process_data(*args):
 	start_point = args[0]
 	start_point_ts = args[1]
@@ -52,14 +172,14 @@ def process_data(*args):
 	if end_point_ts - start_point_ts < 0.2:
 		return start_point, start_point_ts
 	else:
-		angle = det_angle(start_point, end_point)
-		x_diff = abs(start_point[0] - end_point[0])
-		y_diff = abs(start_point[1] - end_point[1])
-		x_diff *= 1920
-		y_diff *= 1080
-		travel_pixel = math.sqrt(math.pow(x_diff, 2) + math.pow(y_diff, 2))
-		# set 1 pixel in screen is equal to 2 cm in real world
-		travel_distance = travel_pixel * 2.
+		angle, travel_pixel, travel_distance = path_segment(start_point, end_point)
+		if path_macro is not None:
+			if travel_pixel > 6:
+				path_macro.add(angle, travel_distance)
+			else:
+				# the gaze rests, drive the path drawn so far
+				path_macro.run()
+			return end_point, end_point_ts
 		# with speed = 50, sphero travel distance is around 66 cm
 		count = math.ceil(travel_distance / 66)
 		i = 0
@@ -68,43 +188,84 @@ def process_data(*args):
 			i += 1
 		return end_point, end_point_ts
 
-def receive_pupil_data(socket, con_level):
+def receive_pupil_data(socket, con_level, conflate = False, smoother = None):
+	'''
+		Draw paths with the gaze position. With conflate only
+		the newest gaze sample is used, stale samples queued up
+		while commands were being sent are skipped. A smoother
+		from gaze_filter filters the gaze positions first.
+	'''
 	# set one pixel values equals to 2 cm in real world
 	pixel =  2.
 	# set an start point and its timestamp
 	start_point = None
 	start_point_ts = None
+	decoder = pupil_stream.PupilDecoder('Gaze', (pupil_stream.CONFIDENCE, pupil_stream.TIMESTAMP, pupil_stream.NORM_POS))
+	latency = pupil_stream.GazeLatency()
 	# accepting connection from pupil head set
 	while True:
-		msg = socket.recv()
-		items = msg.split('\n')
-		msg_type = items.pop(0)
-		items = dict([ i.split(':', 1) for i in items[: -1] ])
-		# check of Gaze type message
-		if msg_type == 'Gaze':
-			try:
-				confidence = float(items['confidence'])
-				
-				if confidence > con_level:
-					timestamp = float(items['timestamp'])
-					# norm_pos is a attribute in the dictionary as string
-					norm_pos = items['norm_pos']
-					norm_x, norm_y = map(float, norm_pos[1:-1].split(','))
-					if start_point == None:
-						start_point = norm_x,norm_y
-						start_point_ts = timestamp 
-					else:
-						# case it isn't a start point
-						# there is an end point for this path
-						end_point = norm_x, norm_y
-						args = [start_point, start_point_ts, end_point, timestamp]
-						start_point, start_point_ts = process_data(*args)
-			except KeyError:
-				pass
+		skipped = 0
+		if conflate:
+			msg, skipped = pupil_stream.recv_latest(socket, 'Gaze')
 		else:
-			# pass on other messages not related to pupil position
+			msg = socket.recv()
+		try:
+			# messages not related to gaze position decode to None
+			gaze = decoder.decode(msg)
+			if gaze is not None and gaze.confidence > con_level:
+				timestamp = gaze.timestamp
+				latency.received(timestamp, skipped)
+				norm_x, norm_y = gaze.norm_x, gaze.norm_y
+				if smoother is not None:
+					norm_x, norm_y = smoother.filter(timestamp, norm_x, norm_y)
+				if start_point == None:
+					start_point = norm_x,norm_y
+					start_point_ts = timestamp 
+				else:
+					# case it isn't a start point
+					# there is an end point for this path
+					end_point = norm_x, norm_y
+					args = [start_point, start_point_ts, end_point, timestamp]
+					start_point, start_point_ts = process_data(*args)
+					if start_point_ts == timestamp:
+						# the path segment ending here was processed
+						latency.sent(timestamp)
+		except KeyError:
 			pass
 
+def draw_loop(socket, con_level, conflate = False, smoother = None, loop = None):
+	'''
+		Single threaded version of receive_pupil_data. Gaze
+		intake and sphero input share one control_loop.ControlLoop,
+		loop or a new one when None, run until it is stopped.
+	'''
+	if loop is None:
+		loop = control_loop.ControlLoop()
+	latency = pupil_stream.GazeLatency()
+	decoder = pupil_stream.PupilDecoder('Gaze', (pupil_stream.CONFIDENCE, pupil_stream.TIMESTAMP, pupil_stream.NORM_POS))
+	# start point of the current path segment and its timestamp
+	path = {'point': None, 'timestamp': None}
+
+	def on_gaze(gaze):
+		if gaze.confidence <= con_level:
+			return
+		latency.received(gaze.timestamp)
+		point = gaze.norm_x, gaze.norm_y
+		if smoother is not None:
+			point = smoother.filter(gaze.timestamp, *point)
+		if path['point'] == None:
+			path['point'], path['timestamp'] = point, gaze.timestamp
+		else:
+			args = [path['point'], path['timestamp'], point, gaze.timestamp]
+			path['point'], path['timestamp'] = process_data(*args)
+			if path['timestamp'] == gaze.timestamp:
+				# the path segment ending here was processed
+				latency.sent(gaze.timestamp)
+
+	control_loop.PupilIntake(loop, socket, decoder, on_gaze, conflate)
+	control_loop.attach_sphero(loop, sphero)
+	loop.run()
+
 def make_calibration(socket):
 	'''
 		Calibrate Sphero at the beginning of
@@ -113,25 +274,22 @@ def make_calibration(socket):
 	'''
 	calibrated = False
 	msg_count = 0
+	decoder = pupil_stream.PupilDecoder('Pupil', (pupil_stream.NORM_POS,))
 	sphero.set_back_led(255, False)
 	while calibrated != True:
 		msg = socket.recv()
-		items = msg.split("\n")
-		msg_type = items.pop(0)
-		items = dict([ i.split(':', 1) for i in items[: -1] ])
-		# check the message type, if the message is from
-		# pupil infomation
-		print items
-		if msg_type == 'Pupil':
-			try:
-				norm_pos = items['norm_pos']
-				norm_x, norm_y = map(float, norm_pos[1:-1].split(','))
-				if norm_x == 0 and norm_y == 0:
+		print msg
+		try:
+			# check the message type, if the message is from
+			# pupil infomation
+			pupil = decoder.decode(msg)
+			if pupil is not None:
+				if pupil.norm_x == 0 and pupil.norm_y == 0:
 					msg_count += 1;
 				else:
 					msg_count = 0
-			except KeyError:
-				pass
+		except KeyError:
+			pass
 		# check the msg_count
 		if msg_count == 0:
 			sphero.roll(0, 6, 1, False)
@@ -143,7 +301,7 @@ def make_calibration(socket):
 			pass
 
 
-def main():
+def main(topics = TOPICS, conflate = False, single_loop = False, smoother = None):
 
 	# network setup connection with pupil eye tracker
 	port = raw_input('Please enter port number: ')
@@ -153,17 +311,35 @@ def main():
 	ip_addr = raw_input("Enter the ip address for Pupil Server: ")
 	# whole ip address
 	socket.connect('%s:%s' % (ip_addr, port))
-	# filter message by stating string "String", '' receives all messages
-	socket.setsockopt(zmq.SUBSCRIBE, '')
+	# only receive the message topics used by the driver
+	pupil_stream.subscribe(socket, topics)
 	make_calibration(socket)
 	# set lowest acceptence level to be 65% 
-	receive_pupil_data(socket, con_level = 0.65)
+	if single_loop:
+		draw_loop(socket, con_level = 0.65, conflate = conflate, smoother = smoother)
+	else:
+		receive_pupil_data(socket, con_level = 0.65, conflate = conflate, smoother = smoother)
 
 
 if __name__ == "__main__":
 	# general set-up of sphero
+	sphero = sphero_driver.Sphero()
 	# set up sphero connection
-	sphero.connect();
+	try:
+		sphero.connect();
+	except sphero_driver.ConnectError as error:
+		print "Could not connect to Sphero: %s" % error
+		exit(1)
+	# reopen the link when it drops instead of ending the run
+	sphero.enable_reconnect()
+	# run everything from one thread with --loop
+	single_loop = '--loop' in argv
+	if not single_loop:
+		# drop repeated roll commands and limit the command rate
+		sphero.enable_scheduler(COMMAND_RATE)
+		# write commands from a separate thread so steering never
+		# waits for the bluetooth link
+		sphero.enable_send_queue()
 	# abstract from mannually set up sphero
 	sphero.set_raw_data_strm(40, 1, 0, False)
 	# time slepp
@@ -177,6 +353,12 @@ if __name__ == "__main__":
 	time.sleep(1)
 	sphero.set_rgb_led(0,0,0,0,False)
 	sphero.set_stablization(1, False)
+	# upload whole gaze drawn paths as macros with --macro
+	if '--macro' in argv:
+		path_macro = PathMacro(sphero)
 	signal.signal(signal.SIGINT, signal_handler)
-	main()
+	logging.basicConfig(level = logging.INFO)
+	# --smooth draws paths with One Euro filtered gaze positions
+	smoother = gaze_filter.OneEuroSmoother(SMOOTH_MIN_CUTOFF, SMOOTH_BETA) if '--smooth' in argv else None
+	main(conflate = '--conflate' in argv, single_loop = single_loop, smoother = smoother)
 
@@ -0,0 +1,212 @@
+'''
+	Shared helpers for reading messages broadcast by the Pupil Server.
+
+	Every datum of the Pupil Server is sent as one ZeroMQ frame of
+	the form
+
+		Pupil\nnorm_pos:(0.5, 0.5)\nconfidence:0.9\n...
+
+	where the first line is the message topic and each following line
+	is a key:value pair. The drivers only look at a few of these keys,
+	so instead of splitting every message into a dictionary the
+	PupilDecoder searches the received buffer for the requested keys
+	and parses their values straight into a record that is reused for
+	every message.
+
+	Drivers subscribe only to the topics they use, so messages of
+	other topics are filtered by ZeroMQ and never reach Python.
+	In conflate mode a driver reads with recv_latest, which skips
+	every queued sample but the newest one.
+'''
+
+import time
+import logging
+import zmq
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# field names understood by PupilDecoder
+CONFIDENCE = 'confidence'
+TIMESTAMP = 'timestamp'
+NORM_POS = 'norm_pos'
+
+
+class PupilRecord(object):
+	'''
+		Parsed fields of the last decoded message. Position fields
+		are stored as separate floats so nothing is allocated per
+		message, surface positions are kept as (x, y) tuples keyed
+		by the surface key (None when missing from the message).
+	'''
+	__slots__ = ('topic', 'confidence', 'timestamp', 'norm_x', 'norm_y', 'surfaces')
+
+	def __init__(self, topic):
+		self.topic = topic
+		self.confidence = 0.0
+		self.timestamp = 0.0
+		self.norm_x = 0.0
+		self.norm_y = 0.0
+		self.surfaces = {}
+
+
+class PupilDecoder(object):
+	'''
+		Decode only the requested fields of messages of one topic.
+
+		fields are the required keys (CONFIDENCE, TIMESTAMP and/or
+		NORM_POS). A message missing one of them raises KeyError,
+		just like the dictionary lookups it replaces. surfaces are
+		optional position keys such as 'realtime gaze on nexus'.
+	'''
+	def __init__(self, topic, fields = (CONFIDENCE, NORM_POS), surfaces = ()):
+		for name in fields:
+			if name not in (CONFIDENCE, TIMESTAMP, NORM_POS):
+				raise ValueError('Unknown Pupil field: %s' % name)
+		self.topic = topic
+		self.fields = tuple(fields)
+		self.record = PupilRecord(topic)
+		self._prefix = topic + '\n'
+		# searching starts at the newline ending the topic line
+		self._start = len(topic)
+		self._keys = [('\n%s:' % name, name) for name in self.fields]
+		self._surface_keys = [('\n%s:' % name, name) for name in surfaces]
+		for name in surfaces:
+			self.record.surfaces[name] = None
+
+	def _find(self, msg, key):
+		# return the bounds of the value belonging to key
+		start = msg.find(key, self._start)
+		if start < 0:
+			return -1, -1
+		start += len(key)
+		end = msg.find('\n', start)
+		if end < 0:
+			end = len(msg)
+		return start, end
+
+	def decode(self, msg):
+		'''
+			Parse msg into self.record and return it. Messages of
+			other topics are skipped by returning None.
+		'''
+		if not msg.startswith(self._prefix):
+			return None
+		record = self.record
+		find = msg.find
+		for key, name in self._keys:
+			start = find(key, self._start)
+			if start < 0:
+				raise KeyError(name)
+			start += len(key)
+			end = find('\n', start)
+			if end < 0:
+				end = len(msg)
+			if name == NORM_POS:
+				# value looks like "(x, y)"
+				comma = find(',', start, end)
+				record.norm_x = float(msg[start + 1:comma])
+				record.norm_y = float(msg[comma + 1:end - 1])
+			elif name == CONFIDENCE:
+				record.confidence = float(msg[start:end])
+			else:
+				record.timestamp = float(msg[start:end])
+		for key, name in self._surface_keys:
+			start, end = self._find(msg, key)
+			if start < 0:
+				record.surfaces[name] = None
+			else:
+				comma = msg.find(',', start, end)
+				record.surfaces[name] = float(msg[start + 1:comma]), float(msg[comma + 1:end - 1])
+		return record
+
+
+def subscribe(socket, topics):
+	'''
+		Subscribe a SUB socket to the given message topics. A topic
+		is matched against the whole first line of the message, so
+		subscribing to 'Pupil' does not receive e.g. 'Pupil_blink'.
+		An empty list of topics subscribes to every message.
+	'''
+	if not topics:
+		socket.setsockopt(zmq.SUBSCRIBE, '')
+	for topic in topics:
+		socket.setsockopt(zmq.SUBSCRIBE, topic + '\n')
+
+
+def recv_latest(socket, topic = None):
+	'''
+		Wait for a message, then drain everything already queued on
+		the socket and return the newest message of the given topic
+		(of any topic when None) together with the number of older
+		messages of that topic which were skipped. Draining keeps
+		working with several topic subscriptions, unlike ZMQ_CONFLATE
+		which would keep one message for all topics together.
+	'''
+	prefix = topic + '\n' if topic else ''
+	latest = None
+	skipped = 0
+	msg = socket.recv()
+	while True:
+		if msg.startswith(prefix):
+			if latest is not None:
+				skipped += 1
+			latest = msg
+		try:
+			msg = socket.recv(zmq.NOBLOCK)
+		except zmq.Again:
+			if latest is not None:
+				return latest, skipped
+			msg = socket.recv()
+
+
+class GazeLatency(object):
+	'''
+		End-to-end latency between the Pupil timestamp of a sample
+		and the moment the command computed from it was sent.
+
+		Pupil timestamps use the clock of the Pupil Server. Unless
+		clock_offset (host time minus Pupil time) is given, it is
+		estimated as the smallest difference seen at receive time,
+		so the reported values are latencies above the best case.
+		A summary is logged every report_interval seconds.
+	'''
+	def __init__(self, name = 'gaze latency', clock_offset = None, report_interval = 5.0):
+		self.stats = metrics.LatencyStats(name)
+		self.clock_offset = clock_offset
+		self.fixed_offset = clock_offset is not None
+		self.report_interval = report_interval
+		self.skipped = 0
+		self._last_report = time.time()
+
+	def received(self, pupil_ts, skipped = 0):
+		# call as soon as a sample arrives
+		self.skipped += skipped
+		if not self.fixed_offset:
+			offset = time.time() - pupil_ts
+			if self.clock_offset is None or offset < self.clock_offset:
+				self.clock_offset = offset
+
+	def sent(self, pupil_ts):
+		# call right after the command computed from the sample was sent
+		now = time.time()
+		if self.clock_offset is None:
+			self.clock_offset = now - pupil_ts
+		self.stats.add(now - pupil_ts - self.clock_offset)
+		if now - self._last_report >= self.report_interval:
+			self._last_report = now
+			logger.info('%s, skipped stale samples: %d' % (self.stats, self.skipped))
+			self.stats.reset()
+			self.skipped = 0
+
+
+def parse_message(msg):
+	'''
+		Reference parser splitting the whole message into a dictionary.
+		This is how the drivers used to read every message, it is kept
+		for debugging and for comparing against PupilDecoder.
+	'''
+	items = msg.split('\n')
+	msg_type = items.pop(0)
+	items = dict([ i.split(':', 1) for i in items[: -1] ])
+	return msg_type, items
@@ -0,0 +1,72 @@
+#!/usr/bin/python
+import time
+import unittest
+import zmq
+import pupil_stream
+
+PUPIL_MSG = 'Pupil\nnorm_pos:(0.412, 0.587)\ndiameter:54.2\nconfidence:0.91\ntimestamp:1534.207\nid:0\n'
+GAZE_MSG = 'Gaze\nnorm_pos:(0.3, 0.6)\nconfidence:0.8\ntimestamp:1534.210\nrealtime gaze on nexus:(0.25, 0.75)\n'
+
+class TestPupilDecoder(unittest.TestCase):
+	'''
+		Compare the decoder against the reference
+		dictionary parser.
+	'''
+	def test_pupil_fields(self):
+		decoder = pupil_stream.PupilDecoder('Pupil', (pupil_stream.CONFIDENCE, pupil_stream.TIMESTAMP, pupil_stream.NORM_POS))
+		record = decoder.decode(PUPIL_MSG)
+		msg_type, items = pupil_stream.parse_message(PUPIL_MSG)
+		norm_x, norm_y = map(float, items['norm_pos'][1:-1].split(','))
+		self.assertEqual(record.topic, msg_type)
+		self.assertEqual(record.confidence, float(items['confidence']))
+		self.assertEqual(record.timestamp, float(items['timestamp']))
+		self.assertEqual((record.norm_x, record.norm_y), (norm_x, norm_y))
+
+	def test_record_is_reused(self):
+		decoder = pupil_stream.PupilDecoder('Pupil')
+		first = decoder.decode(PUPIL_MSG)
+		second = decoder.decode(PUPIL_MSG.replace('0.91', '0.5'))
+		self.assertTrue(first is second)
+		self.assertEqual(second.confidence, 0.5)
+
+	def test_other_topic(self):
+		decoder = pupil_stream.PupilDecoder('Pupil')
+		self.assertEqual(decoder.decode(GAZE_MSG), None)
+
+	def test_missing_field(self):
+		decoder = pupil_stream.PupilDecoder('Pupil', (pupil_stream.CONFIDENCE,))
+		self.assertRaises(KeyError, decoder.decode, 'Pupil\nnorm_pos:(0.1, 0.2)\n')
+
+	def test_surface(self):
+		key = 'realtime gaze on nexus'
+		decoder = pupil_stream.PupilDecoder('Gaze', (pupil_stream.CONFIDENCE,), surfaces = (key,))
+		self.assertEqual(decoder.decode(GAZE_MSG).surfaces[key], (0.25, 0.75))
+		record = decoder.decode('Gaze\nconfidence:0.8\n')
+		self.assertEqual(record.surfaces[key], None)
+
+
+class TestRecvLatest(unittest.TestCase):
+	'''
+		Draining the socket queue keeps only
+		the newest message of the topic.
+	'''
+	def setUp(self):
+		self.context = zmq.Context()
+		self.pull = self.context.socket(zmq.PULL)
+		self.pull.bind('inproc://recv_latest')
+		self.push = self.context.socket(zmq.PUSH)
+		self.push.connect('inproc://recv_latest')
+
+	def tearDown(self):
+		self.push.close()
+		self.pull.close()
+		self.context.term()
+
+	def test_newest_of_topic(self):
+		for i in range(5):
+			self.push.send('Pupil\nid:%d\n' % i)
+		self.push.send('Gaze\nid:9\n')
+		time.sleep(0.1)
+		msg, skipped = pupil_stream.recv_latest(self.pull, 'Pupil')
+		self.assertEqual(msg, 'Pupil\nid:4\n')
+		self.assertEqual(skipped, 4)
@@ -1,5 +1,6 @@
 #!/usr/bin/python
 import unittest
+import numpy as np
 import pupil_driver
 import pdb
 
@@ -60,4 +61,59 @@ class TestDetAngle(unittest.TestCase):
 		self.assertEqual(pupil_driver.det_angle(0.50, '(0.60, 0.70)', 0.65), None)
 		self.assertEqual(pupil_driver.det_angle(0.60, '(0.4, 0.4)', 0.65), None)
 
+class TestDetAngleArray(unittest.TestCase):
+	'''
+		The vectorized version gives the same angles,
+		bit for bit, with NaN for no decision.
+	'''
+	DATA_RANGE = (0.5, 0.5, 0.1)
+
+	def check(self, confidence, norm_x, norm_y):
+		angles = pupil_driver.det_angle_array(confidence, norm_x, norm_y, 0.65, self.DATA_RANGE)
+		for i in range(len(angles)):
+			expected = pupil_driver.det_angle_xy(confidence[i], norm_x[i], norm_y[i], 0.65, self.DATA_RANGE)
+			if expected is None:
+				self.assertTrue(np.isnan(angles[i]))
+			else:
+				self.assertEqual(angles[i], expected)
+
+	def test_cases(self):
+		# the points of TestDetAngle
+		points = [(0.85, 0.7, 0.6), (0.85, 0.75, 0.5), (0.85, 0.3, 0.65), (0.85, 0.45, 0.9),
+			(0.85, 0.4, 0.4), (0.85, 0.1, 0.1), (0.85, 0.7, 0.49), (0.85, 0.56, 0.1),
+			(1, 0.5, 0.5), (0.80, 0.5, 0.55), (0.50, 0.60, 0.70), (0.60, 0.4, 0.4),
+			# on the axes
+			(0.9, 0.5, 0.9), (0.9, 0.5, 0.1), (0.9, 0.9, 0.5), (0.9, 0.1, 0.5)]
+		self.check(*zip(*points))
+
+	def test_random(self):
+		random = np.random.RandomState(0)
+		self.check(random.uniform(0.5, 1, 20000), random.uniform(0, 1, 20000), random.uniform(0, 1, 20000))
+
+class TestHeadingTable(unittest.TestCase):
+	'''
+		Table lookups agree with the computed
+		headings up to the grid resolution.
+	'''
+	DATA_RANGE = (0.5, 0.5, 0.1)
+
+	def test_agree(self):
+		table = pupil_driver.HeadingTable(self.DATA_RANGE, 0.65, 512)
+		random = np.random.RandomState(1)
+		for norm_x, norm_y in random.uniform(0, 1, (2000, 2)):
+			expected = pupil_driver.det_heading(0.9, norm_x, norm_y, 0.65, self.DATA_RANGE)
+			heading = table.heading(0.9, norm_x, norm_y)
+			if expected is None or heading is None:
+				# only cells on the dead zone border may differ
+				distance = np.hypot(1 - norm_x - 0.5, norm_y - 0.5)
+				self.assertTrue(expected == heading or abs(distance - 0.1) < 2. / 512)
+			else:
+				difference = abs(heading - expected) % 360
+				self.assertTrue(min(difference, 360 - difference) <= 2)
 
+	def test_no_decision(self):
+		table = pupil_driver.HeadingTable(self.DATA_RANGE, 0.65, 64)
+		self.assertEqual(table.heading(0.9, 0.5, 0.5), None)
+		self.assertEqual(table.heading(0.6, 0.9, 0.9), None)
+		# outside the grid
+		self.assertEqual(table.heading(0.9, 1.5, 0.5), pupil_driver.det_heading(0.9, 1 - 0.5 / 64, 0.5 + 0.5 / 64, 0.65, self.DATA_RANGE))
@@ -1,5 +1,7 @@
 #!/usr/bin/python
 import unittest
+import numpy as np
+import sphero_driver
 import pupil_driver_v2
 import pdb
 
@@ -65,4 +67,63 @@ class TestDetAngle(unittest.TestCase):
 		self.assertTrue(res > 270)
 		self.assertTrue(res <= 359)
 
+class TestDetAngleArray(unittest.TestCase):
+	'''
+		The vectorized version gives the same
+		angles as det_angle, bit for bit.
+	'''
+	def check(self, start_points, end_points):
+		angles = pupil_driver_v2.det_angle_array(start_points, end_points)
+		for i in range(len(angles)):
+			self.assertEqual(angles[i], pupil_driver_v2.det_angle(start_points[i], end_points[i]))
+
+	def test_cases(self):
+		# the points of TestDetAngle
+		self.check([[0.2, 0.3], [0.3, 0.4], [0.4, 0.6], [0.4, 0.6], [0.4, 0.6], [0.4, 0.3], [0.6, 0.1], [0.1, 0.6]],
+			[[0.5, 0.5], [0.5, 0.6], [0.6, 0.4], [0.4, 0.5], [0.2, 0.1], [0.1, 0.3], [0.3, 0.4], [0, 0.86]])
+
+	def test_random(self):
+		random = np.random.RandomState(0)
+		self.check(random.uniform(0, 1, (20000, 2)), random.uniform(0, 1, (20000, 2)))
+
+	def test_same_point(self):
+		self.assertTrue(np.isnan(pupil_driver_v2.det_angle_array([[0.5, 0.5]], [[0.5, 0.5]])[0]))
+
+class RecordingSphero(object):
+	def __init__(self):
+		self.calls = []
+
+	def abort_macro(self, response):
+		self.calls.append('abort')
+
+	def save_temp_macro(self, macro, response):
+		self.calls.append(macro.build())
+
+	def run_macro(self, macro_id, response):
+		self.calls.append(macro_id)
+
+class TestPathMacro(unittest.TestCase):
+	'''
+		Path segments are uploaded as one macro
+		ending with a stop.
+	'''
+	def test_run(self):
+		sphero = RecordingSphero()
+		path = pupil_driver_v2.PathMacro(sphero)
+		path.run()
+		self.assertEqual(sphero.calls, [])
+		path.add(90.5, 66.)
+		path.add(180., 33.)
+		path.run()
+		self.assertEqual(sphero.calls, ['abort',
+			[0x05, 50, 0, 90, 0, 0x0b, 3, 232, 0x05, 50, 0, 180, 0, 0x0b, 1, 244, 0x05, 0, 0, 180, 0, 0x00],
+			sphero_driver.TEMP_MACRO_ID])
+		self.assertEqual(path.segments, 0)
 
+	def test_full_macro_runs(self):
+		sphero = RecordingSphero()
+		path = pupil_driver_v2.PathMacro(sphero)
+		for i in range(40):
+			path.add(10, 66.)
+		self.assertEqual(path.macros, 1)
+		self.assertEqual(path.segments, 40 - len(sphero.calls[1]) // 8)
@@ -0,0 +1,229 @@
+"""
+Streaming storage for the Recorder.
+
+Pupil and gaze positions are written while recording into .npy files
+that grow chunk by chunk. Only the chunk being filled is memory mapped,
+so the positions take no more memory the longer the session runs, and
+closing a file only flushes the last chunk and trims the preallocated
+tail.
+
+The .npy header reserves HEADER_SIZE bytes and is rewritten in place
+with the number of rows on disk at every flush, after the rows
+themselves were flushed. A file left behind by a crash therefore loads
+with np.load and holds every row up to the last flush. Flushing, and
+its fsync, happens on a flusher thread of each writer, so appending a
+row never waits for the disk.
+
+The raw events of every frame are appended to an EventLog, a stream of
+pickles, so they are not held in memory while recording either. Player
+reads pupil_data as a single pickled dictionary though, which
+load_events rebuilds from the log once the recording stopped. That step
+holds every event of the session in memory at once and takes time
+linear in the session length, like saving pupil_data did before.
+
+Whatever is left to do once a recording stopped runs on the Finalizer
+thread, so the capture loop goes on at full frame rate meanwhile.
+"""
+
+import os
+import struct
+import threading
+import Queue
+import cPickle as pickle
+import numpy as np
+import logging
+
+logger = logging.getLogger(__name__)
+
+#bytes reserved for the .npy header, enough for any row count
+HEADER_SIZE = 128
+
+#columns of the rows written by the Recorder
+PUPIL_COLUMNS = ('timestamp', 'confidence', 'id', 'norm_x', 'norm_y', 'diameter')
+GAZE_COLUMNS = ('timestamp', 'confidence', 'norm_x', 'norm_y')
+
+
+def npy_header(dtype, shape):
+    """
+    Version 1.0 .npy header of exactly HEADER_SIZE bytes.
+    """
+    header = "{'descr': %r, 'fortran_order': False, 'shape': %r, }" % (np.lib.format.dtype_to_descr(dtype), shape)
+    #magic string and version, header length, padded header ending in a newline
+    header = header.ljust(HEADER_SIZE - 10 - 1) + '\n'
+    return np.lib.format.magic(1, 0) + struct.pack('<H', len(header)) + header
+
+
+class PositionWriter(object):
+    """
+    Append rows of float64 values to a .npy file of shape (count, columns).
+
+    chunk_rows rows are preallocated and mapped at a time, rows reach the
+    disk at least every flush_interval seconds. append is meant for a
+    single thread, flush may be called from any.
+    """
+    def __init__(self, path, columns, chunk_rows=8192, flush_interval=1.):
+        self.path = path
+        self.columns = columns
+        self.chunk_rows = chunk_rows
+        self.flush_interval = flush_interval
+        self.dtype = np.dtype(np.float64)
+        self.row_size = self.dtype.itemsize * columns
+        self.count = 0
+        self._file = open(path, 'w+b')
+        #the header has its own descriptor, so writing it from the flusher
+        #thread does not move the position of _file
+        self._header_fd = os.open(path, os.O_WRONLY)
+        #full chunks not flushed yet
+        self._retired = []
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._write_header(0)
+        self._map_chunk(0)
+        self._closed = threading.Event()
+        self._flusher = threading.Thread(target=self._flush_loop, name='PositionWriter')
+        self._flusher.daemon = True
+        self._flusher.start()
+
+    def _map_chunk(self, start):
+        self._file.truncate(HEADER_SIZE + (start + self.chunk_rows) * self.row_size)
+        self._chunk = np.memmap(self._file, dtype=self.dtype, mode='r+',
+                                offset=HEADER_SIZE + start * self.row_size, shape=(self.chunk_rows, self.columns))
+        #rows are written through a plain view, setting items of a memmap is several times slower
+        self._rows = self._chunk.view(np.ndarray)
+        self._chunk_start = start
+
+    def _write_header(self, count):
+        os.lseek(self._header_fd, 0, os.SEEK_SET)
+        os.write(self._header_fd, npy_header(self.dtype, (count, self.columns)))
+        os.fsync(self._header_fd)
+
+    def append(self, row):
+        index = self.count - self._chunk_start
+        if index == self.chunk_rows:
+            with self._lock:
+                #the full chunk is flushed by the next flush
+                self._retired.append(self._chunk)
+                self._map_chunk(self.count)
+            index = 0
+        self._rows[index] = row
+        self.count += 1
+
+    def _flush_loop(self):
+        while not self._closed.wait(self.flush_interval):
+            self.flush()
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                #rows below count are in these chunks
+                chunks = self._retired + [self._chunk]
+                self._retired = []
+                count = self.count
+            #rows first, so the header never counts rows not on disk
+            for chunk in chunks:
+                chunk.flush()
+            self._write_header(count)
+
+    def close(self):
+        if self._file is None:
+            return
+        self._closed.set()
+        self._flusher.join()
+        self.flush()
+        self._chunk = None
+        self._rows = None
+        self._file.truncate(HEADER_SIZE + self.count * self.row_size)
+        self._file.close()
+        os.close(self._header_fd)
+        self._file = None
+
+
+class EventLog(object):
+    """
+    Append the events of every frame to a stream of pickles.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.count = 0
+        self._file = open(path, 'wb')
+
+    def append(self, events):
+        pickle.dump(events, self._file, pickle.HIGHEST_PROTOCOL)
+        self.count += 1
+
+    def flush(self):
+        self._file.flush()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def load_events(path, keys=('pupil_positions', 'gaze_positions')):
+    """
+    Rebuild the pupil_data dictionary from an EventLog, each key holding
+    the list of its events of all frames. The whole dictionary is in
+    memory once this returns. A record cut short by a crash ends the log.
+    """
+    data = dict((key, []) for key in keys)
+    with open(path, 'rb') as f:
+        while True:
+            try:
+                events = pickle.load(f)
+            except (EOFError, pickle.UnpicklingError, ValueError, IndexError, KeyError):
+                break
+            for key in keys:
+                data[key] += events.get(key, [])
+    return data
+
+
+class Finalizer(object):
+    """
+    Run the steps finishing stopped recordings one after the other on a
+    background thread.
+
+    A recording is submitted as a list of (description, callable) steps.
+    A failing step is logged and the remaining ones still run. status
+    tells what is being done, for the user interface, and is empty once
+    every submitted recording is finished.
+    """
+    def __init__(self):
+        self.status = ''
+        self.pending = 0
+        self.finished = 0
+        self._jobs = Queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def submit(self, name, steps):
+        with self._lock:
+            self.pending += 1
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='Finalizer')
+                self._thread.daemon = True
+                self._thread.start()
+        self._jobs.put((name, steps))
+
+    def wait(self):
+        """
+        Block until every submitted recording is finished.
+        """
+        self._jobs.join()
+
+    def _run(self):
+        while True:
+            name, steps = self._jobs.get()
+            for i, (description, step) in enumerate(steps):
+                self.status = 'saving %s: %s (%d/%d)' % (name, description, i + 1, len(steps))
+                try:
+                    step()
+                except Exception:
+                    logger.exception("Could not %s. Please report this bug!" % description)
+            with self._lock:
+                self.pending -= 1
+                self.finished += 1
+                if self.pending == 0:
+                    self.status = ''
+            logger.info("Finished saving recording %s" % name)
+            self._jobs.task_done()
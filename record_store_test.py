@@ -0,0 +1,129 @@
+#!/usr/bin/python
+import os
+import time
+import shutil
+import logging
+import tempfile
+import threading
+import unittest
+import numpy as np
+import record_store
+
+class TestPositionWriter(unittest.TestCase):
+	'''
+		Rows written across chunks load back with
+		np.load, also while the file is still open.
+	'''
+	def setUp(self):
+		self.directory = tempfile.mkdtemp()
+		self.path = os.path.join(self.directory, 'pupil_positions.npy')
+		self.rows = np.random.RandomState(0).uniform(size = (1000, 6))
+
+	def tearDown(self):
+		shutil.rmtree(self.directory)
+
+	def write(self, rows, **kwargs):
+		writer = record_store.PositionWriter(self.path, 6, chunk_rows = 64, **kwargs)
+		for row in rows:
+			writer.append(tuple(row))
+		return writer
+
+	def test_round_trip(self):
+		self.write(self.rows).close()
+		self.assertTrue(np.array_equal(np.load(self.path), self.rows))
+		self.assertEqual(os.path.getsize(self.path), record_store.HEADER_SIZE + self.rows.nbytes)
+
+	def test_empty(self):
+		self.write([]).close()
+		self.assertEqual(np.load(self.path).shape, (0, 6))
+
+	def test_flushed_rows_survive(self):
+		writer = self.write(self.rows[:300], flush_interval = 1000.)
+		writer.flush()
+		for row in self.rows[300:350]:
+			writer.append(tuple(row))
+		# not closed, as if recording crashed
+		self.assertTrue(np.array_equal(np.load(self.path), self.rows[:300]))
+		self.assertTrue(np.array_equal(np.load(self.path, mmap_mode = 'r'), self.rows[:300]))
+		writer.close()
+
+	def test_background_flush(self):
+		writer = self.write(self.rows[:300], flush_interval = 0.01)
+		end = time.time() + 2
+		while len(np.load(self.path)) < 300 and time.time() < end:
+			time.sleep(0.01)
+		# flushed by the flusher thread, not by append
+		self.assertTrue(np.array_equal(np.load(self.path), self.rows[:300]))
+		writer.close()
+
+	def test_header_size(self):
+		header = record_store.npy_header(np.dtype(np.float64), (10 ** 12, 6))
+		self.assertEqual(len(header), record_store.HEADER_SIZE)
+
+class TestEventLog(unittest.TestCase):
+	'''
+		The pupil_data dictionary is rebuilt from
+		the logged events.
+	'''
+	def setUp(self):
+		self.directory = tempfile.mkdtemp()
+		self.path = os.path.join(self.directory, 'pupil_data.events')
+
+	def tearDown(self):
+		shutil.rmtree(self.directory)
+
+	def test_load(self):
+		log = record_store.EventLog(self.path)
+		for i in range(3):
+			log.append({'pupil_positions': [{'timestamp': i}], 'gaze_positions': [{'timestamp': i}] * 2})
+		log.close()
+		data = record_store.load_events(self.path)
+		self.assertEqual(data['pupil_positions'], [{'timestamp': i} for i in range(3)])
+		self.assertEqual(len(data['gaze_positions']), 6)
+
+	def test_cut_short(self):
+		log = record_store.EventLog(self.path)
+		for i in range(3):
+			log.append({'pupil_positions': [{'timestamp': i}]})
+		log.close()
+		with open(self.path, 'r+b') as f:
+			f.truncate(os.path.getsize(self.path) - 3)
+		self.assertEqual(len(record_store.load_events(self.path)['pupil_positions']), 2)
+
+class TestFinalizer(unittest.TestCase):
+	'''
+		Steps run in order off the calling thread,
+		a failing step does not stop the others.
+	'''
+	def test_background(self):
+		finalizer = record_store.Finalizer()
+		release = threading.Event()
+		done = []
+		finalizer.submit('000', [('wait', release.wait), ('first', lambda: done.append(1))])
+		finalizer.submit('001', [('second', lambda: done.append(2))])
+		# submit returned while the first step is still waiting
+		self.assertEqual(done, [])
+		self.assertEqual(finalizer.pending, 2)
+		end = time.time() + 1
+		while not finalizer.status and time.time() < end:
+			time.sleep(0.01)
+		self.assertEqual(finalizer.status, 'saving 000: wait (1/2)')
+		release.set()
+		finalizer.wait()
+		self.assertEqual(done, [1, 2])
+		self.assertEqual(finalizer.status, '')
+		self.assertEqual(finalizer.finished, 2)
+
+	def test_failing_step(self):
+		finalizer = record_store.Finalizer()
+		done = []
+		logging.disable(logging.ERROR)
+		try:
+			finalizer.submit('000', [('fail', lambda: 1 / 0), ('go on', lambda: done.append(1))])
+			finalizer.wait()
+		finally:
+			logging.disable(logging.NOTSET)
+		self.assertEqual(done, [1])
+
+if __name__ == '__main__':
+	unittest.main()
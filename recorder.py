@@ -13,13 +13,14 @@ import getpass
 import cv2
 from pyglui import ui
 import numpy as np
-from scipy.interpolate import UnivariateSpline
 from plugin import Plugin
 from time import strftime,localtime,time,gmtime
 from shutil import copy2
 from glob import glob
 from audio import Audio_Capture,Audio_Input_Dict
 from file_methods import save_object
+from timestamps import TimestampMonitor
+from record_store import PositionWriter, EventLog, Finalizer, load_events, PUPIL_COLUMNS, GAZE_COLUMNS
 from av_writer import JPEG_Writer
 from cv2_writer import CV_Writer
 # koosha
@@ -36,53 +37,6 @@ import subprocess as sp
 def get_auto_name():
     return strftime("%Y_%m_%d", localtime())
 
-def sanitize_timestamps(ts):
-    logger.debug("Checking %s timestamps for monotony in direction and smoothness"%ts.shape[0])
-    avg_frame_time = (ts[-1] - ts[0])/ts.shape[0]
-    logger.debug('average_frame_time: %s'%(1./avg_frame_time))
-
-    raw_ts = ts #only needed for visualization
-    runs = 0
-    while True:
-        #forward check for non monotonic increasing behaviour
-        clean = np.ones((ts.shape[0]),dtype=np.bool)
-        damper  = 0
-        for idx in range(ts.shape[0]-1):
-            if ts[idx] >= ts[idx+1]: #not monotonically increasing timestamp
-                damper = 50
-            clean[idx] = damper <= 0
-            damper -=1
-
-        #backward check to smooth timejumps forward
-        damper  = 0
-        for idx in range(ts.shape[0]-1)[::-1]:
-            if ts[idx+1]-ts[idx]>1: #more than one second forward jump
-                damper = 50
-            clean[idx] &= damper <= 0
-            damper -=1
-
-        if clean.all() == True:
-            if runs >0:
-                logger.debug("Timestamps were bad but are ok now. Correction runs: %s"%runs)
-                # from matplotlib import pyplot as plt
-                # plt.plot(frames,raw_ts)
-                # plt.plot(frames,ts)
-                # # plt.scatter(frames[~clean],ts[~clean])
-                # plt.show()
-            else:
-                logger.debug("Timestamps are clean.")
-            return ts
-
-        runs +=1
-        if runs > 4:
-            logger.error("Timestamps could not be fixed!")
-            return ts
-
-        logger.warning("Timestamps are not sane. We detected non monotitc or jumpy timestamps. Fixing them now")
-        frames = np.arange(len(ts))
-        s = UnivariateSpline(frames[clean],ts[clean],s=0)
-        ts = s(frames)
-
 
 class Recorder(Plugin):
     """Capture Recorder"""
@@ -147,6 +101,8 @@ class Recorder(Plugin):
         self.info_menu = None
         self.info_menu_conf = info_menu_conf
         self.height, self.width = self.g_pool.capture.frame_size
+        # saves stopped recordings while the next one may already run
+        self.finalizer = Finalizer()
 
 
     def get_init_dict(self):
@@ -207,10 +163,8 @@ class Recorder(Plugin):
 
     def start(self):
         self.timestamps = []
-        # add self.data
-        self.data = {'pupil_positions':[], 'gaze_positions': []}
-        self.pupil_list = []
-        self.gaze_list = []
+        # bad world timestamps are flagged as they come in
+        self.timestamp_monitor = TimestampMonitor()
         self.frame_count = 0
         self.running = True
         self.menu.read_only = True
@@ -244,6 +198,10 @@ class Recorder(Plugin):
             f.write("Start Date\t"+ strftime("%d.%m.%Y", localtime(self.start_time))+ "\n")
             f.write("Start Time\t"+ strftime("%H:%M:%S", localtime(self.start_time))+ "\n")
 
+        # pupil and gaze data go to disk as they arrive instead of piling up in memory
+        self.event_log = EventLog(os.path.join(self.rec_path, "pupil_data.events"))
+        self.pupil_writer = PositionWriter(os.path.join(self.rec_path, "pupil_positions.npy"), len(PUPIL_COLUMNS))
+        self.gaze_writer = PositionWriter(os.path.join(self.rec_path, "gaze_positions.npy"), len(GAZE_COLUMNS))
 
         if self.audio_src != 'No Audio':
             audio_path = os.path.join(self.rec_path, "world.wav")
@@ -303,8 +261,7 @@ class Recorder(Plugin):
     def update(self,frame,events):
         if self.running:
             # update data
-            self.data['pupil_positions'] += events['pupil_positions']
-            self.data['gaze_positions'] += events['gaze_positions']
+            self.event_log.append({'pupil_positions': events['pupil_positions'], 'gaze_positions': events['gaze_positions']})
 
             #cv2.putText(frame.img, "Frame %s"%self.frame_count,(200,200), cv2.FONT_HERSHEY_SIMPLEX,1,(255,100,100)
             cv2.putText(frame.img, self.this_state,(200,100), cv2.FONT_HERSHEY_SIMPLEX,1,(255,100,100))
@@ -314,7 +271,7 @@ class Recorder(Plugin):
             for p in events['pupil_positions']:
                 pupil_pos = p['timestamp'],p['confidence'],p['id'],p['norm_pos'][0],p['norm_pos'][1],p['diameter']
 
-                self.pupil_list.append(pupil_pos)
+                self.pupil_writer.append(pupil_pos)
 
             c = 0
             avg_x = -1
@@ -324,9 +281,10 @@ class Recorder(Plugin):
                 avg_x = (avg_x * c + g['norm_pos'][0]) / (c+1)
                 avg_y = (avg_y * c + g['norm_pos'][0]) / (c+1)
                 c = c + 1
-                self.gaze_list.append(gaze_pos)
+                self.gaze_writer.append(gaze_pos)
                 
             self.timestamps.append(frame.timestamp)
+            self.timestamp_monitor.add(frame.timestamp)
 
             avg_col = 0    
 
@@ -336,12 +294,13 @@ class Recorder(Plugin):
             self.frame_count += 1
 
             self.button.status_text = self.get_rec_time_str()
+            if self.timestamp_monitor.glitches:
+                self.button.status_text += ' (%s timestamp glitches)' % self.timestamp_monitor.glitches
+        elif self.button:
+            # progress of saving the last recordings, empty when done
+            self.button.status_text = self.finalizer.status
 
     def stop(self):
-        #explicit release of VideoWriter
-        self.writer.release()
-        self.writer = None
-
         if self.record_eye:
             for tx in self.g_pool.eye_tx:
                 try:
@@ -349,69 +308,108 @@ class Recorder(Plugin):
                 except:
                     logger.warning("Could not stop eye-recording. Please report this bug!")
 
-        save_object(self.data, os.path.join(self.rec_path, "pupil_data"))
-        
-        gaze_list_path = os.path.join(self.rec_path, "gaze_positions.npy")
-        np.save(gaze_list_path,np.asarray(self.gaze_list))
-
-        pupil_list_path = os.path.join(self.rec_path, "pupil_positions.npy")
-        np.save(pupil_list_path,np.asarray(self.pupil_list))
-
-        timestamps_path = os.path.join(self.rec_path, "world_timestamps.npy")
-        ts = sanitize_timestamps(np.array(self.timestamps))
-        np.save(timestamps_path,ts)
-
-        try:
-            copy2(os.path.join(self.g_pool.user_dir,"surface_definitions"),os.path.join(self.rec_path,"surface_definitions"))
-        except:
-            logger.info("No surface_definitions data found. You may want this if you do marker tracking.")
-
-        try:
-            copy2(os.path.join(self.g_pool.user_dir,"cal_pt_cloud.npy"),os.path.join(self.rec_path,"cal_pt_cloud.npy"))
-        except:
-            logger.warning("No calibration data found. Please calibrate first.")
+        # everything else is saved by the finalizer thread, it only gets
+        # the values it needs so recording can start again right away
+        rec_path = self.rec_path
+        user_dir = self.g_pool.user_dir
+        writer = self.writer
+        self.writer = None
+        event_log = self.event_log
+        event_log_path = event_log.path
+        position_writers = self.pupil_writer, self.gaze_writer
+        timestamps = self.timestamps
+        timestamp_monitor = self.timestamp_monitor
+        meta_info_path = self.meta_info_path
+        rec_time_str = self.get_rec_time_str()
+        binocular = self.g_pool.binocular
+        frame_count = self.frame_count
+        width, height = self.width, self.height
+        capture_version = self.g_pool.version
+        user_info = dict(self.user_info)
+
+        def close_position_files():
+            # positions are on disk already, closing flushes the last
+            # rows and trims the files
+            for position_writer in position_writers:
+                position_writer.close()
+            event_log.close()
+
+        def release_writer():
+            #explicit release of VideoWriter
+            writer.release()
+
+        def save_pupil_data():
+            # pupil_data for Player is rebuilt from the event log, the
+            # one step whose memory and time grow with the session
+            save_object(load_events(event_log_path), os.path.join(rec_path, "pupil_data"))
+            os.remove(event_log_path)
+
+        def save_timestamps():
+            timestamps_path = os.path.join(rec_path, "world_timestamps.npy")
+            # only the windows flagged while recording are refitted
+            ts = timestamp_monitor.repair(np.array(timestamps))
+            np.save(timestamps_path,ts)
+
+        def copy_user_files():
+            try:
+                copy2(os.path.join(user_dir,"surface_definitions"),os.path.join(rec_path,"surface_definitions"))
+            except:
+                logger.info("No surface_definitions data found. You may want this if you do marker tracking.")
 
-        try:
-            copy2(os.path.join(self.g_pool.user_dir,"camera_matrix.npy"),os.path.join(self.rec_path,"camera_matrix.npy"))
-            copy2(os.path.join(self.g_pool.user_dir,"dist_coefs.npy"),os.path.join(self.rec_path,"dist_coefs.npy"))
-        except:
-            logger.info("No camera intrinsics found.")
+            try:
+                copy2(os.path.join(user_dir,"cal_pt_cloud.npy"),os.path.join(rec_path,"cal_pt_cloud.npy"))
+            except:
+                logger.warning("No calibration data found. Please calibrate first.")
 
-        try:
-            with open(self.meta_info_path, 'a') as f:
-                f.write("Duration Time\t"+ self.get_rec_time_str()+ "\n")
-                if self.g_pool.binocular:
-                    f.write("Eye Mode\tbinocular\n")
-                else:
-                    f.write("Eye Mode\tmonocular\n")
-                f.write("Duration Time\t"+ self.get_rec_time_str()+ "\n")
-                f.write("World Camera Frames\t"+ str(self.frame_count)+ "\n")
-                f.write("World Camera Resolution\t"+ str(self.width)+"x"+str(self.height)+"\n")
-                f.write("Capture Software Version\t%s\n"%self.g_pool.version)
-                if platform.system() == "Windows":
-                    username = os.environ["USERNAME"]
-                    sysname, nodename, release, version, machine, _ = platform.uname()
-                else:
-                    username = os.getlogin()
-                    try:
-                        sysname, nodename, release, version, machine = os.uname()
-                    except:
-                        sysname, nodename, release, version, machine = sys.platform,None,None,None,None
-                f.write("User\t"+username+"\n")
-                f.write("Platform\t"+sysname+"\n")
-                f.write("Machine\t"+nodename+"\n")
-                f.write("Release\t"+release+"\n")
-                f.write("Version\t"+version+"\n")
-        except Exception:
-            logger.exception("Could not save metadata. Please report this bug!")
+            try:
+                copy2(os.path.join(user_dir,"camera_matrix.npy"),os.path.join(rec_path,"camera_matrix.npy"))
+                copy2(os.path.join(user_dir,"dist_coefs.npy"),os.path.join(rec_path,"dist_coefs.npy"))
+            except:
+                logger.info("No camera intrinsics found.")
 
-        try:
-            with open(os.path.join(self.rec_path, "user_info.csv"), 'w') as f:
-                for name,val in self.user_info.iteritems():
-                    f.write("%s\t%s\n"%(name,val))
-        except Exception:
-            logger.exception("Could not save userdata. Please report this bug!")
+        def save_meta_info():
+            try:
+                with open(meta_info_path, 'a') as f:
+                    f.write("Duration Time\t"+ rec_time_str+ "\n")
+                    if binocular:
+                        f.write("Eye Mode\tbinocular\n")
+                    else:
+                        f.write("Eye Mode\tmonocular\n")
+                    f.write("Duration Time\t"+ rec_time_str+ "\n")
+                    f.write("World Camera Frames\t"+ str(frame_count)+ "\n")
+                    f.write("World Camera Resolution\t"+ str(width)+"x"+str(height)+"\n")
+                    f.write("Capture Software Version\t%s\n"%capture_version)
+                    if platform.system() == "Windows":
+                        username = os.environ["USERNAME"]
+                        sysname, nodename, release, version, machine, _ = platform.uname()
+                    else:
+                        username = os.getlogin()
+                        try:
+                            sysname, nodename, release, version, machine = os.uname()
+                        except:
+                            sysname, nodename, release, version, machine = sys.platform,None,None,None,None
+                    f.write("User\t"+username+"\n")
+                    f.write("Platform\t"+sysname+"\n")
+                    f.write("Machine\t"+nodename+"\n")
+                    f.write("Release\t"+release+"\n")
+                    f.write("Version\t"+version+"\n")
+            except Exception:
+                logger.exception("Could not save metadata. Please report this bug!")
 
+            try:
+                with open(os.path.join(rec_path, "user_info.csv"), 'w') as f:
+                    for name,val in user_info.iteritems():
+                        f.write("%s\t%s\n"%(name,val))
+            except Exception:
+                logger.exception("Could not save userdata. Please report this bug!")
+
+        name = os.path.relpath(rec_path, self.rec_dir)
+        self.finalizer.submit(name, [('close the position files', close_position_files),
+                                     ('release the world video', release_writer),
+                                     ('save pupil data', save_pupil_data),
+                                     ('save world timestamps', save_timestamps),
+                                     ('copy calibration files', copy_user_files),
+                                     ('save meta info', save_meta_info)])
 
         self.close_info_menu()
 
@@ -430,6 +428,8 @@ class Recorder(Plugin):
         """
         if self.running:
             self.stop()
+        # do not leave a recording half saved
+        self.finalizer.wait()
         self.deinit_gui()
 
     def verify_path(self, val):
@@ -0,0 +1,155 @@
+'''
+	Replay a recording of the Pupil Capture recorder to the drivers.
+
+	Recorder.stop saves one row per datum in pupil_positions.npy
+
+		timestamp, confidence, id, norm_x, norm_y, diameter
+
+	and in gaze_positions.npy
+
+		timestamp, confidence, norm_x, norm_y
+
+	Replay turns the rows back into Pupil Server messages and
+	publishes them on a ZeroMQ PUB socket, paced by their timestamps
+	in real time, scaled by a speed factor or as fast as possible,
+	so pupil_driver, pupil_driver_v2 and get_gaze_location run
+	against a recording as they would against the headset.
+
+		python replay.py RECORDING [--speed=N] [--address=tcp://127.0.0.1:5000]
+			[--surface=NAME]
+
+	--speed=0 replays as fast as possible. Recordings hold no surface
+	positions, with --surface gaze messages carry their norm_pos as the
+	position on the named surface, e.g. 'realtime gaze on nexus'
+	for get_gaze_location.
+'''
+
+import os
+import sys
+import time
+import zmq
+import metrics
+
+PUPIL_FILE = 'pupil_positions.npy'
+GAZE_FILE = 'gaze_positions.npy'
+
+# address the drivers connect to by default
+ADDRESS = 'tcp://127.0.0.1:5000'
+
+
+def pupil_message(timestamp, confidence, eye_id, norm_x, norm_y, diameter):
+	# floats are written with repr so they decode to the recorded values
+	return 'Pupil\nnorm_pos:(%r, %r)\ndiameter:%r\nconfidence:%r\ntimestamp:%r\nid:%d\n' % (
+		norm_x, norm_y, diameter, confidence, timestamp, eye_id)
+
+def gaze_message(timestamp, confidence, norm_x, norm_y, surfaces = ()):
+	msg = 'Gaze\nnorm_pos:(%r, %r)\nconfidence:%r\ntimestamp:%r\n' % (norm_x, norm_y, confidence, timestamp)
+	for name in surfaces:
+		msg += '%s:(%r, %r)\n' % (name, norm_x, norm_y)
+	return msg
+
+
+def load(directory, topics = ('Pupil', 'Gaze'), surfaces = ()):
+	'''
+		Messages of a recording directory as a list of
+		(timestamp, message) ordered by timestamp. Files of
+		topics not asked for or missing are skipped.
+	'''
+	import numpy as np
+	messages = []
+	if 'Pupil' in topics and os.path.exists(os.path.join(directory, PUPIL_FILE)):
+		for row in np.load(os.path.join(directory, PUPIL_FILE)).tolist():
+			messages.append((row[0], pupil_message(*row)))
+	if 'Gaze' in topics and os.path.exists(os.path.join(directory, GAZE_FILE)):
+		for row in np.load(os.path.join(directory, GAZE_FILE)).tolist():
+			messages.append((row[0], gaze_message(*row, surfaces = surfaces)))
+	# sorting is stable, pupil and gaze of one timestamp keep their order
+	messages.sort(key = lambda message: message[0])
+	return messages
+
+
+def bind(address = ADDRESS, context = None):
+	'''
+		PUB socket for publish, queueing without limit so
+		nothing is dropped when replaying faster than a
+		subscriber reads.
+	'''
+	context = context or zmq.Context.instance()
+	socket = context.socket(zmq.PUB)
+	socket.setsockopt(zmq.SNDHWM, 0)
+	socket.bind(address)
+	return socket
+
+
+class Replay(object):
+	'''
+		Publish recorded messages with the timing of the
+		recording, speed times faster, or as fast as possible
+		when speed is 0. How late messages went out is
+		collected in self.lag.
+	'''
+	def __init__(self, messages, speed = 1.):
+		self.messages = messages
+		self.speed = speed
+		self.sent = 0
+		self.elapsed = None
+		self.lag = metrics.LatencyStats('replay lag')
+		self._stopped = False
+
+	def stop(self):
+		# may be called from another thread
+		self._stopped = True
+
+	def publish(self, socket):
+		if not self.messages:
+			return
+		speed = self.speed
+		first = self.messages[0][0]
+		start = time.time()
+		for timestamp, msg in self.messages:
+			if self._stopped:
+				break
+			if speed:
+				delay = start + (timestamp - first) / speed - time.time()
+				if delay > 0:
+					time.sleep(delay)
+					self.lag.add(0.)
+				else:
+					self.lag.add(-delay)
+			socket.send(msg)
+			self.sent += 1
+		self.elapsed = time.time() - start
+
+	def __str__(self):
+		if self.elapsed is None:
+			return 'replay: %d of %d messages sent' % (self.sent, len(self.messages))
+		duration = self.messages[self.sent - 1][0] - self.messages[0][0] if self.sent else 0.
+		return 'replay: %d messages in %.2fs, %.0f messages/s, %.1fx real time, %s' % (
+			self.sent, self.elapsed, self.sent / self.elapsed if self.elapsed else 0.,
+			duration / self.elapsed if self.elapsed else 0., self.lag)
+
+def parse_args(args):
+	'''
+		Recording directory, speed, address and surfaces
+		from the command line arguments after the program name.
+	'''
+	speed = 1.
+	address = ADDRESS
+	surfaces = []
+	for arg in args[1:]:
+		if arg.startswith('--speed='):
+			speed = float(arg[len('--speed='):])
+		elif arg.startswith('--address='):
+			address = arg[len('--address='):]
+		elif arg.startswith('--surface='):
+			surfaces.append(arg[len('--surface='):])
+	return args[0], speed, address, surfaces
+
+if __name__ == '__main__':
+	directory, speed, address, surfaces = parse_args(sys.argv[1:])
+	messages = load(directory, surfaces = surfaces)
+	socket = bind(address)
+	raw_input('Publishing %d messages on %s, start the driver and press enter ' % (len(messages), address))
+	replay = Replay(messages, speed)
+	replay.publish(socket)
+	print replay
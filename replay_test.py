@@ -0,0 +1,204 @@
+#!/usr/bin/python
+import os
+import time
+import shutil
+import tempfile
+import threading
+import unittest
+import numpy as np
+import zmq
+import control_loop
+import pupil_stream
+import replay
+import sphero_driver
+import sphero_sim
+import pupil_driver_v2
+import get_gaze_location
+
+def write_recording(directory, seconds = 1., rate = 100.):
+	'''
+		pupil_positions.npy and gaze_positions.npy as
+		Recorder.stop saves them.
+	'''
+	random = np.random.RandomState(0)
+	count = int(seconds * rate)
+	timestamps = 1534. + np.arange(count) / rate
+	pupil = np.column_stack([timestamps, random.uniform(0.5, 1, count), np.zeros(count),
+		random.uniform(size = count), random.uniform(size = count), random.uniform(40, 60, count)])
+	gaze = np.column_stack([timestamps + 0.5 / rate, random.uniform(0.5, 1, count),
+		random.uniform(size = count), random.uniform(size = count)])
+	np.save(os.path.join(directory, replay.PUPIL_FILE), pupil)
+	np.save(os.path.join(directory, replay.GAZE_FILE), gaze)
+	return pupil, gaze
+
+class TestLoad(unittest.TestCase):
+	'''
+		Recordings turn into Pupil Server messages
+		which decode to the recorded values.
+	'''
+	def setUp(self):
+		self.directory = tempfile.mkdtemp()
+		self.pupil, self.gaze = write_recording(self.directory)
+
+	def tearDown(self):
+		shutil.rmtree(self.directory)
+
+	def test_decode(self):
+		messages = replay.load(self.directory, surfaces = ('realtime gaze on nexus',))
+		self.assertEqual(len(messages), len(self.pupil) + len(self.gaze))
+		timestamps = [timestamp for timestamp, msg in messages]
+		self.assertEqual(timestamps, sorted(timestamps))
+		decoder = pupil_stream.PupilDecoder('Pupil', (pupil_stream.CONFIDENCE, pupil_stream.TIMESTAMP, pupil_stream.NORM_POS))
+		pupil = decoder.decode(messages[0][1])
+		self.assertEqual([pupil.timestamp, pupil.confidence, pupil.norm_x, pupil.norm_y],
+			[self.pupil[0, 0], self.pupil[0, 1], self.pupil[0, 3], self.pupil[0, 4]])
+		decoder = pupil_stream.PupilDecoder('Gaze', (pupil_stream.NORM_POS,), surfaces = ('realtime gaze on nexus',))
+		gaze = decoder.decode(messages[1][1])
+		self.assertEqual(gaze.surfaces['realtime gaze on nexus'], (self.gaze[0, 2], self.gaze[0, 3]))
+
+	def test_topics(self):
+		messages = replay.load(self.directory, topics = ('Gaze',))
+		self.assertEqual(len(messages), len(self.gaze))
+		self.assertTrue(all(msg.startswith('Gaze\n') for timestamp, msg in messages))
+
+class TestReplay(unittest.TestCase):
+	'''
+		Everything published arrives in order, paced
+		by the recording timestamps.
+	'''
+	def setUp(self):
+		self.context = zmq.Context()
+		self.pub = replay.bind('inproc://replay', self.context)
+		self.sub = self.context.socket(zmq.SUB)
+		self.sub.connect('inproc://replay')
+		pupil_stream.subscribe(self.sub, ('Pupil',))
+		# timestamps 0.2 seconds apart
+		self.messages = [(i * 0.2, replay.pupil_message(i * 0.2, 1., 0, 0.5, 0.5, 50.)) for i in range(6)]
+
+	def tearDown(self):
+		self.sub.close()
+		self.pub.close()
+		self.context.term()
+
+	def publish(self, speed):
+		player = replay.Replay(self.messages, speed)
+		start = time.time()
+		player.publish(self.pub)
+		elapsed = time.time() - start
+		received = [self.sub.recv() for msg in self.messages]
+		self.assertEqual(received, [msg for timestamp, msg in self.messages])
+		self.assertEqual(player.sent, len(self.messages))
+		return elapsed
+
+	def test_fast(self):
+		self.assertTrue(self.publish(0) < 0.1)
+
+	def test_scaled(self):
+		elapsed = self.publish(10.)
+		self.assertTrue(0.1 <= elapsed < 0.3)
+
+	def test_stop(self):
+		player = replay.Replay(self.messages, 1.)
+		threading.Timer(0.1, player.stop).start()
+		player.publish(self.pub)
+		self.assertEqual(player.sent, 2)
+
+def write_dwells(directory, targets, dwell = 2., rate = 100.):
+	'''
+		gaze_positions.npy of a gaze resting dwell seconds
+		on each of targets in turn, with a pixel of noise.
+	'''
+	random = np.random.RandomState(0)
+	count = int(dwell * rate)
+	gaze = np.vstack([np.column_stack([np.full(count, 0.9), np.tile(target, (count, 1))]) for target in targets])
+	gaze[:, 1:] += random.normal(0, 0.0003, (len(gaze), 2))
+	gaze = np.column_stack([1534. + np.arange(len(gaze)) / rate, gaze])
+	np.save(os.path.join(directory, replay.GAZE_FILE), gaze)
+
+class TestDrivers(unittest.TestCase):
+	'''
+		Recordings replayed headless through the path
+		drawing of pupil_driver_v2 and the taps of
+		get_gaze_location.
+	'''
+	targets = [(0.2, 0.2), (0.8, 0.3), (0.7, 0.8), (0.3, 0.6)]
+
+	def setUp(self):
+		self.directory = tempfile.mkdtemp()
+		write_dwells(self.directory, self.targets)
+		self.context = zmq.Context()
+		self.pub = replay.bind('inproc://drivers', self.context)
+		self.sub = self.context.socket(zmq.SUB)
+		self.sub.connect('inproc://drivers')
+		pupil_stream.subscribe(self.sub, ('Gaze',))
+
+	def tearDown(self):
+		self.sub.close()
+		self.pub.close()
+		self.context.term()
+		shutil.rmtree(self.directory)
+
+	def replay(self, args, run):
+		'''
+			Publish the recording as fast as possible while
+			run(socket, loop) handles it, stop once done.
+		'''
+		directory, speed, address, surfaces = replay.parse_args([self.directory, '--speed=0'] + args)
+		player = replay.Replay(replay.load(directory, surfaces = surfaces), speed)
+		thread = threading.Thread(target = player.publish, args = (self.pub,))
+		loop = control_loop.ControlLoop()
+		def check():
+			if not thread.is_alive():
+				loop.call_later(0.1, loop.stop)
+				timer.cancel()
+		timer = loop.call_every(0.01, check)
+		thread.start()
+		run(self.sub, loop)
+		thread.join()
+
+	def test_parse_args(self):
+		self.assertEqual(replay.parse_args(['rec', '--speed=2', '--address=inproc://x', '--surface=a', '--surface=b']),
+			('rec', 2., 'inproc://x', ['a', 'b']))
+		self.assertEqual(replay.parse_args(['rec']), ('rec', 1., replay.ADDRESS, []))
+
+	def test_draw_paths(self):
+		transport, sim = sphero_sim.loopback()
+		sphero = sphero_driver.Sphero()
+		sphero.connect(transport)
+		sphero.start()
+		pupil_driver_v2.sphero = sphero
+		pupil_driver_v2.path_macro = pupil_driver_v2.PathMacro(sphero)
+		try:
+			self.replay([], lambda socket, loop: pupil_driver_v2.draw_loop(socket, 0.65, loop = loop))
+			self.assertTrue(sphero.ping(True).ok(1))
+		finally:
+			pupil_driver_v2.sphero = pupil_driver_v2.path_macro = None
+			sphero.disconnect()
+			sim.stop()
+			sphero.join(1)
+		# one path per move between targets, run once the gaze rests
+		self.assertEqual(sim.commands[tuple(sphero_driver.REQ['CMD_RUN_MACRO'])], len(self.targets) - 1)
+		self.assertEqual(sim.commands[tuple(sphero_driver.REQ['CMD_SAVE_TEMP_MACRO'])], len(self.targets) - 1)
+
+	def tap(self, fixation):
+		commands = []
+		tapper = get_gaze_location.GazeTapper(commands.append, fixation)
+		self.replay(['--surface=' + get_gaze_location.SURFACE],
+			lambda socket, loop: get_gaze_location.tap_loop(socket, tapper, loop = loop))
+		self.assertEqual(commands, tapper.taps)
+		return [map(float, command.split()[2:]) for command in commands]
+
+	def test_dwell_taps(self):
+		taps = self.tap(False)
+		for tap, (x, y) in zip(taps, self.targets):
+			self.assertTrue(abs(tap[0] - x * 1920) < 5 and abs(tap[1] - (1 - y) * 1200) < 5)
+		self.assertEqual(len(taps), len(self.targets))
+
+	def test_fixation_taps(self):
+		taps = self.tap(True)
+		self.assertEqual(len(taps), len(self.targets))
+		for (x, y), (target_x, target_y) in zip(taps, self.targets):
+			self.assertTrue(abs(x - target_x * 1920) < 20 and abs(y - (1 - target_y) * 1200) < 20)
+
+if __name__ == '__main__':
+	unittest.main()
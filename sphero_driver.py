@@ -36,15 +36,16 @@
 # Fitting using for Mac system.
 # Using lightblue instead of bluetooth
 
-# import bluetooth
-# changed
-import lightblue
-
 import sys
 import struct
 import time
 import operator
 import threading
+import collections
+
+import metrics
+#BTInterface moved to sphero_transport, imported here for existing users
+from sphero_transport import BTInterface, ConnectError
 
 #These are the message response code that can be return by Sphero.
 MRSP = dict(
@@ -167,90 +168,756 @@ STRM_MASK2 = dict(
   VELOCITY_Y         = 0x00800000)
 
 
-class BTInterface(object):
-
-  def __init__(self, target_name = 'Sphero', port = 1):
-      self.target_name = target_name
-      self.port = port
-      self.found_device = False
-      self.tries = 0
-      self.target_address = None
-      self.sock = None
-
-  def connect(self):
-    sys.stdout.write("Searching for devices....")
-    sys.stdout.flush()
-
-    for i in range(10):
-      sys.stdout.write("....")
-      sys.stdout.flush()
-      # nearby_devices = bluetooth.discover_devices(lookup_names = True)
-      nearby_devices = lightblue.finddevices(getnames = True)
-
-      devs = {}
-      count = 0
-      if len(nearby_devices)>0:
-        # # for bdaddr, name in nearby_devices:
-        # for bdaddr, name, d_val in nearby_devices:
-        #   #look for a device name that starts with Sphero
-        #   if name.startswith(self.target_name):
-        #     self.found_device = True
-        #     self.target_address = bdaddr
-        #     break
-        for bdaddr, name, d_val in nearby_devices:
-          # look for a devic name that starts with Sphero
-          if name.startswith(self.target_name):
-            devs[name] = [bdaddr, name, d_val]
-            print "devices name = {}".format(name)
-            count += 1
-
-        if count == 1:
-          self.found_device = True
-          self.target_address = bdaddr
-          break
-        elif count >= 1:
-          selected_dev = raw_input("Please enter name: ")
-          self.found_device = True
-          self.target_address = devs[selected_dev][0]
-          break
-        else:
-          pass
+#Payload formats of the commands packed from a CommandTemplate, these
+#are the ones sent at high rates.
+TEMPLATE_FORMATS = dict(
+  CMD_ROLL = 'BHB',
+  CMD_SET_HEADING = 'H',
+  CMD_SET_RGB_LED = 'BBBB',
+  CMD_SET_BACK_LED = 'B',
+  CMD_SET_RAW_MOTORS = 'BBBB')
 
-      if self.found_device:
-        break
 
+class CommandTemplate(object):
+  """
+  Precompiled packet of a command with a fixed size payload. The
+  packet is written into a reusable bytearray: the constant header
+  bytes once, and per packet only SOP2, SEQ, the payload through a
+  struct.Struct and the checksum, which starts from the precomputed
+  sum of DID, CID and DLEN.
+
+  :param req: DID and CID, as in REQ.
+  :param fmt: struct format of the payload, big endian.
+  """
+
+  def __init__(self, req, fmt):
+    self.struct = struct.Struct('>' + fmt)
+    dlen = self.struct.size + 1
+    self.buf = bytearray(6 + dlen)
+    self.buf[0] = 0xff
+    self.buf[2] = req[0]
+    self.buf[3] = req[1]
+    self.buf[5] = dlen
+    self.header_sum = req[0] + req[1] + dlen
+
+  def pack(self, response, seq, *values):
+    """
+    :return: the packed message, as built by Sphero.send.
+    """
+    buf = self.buf
+    buf[1] = 0xff if response else 0xfe
+    buf[4] = seq
+    self.struct.pack_into(buf, 6, *values)
+    buf[-1] = ~(self.header_sum + seq + sum(buf[6:-1])) & 0xff
+    return str(buf)
+
+
+#Command codes of the macro language, each followed by its arguments.
+#PCD is the post command delay in ms.
+MACRO_CMDS = dict(
+  END = 0x00,                           #End of macro
+  SET_STABILIZATION = 0x03,             #Flag, PCD
+  SET_HEADING = 0x04,                   #Heading MSB, LSB, PCD
+  ROLL = 0x05,                          #Speed, Heading MSB, LSB, PCD
+  SET_RGB_LED = 0x07,                   #Red, Green, Blue, PCD
+  SET_BACK_LED = 0x08,                  #Intensity, PCD
+  DELAY = 0x0b)                         #Time MSB, LSB
+
+#ID of the temporary macro, as saved by CMD_SAVE_TEMP_MACRO.
+TEMP_MACRO_ID = 0xff
+
+
+class MacroBuilder(object):
+  """
+  Encodes steps into a macro that Sphero runs on its own, so a
+  sequence of commands costs one upload instead of a packet per step.
+  The step methods return the builder, so they can be chained::
+
+    macro = MacroBuilder().roll(50, 90).delay(1500).roll(0, 90)
+    sphero.save_temp_macro(macro, False)
+    sphero.run_macro(TEMP_MACRO_ID, False)
+
+  The END command is added by build. A macro is uploaded in one
+  packet, so it is limited to MAX_SIZE bytes; adding a step that does
+  not fit raises ValueError.
+  """
+
+  # one byte DLEN, which also counts the checksum
+  MAX_SIZE = 254
+
+  def __init__(self):
+    self.data = bytearray()
+
+  def __len__(self):
+    return len(self.data)
+
+  def space(self):
+    """
+    :return: bytes left for steps, the END command excluded.
+    """
+    return self.MAX_SIZE - 1 - len(self.data)
+
+  def _add(self, cmd, *args):
+    if 1 + len(args) > self.space():
+      raise ValueError("Macro is full, %d bytes left" % self.space())
+    self.data.append(MACRO_CMDS[cmd])
+    self.data.extend(args)
+    return self
+
+  def roll(self, speed, heading, pcd = 0):
+    return self._add('ROLL', speed, heading >> 8, heading & 0xff, pcd)
+
+  def set_heading(self, heading, pcd = 0):
+    return self._add('SET_HEADING', heading >> 8, heading & 0xff, pcd)
+
+  def set_rgb_led(self, red, green, blue, pcd = 0):
+    return self._add('SET_RGB_LED', red, green, blue, pcd)
+
+  def set_back_led(self, brightness, pcd = 0):
+    return self._add('SET_BACK_LED', brightness, pcd)
+
+  def set_stabilization(self, enable, pcd = 0):
+    return self._add('SET_STABILIZATION', enable, pcd)
+
+  def delay(self, ms):
+    """
+    :param ms: 0-65535 milliseconds.
+    """
+    return self._add('DELAY', ms >> 8, ms & 0xff)
+
+  def build(self):
+    """
+    :return: the macro bytes, as a list for Sphero.pack_cmd.
+    """
+    return list(self.data) + [MACRO_CMDS['END']]
+
+
+#Commands that the CommandScheduler coalesces and rate limits. Only the
+#latest value of these matters, so intermediate ones can be dropped.
+COALESCED_CMDS = [REQ['CMD_ROLL'], REQ['CMD_SET_HEADING'], REQ['CMD_SET_RGB_LED'], REQ['CMD_SET_BACK_LED']]
+
+
+class CommandScheduler(threading.Thread):
+  """
+  Sits between the command methods of Sphero and the Bluetooth link
+  and thins out streams of motion and LED commands:
+
+  * a command identical to the previous one sent is suppressed, unless\
+    more than refresh seconds passed since it was sent.
+  * commands are sent at most max_rate times per second. Commands\
+    arriving faster are held back, and a newer command of the same\
+    type replaces the held back one, so the latest value is always\
+    the one that gets sent.
 
-    if self.target_address is not None:
-      sys.stdout.write("\nFound Sphero device with address: %s\n" %  (self.target_address))
-      sys.stdout.flush()
+  Other commands are sent immediately, after flushing held back
+  commands to keep their order.
+  """
+
+  def __init__(self, write, max_rate = 20.0, refresh = 1.0):
+    threading.Thread.__init__(self)
+    self.daemon = True
+    self.write = write
+    self.min_interval = 1.0 / max_rate if max_rate else 0.0
+    self.refresh = refresh
+    self.sent = 0
+    self.suppressed = 0
+    self.shutdown = False
+    self._coalesced = set(''.join(chr(x) for x in cmd) for cmd in COALESCED_CMDS)
+    self._last_body = None
+    self._last_time = 0.0
+    self._pending = collections.OrderedDict()
+    self._cond = threading.Condition()
+
+  def submit(self, msg):
+    """
+    Send or schedule a packed message without response request.
+
+    :param msg: packed message as built by Sphero.send.
+    """
+    # DID and CID identify the command, SEQ and DLEN are skipped
+    # when comparing the payload
+    cmd = msg[2:4]
+    body = cmd + msg[6:-1]
+    with self._cond:
+      if cmd not in self._coalesced:
+        self._flush()
+        self._write(body, msg)
+        return
+      if cmd in self._pending:
+        self.suppressed += 1
+        del self._pending[cmd]
+      now = time.time()
+      if self._pending or now - self._last_time < self.min_interval:
+        self._pending[cmd] = (body, msg)
+        self._cond.notify()
+      elif body == self._last_body and now - self._last_time < self.refresh:
+        self.suppressed += 1
+      else:
+        self._write(body, msg)
+
+  def _write(self, body, msg):
+    # must be called with self._cond held
+    self.write(msg)
+    self._last_body = body
+    self._last_time = time.time()
+    self.sent += 1
+
+  def _send_pending(self):
+    # must be called with self._cond held
+    cmd, (body, msg) = self._pending.popitem(last = False)
+    if body == self._last_body and time.time() - self._last_time < self.refresh:
+      self.suppressed += 1
     else:
-      sys.stdout.write("\nNo Sphero devices found.\n" )
-      sys.stdout.flush()
-      sys.exit(1)
+      self._write(body, msg)
 
-    try:
-      #self.sock=bluetooth.BluetoothSocket(bluetooth.RFCOMM)
-      #self.sock.connect((bdaddr,self.port))
-      self.sock = lightblue.socket()
-      self.sock.connect((bdaddr, self.port))
-    # except bluetooth.btcommon.BluetoothError as error:
-    except lightblue.socket.error as error:
-      sys.stdout.write(error)
-      sys.stdout.flush()
-      time.sleep(5.0)
-      sys.exit(1)
-    sys.stdout.write("Paired with Sphero.\n")
-    sys.stdout.flush()
+  def _flush(self):
+    # must be called with self._cond held
+    while self._pending:
+      self._send_pending()
+
+  def flush(self):
+    """
+    Send all held back commands right away.
+    """
+    with self._cond:
+      self._flush()
+
+  def run(self):
+    with self._cond:
+      while not self.shutdown:
+        if not self._pending:
+          self._cond.wait()
+          continue
+        delay = self._last_time + self.min_interval - time.time()
+        if delay > 0:
+          self._cond.wait(delay)
+          continue
+        self._send_pending()
+
+  def stop(self):
+    with self._cond:
+      self.shutdown = True
+      self._flush()
+      self._cond.notify()
+
+  def __str__(self):
+    return "commands sent: %d, suppressed: %d" % (self.sent, self.suppressed)
+
+
+#Back-pressure policies of the SendQueue when it is full.
+SEND_POLICIES = ('block', 'drop_oldest', 'drop_newest')
+
+#DID and CID of the messages a SendQueue may drop.
+DROPPABLE_CMDS = frozenset(str(bytearray(cmd)) for cmd in COALESCED_CMDS)
+
+
+class SendQueue(threading.Thread):
+  """
+  Bounded queue of packed messages that a dedicated writer thread
+  writes to the link, so that sending a command never waits for the
+  Bluetooth socket. When the queue is full the policy decides:
+
+  * block - wait until the writer made room.
+  * drop_oldest - discard the oldest queued droppable message.
+  * drop_newest - discard the message being queued, if it is droppable.
+
+  Only messages of COALESCED_CMDS that do not request a response are
+  droppable, configuration packets and commands waiting for a response
+  are always sent. When there is nothing to drop, put waits as with
+  block.
+
+  The time from queueing a message until it was written is collected
+  in the latency histogram, discarded messages in dropped.
+  """
+
+  def __init__(self, write, maxsize = 64, policy = 'block'):
+    threading.Thread.__init__(self)
+    if policy not in SEND_POLICIES:
+      raise ValueError("Unknown send queue policy: %s" % policy)
+    self.daemon = True
+    self.write = write
+    self.maxsize = maxsize
+    self.policy = policy
+    self.dropped = 0
+    self.shutdown = False
+    self.latency = metrics.LatencyStats('enqueue to wire')
+    self._queue = collections.deque()
+    self._lock = threading.Lock()
+    self._not_empty = threading.Condition(self._lock)
+    self._not_full = threading.Condition(self._lock)
+
+  def put(self, msg):
+    """
+    Queue a packed message for writing.
+
+    :param msg: packed message as built by Sphero.send.
+    :return: False if the message was discarded.
+    """
+    #no response requested and a command of which only the latest matters
+    droppable = msg[1] == '\xfe' and msg[2:4] in DROPPABLE_CMDS
+    with self._lock:
+      while len(self._queue) >= self.maxsize:
+        if self.policy == 'drop_newest' and droppable:
+          self.dropped += 1
+          return False
+        if self.policy == 'drop_oldest' and self._drop_oldest():
+          continue
+        self._not_full.wait()
+      self._queue.append((time.time(), msg, droppable))
+      self._not_empty.notify()
     return True
 
-  def send(self, data):
-    self.sock.send(data)
+  def _drop_oldest(self):
+    for i, (queued, msg, droppable) in enumerate(self._queue):
+      if droppable:
+        del self._queue[i]
+        self.dropped += 1
+        return True
+    return False
 
-  def recv(self, num_bytes):
-    return self.sock.recv(num_bytes)
+  def __len__(self):
+    return len(self._queue)
+
+  def run(self):
+    while True:
+      with self._lock:
+        while not self._queue and not self.shutdown:
+          self._not_empty.wait()
+        if not self._queue:
+          return
+        queued, msg, droppable = self._queue.popleft()
+        self._not_full.notify()
+      self.write(msg)
+      self.latency.add(time.time() - queued)
+
+  def stop(self):
+    """
+    Stop the writer thread once the queued messages are written.
+    """
+    with self._lock:
+      self.shutdown = True
+      self._not_empty.notify()
+    self.join()
+
+  def __str__(self):
+    return "%s, queued: %d, dropped: %d" % (self.latency, len(self._queue), self.dropped)
+
+
+class ResponseTimeout(RuntimeError):
+  """
+  Raised by ResponseFuture.result when Sphero did not answer in time.
+  """
+  pass
+
+
+class ResponseFuture(object):
+  """
+  Pending response to a command sent with a response request. It is
+  matched with the response packet by its sequence number and
+  resolves with the message response code (see MRSP) and the data
+  payload of the response.
+  """
+
+  def __init__(self, seq):
+    self.seq = seq
+    self.sent_time = time.time()
+    self.rtt = None
+    self.mrsp = None
+    self.data = None
+    self.expired = False
+    self._event = threading.Event()
+
+  def set_result(self, mrsp, data):
+    self.rtt = time.time() - self.sent_time
+    self.mrsp = mrsp
+    self.data = data
+    self._event.set()
+
+  def expire(self):
+    """
+    Give up waiting, e.g. because the sequence number was reused.
+    """
+    self.expired = True
+    self._event.set()
+
+  def done(self):
+    return self._event.is_set()
+
+  def result(self, timeout = None):
+    """
+    Wait for the response.
+
+    :param timeout: seconds to wait, None waits forever.
+    :return: tuple of message response code and data payload.
+    """
+    self._event.wait(timeout)
+    if not self._event.is_set() or self.expired:
+      raise ResponseTimeout("No response for sequence number %d" % self.seq)
+    return self.mrsp, self.data
+
+  def ok(self, timeout = None):
+    """
+    Wait for the response and tell whether the command succeeded.
+    """
+    return self.result(timeout)[0] == MRSP['ORBOTIX_RSP_CODE_OK']
+
+
+class PacketFramer(object):
+  """
+  Splits the byte stream received from Sphero into packets. Received
+  bytes are copied into a preallocated bytearray and packets are
+  handed out as memoryviews of it, so no per packet copies of the
+  remaining buffer are made. A packet view is only valid until the
+  next call of feed.
+
+  The checksum of every packet is validated. With resync, bytes that
+  do not start a valid packet (bad SOF, bad checksum) are skipped up to
+  the next possible start of packet and counted, otherwise a
+  RuntimeError is raised.
+  """
+
+  # larger than the largest packet (16-bit DLEN) plus one read
+  CAPACITY = 1 << 17
+
+  def __init__(self, resync = True, capacity = CAPACITY):
+    self.resync = resync
+    self.buf = bytearray(capacity)
+    self.view = memoryview(self.buf)
+    self.start = 0
+    self.end = 0
+    self.bad_checksum = 0
+    self.skipped_bytes = 0
+
+  def feed(self, data):
+    """
+    Append received bytes.
+
+    :param data: string of received bytes.
+    """
+    n = len(data)
+    if self.end + n > len(self.buf):
+      #move the unparsed bytes to the front, the buffer itself is
+      #never resized so handed out views stay valid objects
+      remaining = self.end - self.start
+      if remaining + n > len(self.buf):
+        raise RuntimeError("Receive buffer overflow")
+      self.buf[0:remaining] = self.buf[self.start:self.end]
+      self.start = 0
+      self.end = remaining
+    self.buf[self.end:self.end + n] = data
+    self.end += n
+
+  def __len__(self):
+    return self.end - self.start
+
+  def reset(self):
+    """
+    Drop buffered bytes, e.g. the partial packet of a lost link.
+    """
+    self.start = 0
+    self.end = 0
+
+  def _skip(self, reason):
+    #drop the current start of packet and look for the next one
+    if not self.resync:
+      raise RuntimeError(reason + " : " + ' '.join("%02x" % b for b in self.buf[self.start:self.end]))
+    pos = self.buf.find('\xff', self.start + 1, self.end)
+    if pos < 0:
+      pos = self.end
+    self.skipped_bytes += pos - self.start
+    self.start = pos
+
+  def next_packet(self):
+    """
+    :return: memoryview of the next complete packet, None if more\
+    bytes are needed.
+    """
+    buf = self.buf
+    while self.end - self.start >= 5:
+      start = self.start
+      if buf[start] != 0xff or buf[start + 1] not in (0xff, 0xfe):
+        self._skip("Bad SOF")
+        continue
+      if buf[start + 1] == 0xff:
+        #response packet, one byte DLEN
+        data_length = buf[start + 4]
+      else:
+        #async packet, two byte DLEN
+        data_length = (buf[start + 3] << 8) + buf[start + 4]
+      if data_length == 0:
+        self._skip("Bad DLEN")
+        continue
+      end = start + 5 + data_length
+      if end > self.end:
+        return None
+      if (sum(buf[start + 2:end - 1]) & 0xff) ^ 0xff != buf[end - 1]:
+        self.bad_checksum += 1
+        self._skip("Bad checksum")
+        continue
+      self.start = end
+      return self.view[start:end]
+    return None
+
+
+#Rate in Hz of the Sphero control system, the data streaming sample
+#rate is this divided by sample_div.
+SENSOR_RATE = 400.
+
+
+class TelemetryBuffer(object):
+  """
+  Fixed capacity ring buffer of data streaming samples with one int16
+  column per streamed field and a host_time column (seconds since the
+  epoch). Every sample is stored twice, at i and i + capacity, so the
+  most recent samples always form one contiguous slice and windows
+  are returned as NumPy views without copying.
+
+  Views share memory with the buffer and are overwritten as new
+  samples arrive, copy a window to keep it.
+  """
+
+  def __init__(self, fields, capacity = 4096):
+    #numpy is imported by the methods keeping or decoding telemetry, so
+    #drivers that do not stream sensor data never wait for it
+    import numpy as np
+    self.fields = list(fields)
+    self.capacity = capacity
+    self.dtype = np.dtype([('host_time', np.float64)] + [(key, np.int16) for key in self.fields])
+    self.count = 0
+    self._data = np.zeros(2 * capacity, self.dtype)
+    self._lock = threading.Lock()
+
+  def __len__(self):
+    return min(self.count, self.capacity)
+
+  def append(self, frames, host_time, period = 0.0):
+    """
+    Store the frames of one data streaming packet.
+
+    :param frames: structured array as returned by\
+    Sphero.decode_data_strm.
+    :param host_time: receive time of the packet, given to the last frame.
+    :param period: seconds between two frames of the packet.
+    """
+    import numpy as np
+    n = len(frames)
+    rows = np.empty(n, self.dtype)
+    rows['host_time'] = host_time - period * np.arange(n - 1, -1, -1)
+    for key in self.fields:
+      rows[key] = frames[key]
+    with self._lock:
+      pos = (self.count + np.arange(n)) % self.capacity
+      self._data[pos] = rows
+      self._data[pos + self.capacity] = rows
+      self.count += n
+
+  def last(self, n = None):
+    """
+    :param n: number of samples, all stored samples when None.
+    :return: view of the last n samples, oldest first.
+    """
+    with self._lock:
+      available = min(self.count, self.capacity)
+      n = available if n is None else min(n, available)
+      end = self.count % self.capacity + self.capacity
+      return self._data[end - n:end]
+
+  def since(self, host_time):
+    """
+    :param host_time: seconds since the epoch.
+    :return: view of the stored samples newer than host_time.
+    """
+    import numpy as np
+    window = self.last()
+    return window[np.searchsorted(window['host_time'], host_time, 'right'):]
+
+  def snapshot(self, path, n = None):
+    """
+    Save the last n samples to a .npy file while streaming goes on.
+
+    :param path: file name to save to.
+    :param n: number of samples, all stored samples when None.
+    """
+    import numpy as np
+    np.save(path, self.last_copy(n))
+
+  def last_copy(self, n = None):
+    """
+    Same as last, but returns a copy that later samples do not change.
+    """
+    with self._lock:
+      available = min(self.count, self.capacity)
+      n = available if n is None else min(n, available)
+      end = self.count % self.capacity + self.capacity
+      return self._data[end - n:end].copy()
+
+
+class AsyncSubscription(threading.Thread):
+  """
+  One subscriber of the AsyncEventBus. Events are put in a bounded
+  queue and handed to the callback on the subscription's own thread,
+  so a slow subscriber never holds up packet reception. When the
+  queue is full the oldest event is dropped and counted in dropped.
+  """
+
+  def __init__(self, id_code, callback, maxsize = 256):
+    threading.Thread.__init__(self)
+    self.daemon = True
+    self.id_code = id_code
+    self.callback = callback
+    self.maxsize = maxsize
+    self.delivered = 0
+    self.dropped = 0
+    self.shutdown = False
+    self._queue = collections.deque()
+    self._cond = threading.Condition()
+
+  def put(self, event):
+    with self._cond:
+      if len(self._queue) >= self.maxsize:
+        self._queue.popleft()
+        self.dropped += 1
+      self._queue.append(event)
+      self._cond.notify()
+
+  def run(self):
+    while True:
+      with self._cond:
+        while not self._queue and not self.shutdown:
+          self._cond.wait()
+        if self.shutdown:
+          return
+        event = self._queue.popleft()
+      try:
+        self.callback(event)
+      except Exception as error:
+        sys.stderr.write("Async callback %r failed: %r\n" % (self.callback, error))
+      self.delivered += 1
+
+  def stop(self):
+    with self._cond:
+      self.shutdown = True
+      self._cond.notify()
+    if threading.current_thread() is not self:
+      self.join()
+
+  def __str__(self):
+    return "%r: delivered %d, dropped %d, queued %d" % (self.callback, self.delivered, self.dropped, len(self._queue))
+
+
+class InlineSubscription(object):
+  """
+  Subscriber of the AsyncEventBus called directly by the thread that
+  publishes, without queue or thread of its own. Meant for a single
+  threaded event loop that also does the receiving.
+  """
+
+  def __init__(self, id_code, callback):
+    self.id_code = id_code
+    self.callback = callback
+    self.delivered = 0
+    self.dropped = 0
+
+  def put(self, event):
+    self.callback(event)
+    self.delivered += 1
+
+  def stop(self):
+    pass
+
+  def __str__(self):
+    return "%r: delivered %d inline" % (self.callback, self.delivered)
+
+
+class AsyncEventBus(object):
+  """
+  Publish/subscribe dispatch of asynchronous Sphero packets. Any
+  number of subscribers can listen to an ID code (see IDCODE), each
+  one gets its own bounded queue and delivery thread.
+  """
+
+  def __init__(self):
+    self._subscribers = dict()
+    self._lock = threading.Lock()
+
+  def subscribe(self, id_code, callback, maxsize = 256, inline = False):
+    """
+    :param id_code: ID code of the asynchronous packets, see IDCODE.
+    :param callback: called with the parsed packet.
+    :param maxsize: number of events queued for this subscriber.
+    :param inline: call back on the publishing thread, see\
+    InlineSubscription.
+    :return: the subscription, pass it to unsubscribe.
+    """
+    if inline:
+      subscription = InlineSubscription(id_code, callback)
+    else:
+      subscription = AsyncSubscription(id_code, callback, maxsize)
+      subscription.start()
+    with self._lock:
+      #copy on write so publish can iterate without the lock
+      self._subscribers[id_code] = self._subscribers.get(id_code, ()) + (subscription,)
+    return subscription
+
+  def unsubscribe(self, subscription):
+    with self._lock:
+      remaining = tuple(s for s in self._subscribers.get(subscription.id_code, ()) if s is not subscription)
+      if remaining:
+        self._subscribers[subscription.id_code] = remaining
+      else:
+        self._subscribers.pop(subscription.id_code, None)
+    subscription.stop()
+
+  def has_subscribers(self, id_code):
+    return id_code in self._subscribers
+
+  def publish(self, id_code, event):
+    for subscription in self._subscribers.get(id_code, ()):
+      subscription.put(event)
+
+  def subscriptions(self):
+    with self._lock:
+      return [s for subscribers in self._subscribers.values() for s in subscribers]
 
   def close(self):
-    self.sock.close()
+    for subscription in self.subscriptions():
+      self.unsubscribe(subscription)
+
+
+class Backoff(object):
+  """
+  Delays between reconnect attempts, starting at initial_delay and
+  doubling after every failed attempt up to max_delay.
+
+  :param max_attempts: attempts before giving up, None to never give up.
+  """
+
+  def __init__(self, initial_delay = 0.5, max_delay = 30.0, max_attempts = None):
+    self.initial_delay = initial_delay
+    self.max_delay = max_delay
+    self.max_attempts = max_attempts
+    self.reset()
+
+  def reset(self):
+    self.attempts = 0
+    self.delay = self.initial_delay
+
+  def next(self):
+    """
+    :return: seconds to wait before the next attempt, None when no\
+    attempts are left.
+    """
+    if self.max_attempts is not None and self.attempts >= self.max_attempts:
+      return None
+    delay = self.delay
+    self.attempts += 1
+    self.delay = min(self.delay * 2, self.max_delay)
+    return delay
+
+
+#States of the link to Sphero, see Sphero.enable_reconnect.
+LINK_STATES = ('disconnected', 'connected', 'reconnecting', 'closed')
+
 
 class Sphero(threading.Thread):
 
@@ -261,29 +928,229 @@ class Sphero(threading.Thread):
     self.shutdown = False
     self.is_connected = False
     self.mask_list = None
+    self.strm_struct = None
+    self.strm_dtype = None
+    self.strm_native_dtype = None
     self.stream_mask1 = None
     self.stream_mask2 = None
+    self.stream_frames = None
+    self.stream_div = None
+    self.telemetry = None
+    self.telemetry_capacity = None
     self.seq = 0
-    self.raw_data_buf = []
-    self._communication_lock = threading.Lock()
+    #packet templates of TEMPLATE_FORMATS, by REQ name
+    self._templates = dict((name, CommandTemplate(REQ[name], fmt)) for name, fmt in TEMPLATE_FORMATS.items())
+    #guards seq and the shared buffers of the templates, commands are
+    #sent from several threads and no two may get the same SEQ
+    self._seq_lock = threading.Lock()
+    self.framer = PacketFramer()
+    #reading and writing the link are locked separately so that a
+    #send never waits for a blocking read
+    self._send_lock = threading.Lock()
+    self._recv_lock = threading.Lock()
+    self.scheduler = None
+    self.send_queue = None
+    #commands waiting for their response, keyed by sequence number
+    self._pending_responses = dict()
+    self._pending_lock = threading.Lock()
+    self.response_rtt = metrics.LatencyStats('response round trip')
+    self.events = AsyncEventBus()
+    #subscriptions made with add_async_callback, one per ID code
     self._async_callback_dict = dict()
+    self._async_parsers = {IDCODE['COLLISION']: self.parse_collision_detect,
+                           IDCODE['PWR_NOTIFY']: self.parse_pwr_notify}
     self._sync_callback_dict = dict()
     self._sync_callback_queue = []
-
-  def connect(self):
-    self.bt = BTInterface(self.target_name)
+    self.state = 'disconnected'
+    self._state_lock = threading.Lock()
+    #cleared while reconnecting, writers wait for it at most write_wait
+    self._link_up = threading.Event()
+    self._link_up.set()
+    self.write_wait = 0.05
+    #messages written while reconnecting, sent once the link is back
+    self._held = []
+    self.dropped_while_down = 0
+    self._closing = threading.Event()
+    self.backoff = None
+    self.connect_time = metrics.LatencyStats('connect')
+    self.reconnects = 0
+    #configuration commands sent again after a reconnect, by REQ name
+    self._link_config = collections.OrderedDict()
+
+  def connect(self, transport = None):
+    """
+    Open the link to Sphero.
+
+    :param transport: link from sphero_transport, by default a\
+    BTInterface looking for target_name.
+    """
+    if transport is None:
+      transport = BTInterface(self.target_name)
+    self.bt = transport
+    start = time.time()
     self.is_connected = self.bt.connect()
+    self.connect_time.add(time.time() - start)
+    self._closing.clear()
+    self.state = 'connected'
+    return True
+
+  def enable_reconnect(self, initial_delay = 0.5, max_delay = 30.0, max_attempts = None, write_wait = 0.05):
+    """
+    Reopen the link automatically when it is lost, waiting with
+    exponential backoff between attempts. The Sphero object, commands
+    in the send queue and the data streaming and collision detection
+    configuration are kept, responses that were pending are expired.
+
+    While reconnecting, a write waits at most write_wait seconds for the
+    link, so neither the send queue nor an event loop stalls for the
+    whole backoff. After that, motion and LED commands without response
+    request (DROPPABLE_CMDS) are dropped, as they are outdated by the
+    time the link is back, and other messages are held and sent once
+    it is.
+
+    :param initial_delay: seconds before the first attempt.
+    :param max_delay: longest wait between attempts.
+    :param max_attempts: attempts before giving up, None to never give up.
+    :param write_wait: seconds a write waits for the link to come back.
+    """
+    self.backoff = Backoff(initial_delay, max_delay, max_attempts)
+    self.write_wait = write_wait
+
+  def disable_reconnect(self):
+    self.backoff = None
+
+  def _link_lost(self):
+    """
+    Called when reading or writing the link failed.
+
+    :return: True if the link is being reopened.
+    """
+    with self._state_lock:
+      if self.state != 'connected':
+        return self.state == 'reconnecting'
+      self.is_connected = False
+      if self.backoff is None:
+        self.state = 'disconnected'
+        return False
+      self.state = 'reconnecting'
+      self._link_up.clear()
+    with self._pending_lock:
+      pending = self._pending_responses.values()
+      self._pending_responses.clear()
+    for future in pending:
+      future.expire()
+    reconnect = threading.Thread(target = self._reconnect)
+    reconnect.daemon = True
+    reconnect.start()
     return True
 
+  def _reconnect(self):
+    self.backoff.reset()
+    while True:
+      delay = self.backoff.next()
+      if delay is None or self._closing.wait(delay):
+        break
+      start = time.time()
+      try:
+        if not self.bt.reconnect():
+          continue
+      except (IOError, OSError):
+        continue
+      self.connect_time.add(time.time() - start)
+      self.framer.reset()
+      with self._state_lock:
+        if self.state == 'closed':
+          self.bt.close()
+          break
+        self.is_connected = True
+        self.state = 'connected'
+        self.reconnects += 1
+        held = self._held
+        self._held = []
+      self._link_up.set()
+      for name, args in self._link_config.items():
+        self.send(self.pack_cmd(REQ[name], args), False)
+      for msg in held:
+        self._write_link(msg)
+      return
+    with self._state_lock:
+      if self.state != 'closed':
+        self.state = 'disconnected'
+      self._held = []
+    self._link_up.set()
+
+  def enable_scheduler(self, max_rate = 20.0, refresh = 1.0):
+    """
+    Route commands sent without response request through a
+    CommandScheduler, which drops repeated motion and LED commands
+    and limits their rate.
+
+    :param max_rate: maximum number of roll, heading and LED commands\
+    sent per second.
+    :param refresh: seconds after which an identical command is sent again.
+    """
+    self.disable_scheduler()
+    self.scheduler = CommandScheduler(self.write, max_rate, refresh)
+    self.scheduler.start()
+
+  def disable_scheduler(self):
+    """
+    Send any held back commands and stop using the scheduler.
+    """
+    if self.scheduler is not None:
+      self.scheduler.stop()
+      self.scheduler = None
+
+  def enable_send_queue(self, maxsize = 64, policy = 'block'):
+    """
+    Write packed messages to the link from a dedicated writer thread,
+    so that command methods return without waiting for the link.
+
+    :param maxsize: number of messages the queue holds.
+    :param policy: what to do when the queue is full, one of\
+    SEND_POLICIES.
+    """
+    self.disable_send_queue()
+    self.send_queue = SendQueue(self._write_link, maxsize, policy)
+    self.send_queue.start()
+
+  def disable_send_queue(self):
+    """
+    Write the queued messages and stop the writer thread.
+    """
+    if self.send_queue is not None:
+      send_queue = self.send_queue
+      self.send_queue = None
+      send_queue.stop()
+
+  def enable_telemetry(self, capacity = 4096):
+    """
+    Keep the last capacity data streaming samples in self.telemetry,
+    a TelemetryBuffer. The buffer is recreated whenever the streamed
+    fields change with set_data_strm.
+
+    :param capacity: number of samples kept.
+    """
+    self.telemetry_capacity = capacity
+    if self.mask_list is not None:
+      self.telemetry = TelemetryBuffer(self.mask_list, capacity)
+
+  def disable_telemetry(self):
+    self.telemetry_capacity = None
+    self.telemetry = None
+
   def inc_seq(self):
-    self.seq = self.seq + 1
-    if self.seq > 0xff:
-      self.seq = 0
+    """
+    :return: the next sequence number.
+    """
+    with self._seq_lock:
+      self.seq = seq = (self.seq + 1) & 0xff
+    return seq
 
   def pack_cmd(self, req ,cmd):
-    self.inc_seq()
- #   print req + [self.seq] + [len(cmd)+1] + cmd
-    return req + [self.seq] + [len(cmd)+1] + cmd
+    seq = self.inc_seq()
+ #   print req + [seq] + [len(cmd)+1] + cmd
+    return req + [seq] + [len(cmd)+1] + cmd
 
   def data2hexstr(self, data):
     return ' '.join([ ("%02x"%ord(d)) for d in data])
@@ -298,13 +1165,28 @@ class Sphero(threading.Thread):
     #create a list containing the keys that are part of the mask
     self.mask_list2 = [key  for key, value in sorted_STRM2 if value & mask2]
     self.mask_list = self.mask_list1 + self.mask_list2
-
+    #compile the decoders of one sample frame, the fields are sent
+    #as big endian 16-bit values in the order of mask_list. The NumPy
+    #dtypes are compiled by the first decode_data_strm.
+    self.strm_struct = struct.Struct('>' + 'h' * len(self.mask_list))
+    self.strm_dtype = None
+    self.strm_native_dtype = None
 
   def add_async_callback(self, callback_type, callback):
-    self._async_callback_dict[callback_type] = callback
+    """
+    Set the callback of an asynchronous packet type, replacing the
+    one set before. It is called from its own thread, use
+    self.events.subscribe to add more subscribers to the same type.
+
+    :param callback_type: ID code of the packets, see IDCODE.
+    :param callback: called with the parsed packet.
+    """
+    if callback_type in self._async_callback_dict:
+      self.remove_async_callback(callback_type)
+    self._async_callback_dict[callback_type] = self.events.subscribe(callback_type, callback)
 
   def remove_async_callback(self, callback_type):
-    del self._async_callback_dict[callback_type]
+    self.events.unsubscribe(self._async_callback_dict.pop(callback_type))
 
   def add_sync_callback(self, callback_type, callback):
     self._sync_callback_dict[callback_type] = callback
@@ -322,7 +1204,7 @@ class Sphero(threading.Thread):
 
     :param response: request response back from Sphero.
     """
-    self.send(self.pack_cmd(REQ['CMD_PING'],[]), response)
+    return self.send(self.pack_cmd(REQ['CMD_PING'],[]), response)
 
   def get_version(self, response):
     """
@@ -331,7 +1213,7 @@ class Sphero(threading.Thread):
 
     :param response: request response back from Sphero.
     """
-    self.send(self.pack_cmd(REQ['CMD_VERSION'],[]), response)
+    return self.send(self.pack_cmd(REQ['CMD_VERSION'],[]), response)
 
   def set_device_name(self, name, response):
     """
@@ -344,7 +1226,7 @@ class Sphero(threading.Thread):
     :param name: 48 character name.
     :param response: request response back from Sphero.
     """
-    self.send(self.pack_cmd(REQ['CMD_SET_BT_NAME'],[name]), response)
+    return self.send(self.pack_cmd(REQ['CMD_SET_BT_NAME'],[name]), response)
 
   def get_bt_name(self, response):
     """
@@ -356,7 +1238,7 @@ class Sphero(threading.Thread):
 
     :param response: request response back from Sphero.
     """
-    self.send(self.pack_cmd(REQ['CMD_GET_BT_NAME'],[]), response)
+    return self.send(self.pack_cmd(REQ['CMD_GET_BT_NAME'],[]), response)
 
   def set_auto_reconnect(self, enable, time, response):
     """
@@ -374,7 +1256,7 @@ class Sphero(threading.Thread):
     enable auto reconnect mode
     :param response: request response back from Sphero.
     """
-    self.send(self.pack_cmd(REQ['CMD_SET_AUTO_RECONNECT'],[enable,time]), response)
+    return self.send(self.pack_cmd(REQ['CMD_SET_AUTO_RECONNECT'],[enable,time]), response)
 
   def get_auto_reconnect(self, response):
     """
@@ -383,7 +1265,7 @@ class Sphero(threading.Thread):
 
     :param response: request response back from Sphero.
     """
-    self.send(self.pack_cmd(REQ['CMD_GET_AUTO_RECONNECT'],[]), reponse)
+    return self.send(self.pack_cmd(REQ['CMD_GET_AUTO_RECONNECT'],[]), response)
 
   def get_power_state(self, response):
     """
@@ -392,7 +1274,7 @@ class Sphero(threading.Thread):
 
     :param response: request response back from Sphero.
     """
-    self.send(self.pack_cmd(REQ['CMD_GET_PWR_STATE'],[]), response)
+    return self.send(self.pack_cmd(REQ['CMD_GET_PWR_STATE'],[]), response)
 
   def set_power_notify(self, enable, response):
     """
@@ -405,7 +1287,7 @@ class Sphero(threading.Thread):
     :param enable: 00h to disable and 01h to enable power notifications.
     :param response: request response back from Sphero.
     """
-    self.send(self.pack_cmd(REQ['CMD_SET_PWR_NOTIFY'],[enable]), response)
+    return self.send(self.pack_cmd(REQ['CMD_SET_PWR_NOTIFY'],[enable]), response)
 
   def go_to_sleep(self, time, macro, response):
     """
@@ -419,7 +1301,7 @@ class Sphero(threading.Thread):
     :param macro: macro number to run when re-awakened.
     :param response: request response back from Sphero.
     """
-    self.send(self.pack_cmd(REQ['CMD_SLEEP'],[(time>>8), (time & 0xff), macro]), response)
+    return self.send(self.pack_cmd(REQ['CMD_SLEEP'],[(time>>8), (time & 0xff), macro]), response)
 
   def run_l1_diags(self, response):
     """
@@ -431,7 +1313,7 @@ class Sphero(threading.Thread):
 
     :param response: request response back from Sphero.
     """
-    self.send(self.pack_cmd(REQ['CMD_RUN_L1_DIAGS'],[]), response)
+    return self.send(self.pack_cmd(REQ['CMD_RUN_L1_DIAGS'],[]), response)
 
   def run_l2_diags(self, response):
     """
@@ -442,7 +1324,7 @@ class Sphero(threading.Thread):
 
     :param response: request response back from Sphero.
     """
-    self.send(self.pack_cmd(REQ['CMD_RUN_L2_DIAGS'],[]), response)
+    return self.send(self.pack_cmd(REQ['CMD_RUN_L2_DIAGS'],[]), response)
 
   def clear_counters(self, response):
     """
@@ -451,7 +1333,7 @@ class Sphero(threading.Thread):
 
     :param response: request response back from Sphero.
     """
-    self.send(self.pack_cmd(REQ['CMD_CLEAR_COUNTERS'],[]), response)
+    return self.send(self.pack_cmd(REQ['CMD_CLEAR_COUNTERS'],[]), response)
 
   def assign_counter_value(self, counter, response):
     """
@@ -463,7 +1345,7 @@ class Sphero(threading.Thread):
     :param counter: value to set the counter to.
     :param response: request response back from Sphero.
     """
-    self.send(self.pack_cmd(REQ['CMD_ASSIGN_COUNTER'],[((counter>>24) & 0xff), ((counter>>16) & 0xff), ((counter>>8) & 0xff) ,(counter & 0xff)]), response)
+    return self.send(self.pack_cmd(REQ['CMD_ASSIGN_COUNTER'],[((counter>>24) & 0xff), ((counter>>16) & 0xff), ((counter>>8) & 0xff) ,(counter & 0xff)]), response)
 
   def poll_packet_times(self, time, response):
     """
@@ -494,7 +1376,7 @@ class Sphero(threading.Thread):
     :param time: client Tx time.
     :param response: request response back from Sphero.
     """
-    self.send(self.pack_cmd(REQ['CMD_POLL_TIME'],[((time>>24) & 0xff), ((time>>16) & 0xff), ((time>>8) & 0xff), (time & 0xff)]), response)
+    return self.send(self.pack_cmd(REQ['CMD_POLL_TIME'],[((time>>24) & 0xff), ((time>>16) & 0xff), ((time>>8) & 0xff), (time & 0xff)]), response)
 
   def set_heading(self, heading, response):
     """
@@ -507,7 +1389,7 @@ class Sphero(threading.Thread):
     shortest angular distance to heading command)
     :param response: request response back from Sphero.
     """
-    self.send(self.pack_cmd(REQ['CMD_SET_HEADING'],[(heading>>8),(heading & 0xff)]), response)
+    return self.send_template('CMD_SET_HEADING', response, heading)
 
   def set_stablization(self, enable, response):
     """
@@ -519,7 +1401,7 @@ class Sphero(threading.Thread):
     :param enable: 00h for off and 01h for on (on by default).
     :param response: request response back from Sphero.
     """
-    self.send(self.pack_cmd(REQ['CMD_SET_STABILIZ'],[enable]), response)
+    return self.send(self.pack_cmd(REQ['CMD_SET_STABILIZ'],[enable]), response)
 
   def set_rotation_rate(self, rate, response):
     """
@@ -534,7 +1416,7 @@ class Sphero(threading.Thread):
     will move in other funcation calls).
     :param response: request response back from Sphero.
     """
-    self.send(self.pack_cmd(REQ['CMD_SET_ROTATION_RATE'],[self.clamp(rate, 0, 255)]), response)
+    return self.send(self.pack_cmd(REQ['CMD_SET_ROTATION_RATE'],[self.clamp(rate, 0, 255)]), response)
 
   def set_app_config_blk(self, app_data, response):
     """
@@ -545,7 +1427,7 @@ class Sphero(threading.Thread):
     :param app_data: block set aside for application.
     :param response: request response back from Sphero.
     """
-    self.send(self.pack_cmd(REQ['CMD_SET_APP_CONFIG_BLK'],[((app_data>>24) & 0xff), ((app_data>>16) & 0xff), ((app_data>>8) & 0xff), (app_data & 0xff)]), response)
+    return self.send(self.pack_cmd(REQ['CMD_SET_APP_CONFIG_BLK'],[((app_data>>24) & 0xff), ((app_data>>16) & 0xff), ((app_data>>8) & 0xff), (app_data & 0xff)]), response)
 
   def get_app_config_blk(self, response):
     """
@@ -553,7 +1435,7 @@ class Sphero(threading.Thread):
     that is set aside for exclusive use by applications.
     :param response: request response back from Sphero.
     """
-    self.send(self.pack_cmd(REQ['CMD_GET_APP_CONFIG_BLK'], []), response)
+    return self.send(self.pack_cmd(REQ['CMD_GET_APP_CONFIG_BLK'], []), response)
 
   def set_data_strm(self, sample_div, sample_frames, sample_mask1, pcnt, sample_mask2, response):
     """
@@ -576,15 +1458,20 @@ class Sphero(threading.Thread):
     :param pcnt: packet count (set to 0 for unlimited streaming).
     :param response: request response back from Sphero.
     """
-    data = self.pack_cmd(REQ['CMD_SET_DATA_STRM'], \
-           [(sample_div>>8), (sample_div & 0xff), (sample_frames>>8), (sample_frames & 0xff), ((sample_mask1>>24) & 0xff), \
+    args = [(sample_div>>8), (sample_div & 0xff), (sample_frames>>8), (sample_frames & 0xff), ((sample_mask1>>24) & 0xff), \
               ((sample_mask1>>16) & 0xff),((sample_mask1>>8) & 0xff), (sample_mask1 & 0xff), pcnt, ((sample_mask2>>24) & 0xff), \
-              ((sample_mask2>>16) & 0xff),((sample_mask2>>8) & 0xff), (sample_mask2 & 0xff)])
+              ((sample_mask2>>16) & 0xff),((sample_mask2>>8) & 0xff), (sample_mask2 & 0xff)]
+    data = self.pack_cmd(REQ['CMD_SET_DATA_STRM'], args)
+    self._link_config['CMD_SET_DATA_STRM'] = args
     self.create_mask_list(sample_mask1, sample_mask2)
     self.stream_mask1 = sample_mask1
     self.stream_mask2 = sample_mask2
+    self.stream_frames = sample_frames
+    self.stream_div = sample_div
+    if self.telemetry_capacity is not None:
+      self.telemetry = TelemetryBuffer(self.mask_list, self.telemetry_capacity)
     #print data
-    self.send(data, response)
+    return self.send(data, response)
 
   def set_filtered_data_strm(self, sample_div, sample_frames, pcnt, response):
     """
@@ -603,7 +1490,7 @@ class Sphero(threading.Thread):
         mask1 = mask1|value
     for value in STRM_MASK2.itervalues():
         mask2 = mask2|value
-    self.set_data_strm(sample_div, sample_frames, mask1, pcnt, mask2, response)
+    return self.set_data_strm(sample_div, sample_frames, mask1, pcnt, mask2, response)
 
   def set_raw_data_strm(self, sample_div, sample_frames, pcnt, response):
     """
@@ -622,7 +1509,7 @@ class Sphero(threading.Thread):
         mask1 = mask1|value
     for value in STRM_MASK2.itervalues():
         mask2 = mask2|value
-    self.set_data_strm(sample_div, sample_frames, mask1, pcnt, mask2, response)
+    return self.set_data_strm(sample_div, sample_frames, mask1, pcnt, mask2, response)
 
 
   def set_all_data_strm(self, sample_div, sample_frames, pcnt, response):
@@ -641,7 +1528,7 @@ class Sphero(threading.Thread):
         mask1 = mask1|value
     for value in STRM_MASK2.itervalues():
         mask2 = mask2|value
-    self.set_data_strm(sample_div, sample_frames, mask1, pcnt, mask2, response)
+    return self.set_data_strm(sample_div, sample_frames, mask1, pcnt, mask2, response)
 
   def config_collision_detect(self, method, Xt, Xspd, Yt, Yspd, ignore_time, response):
     """
@@ -663,7 +1550,9 @@ class Sphero(threading.Thread):
     :param ignore_time: An 8-bit post-collision dead time to prevent\
     retriggering; specified in 10ms increments.
     """
-    self.send(self.pack_cmd(REQ['CMD_CFG_COL_DET'],[method, Xt, Xspd, Yt, Yspd, ignore_time]), response)
+    args = [method, Xt, Xspd, Yt, Yspd, ignore_time]
+    self._link_config['CMD_CFG_COL_DET'] = args
+    return self.send(self.pack_cmd(REQ['CMD_CFG_COL_DET'], args), response)
 
   def set_rgb_led(self, red, green, blue, save, response):
     """
@@ -679,7 +1568,7 @@ class Sphero(threading.Thread):
     :param blue: blue color value.
     :param save: 01h for save (color is saved as "user LED color").
     """
-    self.send(self.pack_cmd(REQ['CMD_SET_RGB_LED'],[self.clamp(red,0,255), self.clamp(green,0,255), self.clamp(blue,0,255), save]), response)
+    return self.send_template('CMD_SET_RGB_LED', response, self.clamp(red,0,255), self.clamp(green,0,255), self.clamp(blue,0,255), save)
 
   def set_back_led(self, brightness, response):
     """
@@ -689,7 +1578,7 @@ class Sphero(threading.Thread):
     :param brightness: 0-255, off-on (the blue LED on hemisphere of the Sphero).
     :param response: request response back from Sphero.
     """
-    self.send(self.pack_cmd(REQ['CMD_SET_BACK_LED'],[self.clamp(brightness,0,255)]), response)
+    return self.send_template('CMD_SET_BACK_LED', response, self.clamp(brightness,0,255))
 
   def get_rgb_led(self, response):
     """
@@ -698,7 +1587,7 @@ class Sphero(threading.Thread):
 
     :param response: request response back from Sphero.
     """
-    self.send(self.pack_cmd(REQ['CMD_GET_RGB_LED'],[]), response)
+    return self.send(self.pack_cmd(REQ['CMD_GET_RGB_LED'],[]), response)
 
   def roll(self, speed, heading, state, response):
     """
@@ -715,7 +1604,7 @@ class Sphero(threading.Thread):
     :param state: 00h for off (braking) and 01h for on (driving).
     :param response: request response back from Sphero.
     """
-    self.send(self.pack_cmd(REQ['CMD_ROLL'],[self.clamp(speed,0,255), (heading>>8), (heading & 0xff), state]), response)
+    return self.send_template('CMD_ROLL', response, self.clamp(speed,0,255), heading, state)
 
   def boost(self, time, heading, response):
     """
@@ -729,7 +1618,7 @@ class Sphero(threading.Thread):
     :param heading: the heading to travel while boosting.
     :param response: request response back from Sphero.
     """
-    self.send(self.pack_cmd(REQ['CMD_BOOST'], [time, (heading>>8), (heading & 0xff)]), response)
+    return self.send(self.pack_cmd(REQ['CMD_BOOST'], [time, (heading>>8), (heading & 0xff)]), response)
 
   def set_motion_to(self, time, response):
     """
@@ -742,7 +1631,7 @@ class Sphero(threading.Thread):
     an orbBasic program is executing with a similar flag, BFEXCLUSIVEDRV.
     Note that you must enable this action by setting System Option Flag #4.
     """
-    self.send(self.pack_cmd(REQ['CMD_SET_MOTION_TO'], [self.clamp(time, 0, 2000)]), response)
+    return self.send(self.pack_cmd(REQ['CMD_SET_MOTION_TO'], [self.clamp(time, 0, 2000)]), response)
 
   def set_raw_motor_values(self, l_mode, l_power, r_mode, r_power, response):
     """
@@ -757,10 +1646,43 @@ class Sphero(threading.Thread):
     brake, 0x04 - ignored.
     :param power: 0-255 scalar value (units?).
     """
-    self.send(self.pack_cmd(REQ['CMD_RAW_MOTORS'], [l_mode, l_power, r_mode, r_power]), response)
+    return self.send_template('CMD_SET_RAW_MOTORS', response, l_mode, l_power, r_mode, r_power)
+
+  def save_temp_macro(self, macro, response):
+    """
+    Store a macro as the temporary macro, TEMP_MACRO_ID. It replaces
+    the previous temporary macro.
+
+    :param macro: MacroBuilder, or list of macro bytes ending in END.
+    :param response: request response back from Sphero.
+    """
+    if isinstance(macro, MacroBuilder):
+      macro = macro.build()
+    return self.send(self.pack_cmd(REQ['CMD_SAVE_TEMP_MACRO'], macro), response)
+
+  def run_macro(self, macro_id, response):
+    """
+    Run a macro, e.g. TEMP_MACRO_ID after save_temp_macro.
+
+    :param macro_id: ID of the macro.
+    :param response: request response back from Sphero.
+    """
+    return self.send(self.pack_cmd(REQ['CMD_RUN_MACRO'], [macro_id]), response)
+
+  def abort_macro(self, response):
+    """
+    Stop the running macro. Sphero keeps doing what the last macro
+    command told it, so follow with a roll to stop.
+
+    :param response: request response back from Sphero.
+    """
+    return self.send(self.pack_cmd(REQ['CMD_ABORT_MACRO'], []), response)
 
   def send(self, data, response):
     """
+    When response is true, a ResponseFuture is returned that resolves
+    with the response of Sphero.
+
     Packets are sent from Client -> Sphero in the following byte format::
 
       -------------------------------------------------------
@@ -791,10 +1713,84 @@ class Sphero(threading.Thread):
     else:
       output = REQ['WITHOUT_RESPONSE'] + data + [checksum]
     #pack the msg
-    msg = ''.join(struct.pack('B',x) for x in output)
-    #send the msg
-    with self._communication_lock:
-      self.bt.send(msg)
+    msg = str(bytearray(output))
+    return self._dispatch(msg, data[2], response)
+
+  def send_template(self, name, response, *values):
+    """
+    Fast path of send for the commands of TEMPLATE_FORMATS, packing
+    the payload values straight into a CommandTemplate.
+
+    :param name: REQ name of the command.
+    :param values: payload values, in the order of the format.
+    """
+    with self._seq_lock:
+      #inc_seq, inlined
+      self.seq = seq = (self.seq + 1) & 0xff
+      msg = self._templates[name].pack(response, seq, *values)
+    return self._dispatch(msg, seq, response)
+
+  def _dispatch(self, msg, seq, response):
+    #send the msg, commands waiting for a response are never delayed
+    if self.scheduler is not None and not response:
+      self.scheduler.submit(msg)
+    elif response:
+      future = self._add_pending_response(seq)
+      self.write(msg)
+      return future
+    else:
+      self.write(msg)
+
+  def _add_pending_response(self, seq):
+    future = ResponseFuture(seq)
+    with self._pending_lock:
+      previous = self._pending_responses.get(seq)
+      self._pending_responses[seq] = future
+    if previous is not None:
+      #the sequence number wrapped around before an answer came
+      previous.expire()
+    return future
+
+  def _resolve_response(self, mrsp, seq, data):
+    with self._pending_lock:
+      future = self._pending_responses.pop(seq, None)
+    if future is not None:
+      future.set_result(mrsp, data)
+      self.response_rtt.add(future.rtt)
+
+  def write(self, msg):
+    """
+    Write a packed message to the Bluetooth link, or queue it for the
+    writer thread when the send queue is enabled.
+
+    :param msg: packed message as built by send.
+    """
+    if self.send_queue is not None:
+      self.send_queue.put(msg)
+    else:
+      self._write_link(msg)
+
+  def _write_link(self, msg):
+    while True:
+      #while reconnecting, wait a little for the link to come back
+      if not self._link_up.wait(self.write_wait):
+        with self._state_lock:
+          if self.state == 'reconnecting':
+            if msg[1] == '\xfe' and msg[2:4] in DROPPABLE_CMDS:
+              self.dropped_while_down += 1
+            else:
+              self._held.append(msg)
+            return
+        continue
+      try:
+        with self._send_lock:
+          self.bt.send(msg)
+        return
+      except (IOError, OSError):
+        if self.state == 'closed':
+          return
+        if not self._link_lost():
+          raise
 
   def run(self):
     # this is larger than any single packet
@@ -845,41 +1841,75 @@ class Sphero(threading.Thread):
 
     '''
 
-    while self.is_connected and not self.shutdown:
-      with self._communication_lock:
-        self.raw_data_buf += self.bt.recv(num_bytes)
-      data = self.raw_data_buf
-      while len(data)>5:
-        if data[:2] == RECV['SYNC']:
-          #print "got response packet"
-          # response packet
-          data_length = ord(data[4])
-          if data_length+5 <= len(data):
-            data_packet = data[:(5+data_length)]
-            data = data[(5+data_length):]
-          else:
-            break
-            #print "Response packet", self.data2hexstr(data_packet)
-         
-        elif data[:2] == RECV['ASYNC']:
-          data_length = (ord(data[3])<<8)+ord(data[4])
-          if data_length+5 <= len(data):
-            data_packet = data[:(5+data_length)]
-            data = data[(5+data_length):]
-          else:
-            # the remainder of the packet isn't long enough
-            break
-          if data_packet[2]==IDCODE['DATA_STRM'] and self._async_callback_dict.has_key(IDCODE['DATA_STRM']):
-            self._async_callback_dict[IDCODE['DATA_STRM']](self.parse_data_strm(data_packet, data_length))
-          elif data_packet[2]==IDCODE['COLLISION'] and self._async_callback_dict.has_key(IDCODE['COLLISION']):
-            self._async_callback_dict[IDCODE['COLLISION']](self.parse_collision_detect(data_packet, data_length))
-          elif data_packet[2]==IDCODE['PWR_NOTIFY'] and self._async_callback_dict.has_key(IDCODE['PWR_NOTIFY']):
-            self._async_callback_dict[IDCODE['PWR_NOTIFY']](self.parse_pwr_notify(data_packet, data_length))
-          else:
-            print "got a packet that isn't streaming"
-        else:
-          raise RuntimeError("Bad SOF : " + self.data2hexstr(data))
-      self.raw_data_buf=data
+    while not self.shutdown:
+      if self.is_connected:
+        self.recv_once(num_bytes)
+      elif self.state == 'reconnecting':
+        self._link_up.wait(0.1)
+      else:
+        break
+
+  def recv_once(self, num_bytes):
+    """
+    Read once from the link and dispatch the packets completed by the
+    read. Used by the receive thread, and by an event loop such as
+    control_loop.ControlLoop when the link is readable.
+
+    :param num_bytes: maximum number of bytes to read.
+    """
+    try:
+      with self._recv_lock:
+        received = self.bt.recv(num_bytes)
+    except (IOError, OSError):
+      received = ''
+    if not received:
+      #the other side closed the link
+      if not self._link_lost():
+        self.is_connected = False
+      return
+    self.framer.feed(received)
+    packet = self.framer.next_packet()
+    while packet is not None:
+      self.handle_packet(packet)
+      packet = self.framer.next_packet()
+
+  def fileno(self):
+    """
+    File descriptor of the link, so it can be polled for reading.
+    """
+    return self.bt.fileno()
+
+  def handle_packet(self, packet):
+    """
+    Dispatch one complete packet as returned by PacketFramer.
+
+    :param packet: memoryview of the packet.
+    """
+    if packet[1] == RECV['SYNC'][1]:
+      # response packet
+      mrsp, seq = struct.unpack_from('BB', packet, 2)
+      self._resolve_response(mrsp, seq, packet[5:-1].tobytes())
+    else:
+      data_length = len(packet) - 5
+      id_code = packet[2]
+      if id_code==IDCODE['DATA_STRM']:
+        if self.telemetry is not None:
+          frames = self.decode_data_strm(packet, data_length)
+          self.telemetry.append(frames, time.time(), (self.stream_div or 1) / SENSOR_RATE)
+        if self.events.has_subscribers(id_code):
+          #subscribers get one event per sample frame
+          for frame in self.parse_data_strm(packet, data_length):
+            self.events.publish(id_code, frame)
+      elif self.events.has_subscribers(id_code):
+        parse = self._async_parsers.get(id_code, self.parse_async_data)
+        self.events.publish(id_code, parse(packet, data_length))
+
+  def parse_async_data(self, data, data_length):
+    '''
+    Payload of asynchronous packets without a dedicated parser
+    (CONFIG_BLOCK, MACRO_MARKERS, LEVEL1_DIAG text, empty for SLEEP).
+    '''
+    return data[5:-1].tobytes()
 
   def parse_pwr_notify(self, data, data_length):
     '''
@@ -896,7 +1926,7 @@ class Sphero(threading.Thread):
       * 03h = Battery Low, 
       * 04h = Battery Critical
     '''
-    return struct.unpack_from('B', ''.join(data[5:]))[0]
+    return struct.unpack_from('B', data, 5)[0]
 
   def parse_collision_detect(self, data, data_length):
     '''
@@ -925,19 +1955,56 @@ class Sphero(threading.Thread):
     '''
     output={}
     
-    output['X'], output['Y'], output['Z'], output['Axis'], output['xMagnitude'], output['yMagnitude'], output['Speed'], output['Timestamp'] = struct.unpack_from('>hhhbhhbI', ''.join(data[5:]))
+    output['X'], output['Y'], output['Z'], output['Axis'], output['xMagnitude'], output['yMagnitude'], output['Speed'], output['Timestamp'] = struct.unpack_from('>hhhbhhbI', data, 5)
     return output
 
+  def data_strm_frames(self, data_length):
+    '''
+    Number of sample frames in a data streaming packet. It follows
+    from the packet length rather than the requested sample_frames,
+    so a packet is never mislabelled.
+    '''
+    return (data_length - 1) // self.strm_struct.size
+
   def parse_data_strm(self, data, data_length):
-    output={}
-    for i in range((data_length-1)/2):
-      unpack = struct.unpack_from('>h', ''.join(data[5+2*i:]))
-      output[self.mask_list[i]] = unpack[0]
-    #print self.mask_list
-    #print output
-    return output
+    '''
+    The data payload holds sample_frames frames, each made of one
+    signed 16-bit value per field of mask_list.
+
+    :return: list with a dictionary of field values per frame.
+    '''
+    frame_size = self.strm_struct.size
+    unpack_from = self.strm_struct.unpack_from
+    mask_list = self.mask_list
+    return [dict(zip(mask_list, unpack_from(data, 5 + i * frame_size)))
+            for i in range(self.data_strm_frames(data_length))]
+
+  def decode_data_strm(self, data, data_length):
+    '''
+    Decode all frames of a data streaming packet at once.
+
+    :return: NumPy structured array with one row per frame and one\
+    native endian int16 column per field of mask_list.
+    '''
+    import numpy as np
+    if self.strm_dtype is None:
+      self.strm_dtype = np.dtype([(key, '>i2') for key in self.mask_list])
+      self.strm_native_dtype = self.strm_dtype.newbyteorder('=')
+    if isinstance(data, memoryview):
+      #NumPy does not read memoryviews on Python 2
+      data = data.tobytes()
+    frames = np.frombuffer(data, self.strm_dtype, self.data_strm_frames(data_length), 5)
+    return frames.astype(self.strm_native_dtype)
 
   def disconnect(self):
+    with self._state_lock:
+      self.state = 'closed'
+    self._closing.set()
+    self._link_up.set()
+    self.disable_scheduler()
+    self.disable_send_queue()
+    self.events.close()
+    self._async_callback_dict.clear()
     self.is_connected = False
     self.bt.close()
     return self.is_connected
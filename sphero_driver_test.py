@@ -0,0 +1,267 @@
+#!/usr/bin/python
+import time
+import threading
+import unittest
+import numpy as np
+import sphero_driver
+
+def make_packet(sop2, body):
+	# packet with start of packet bytes and checksum
+	checksum = ~sum(body) % 256
+	return ''.join(chr(x) for x in [0xff, sop2] + body + [checksum])
+
+RESPONSE = make_packet(0xff, [0x00, 0x07, 0x02, 0x42])
+PWR_NOTIFY = make_packet(0xfe, [0x01, 0x00, 0x02, 0x02])
+
+class TestPacketFramer(unittest.TestCase):
+	'''
+		Split the received byte stream into
+		packets and recover from bad bytes.
+	'''
+	def test_split_packets(self):
+		framer = sphero_driver.PacketFramer()
+		stream = RESPONSE + PWR_NOTIFY
+		# feed a few bytes at a time
+		packets = []
+		for i in range(0, len(stream), 3):
+			framer.feed(stream[i:i + 3])
+			packet = framer.next_packet()
+			while packet is not None:
+				packets.append(packet.tobytes())
+				packet = framer.next_packet()
+		self.assertEqual(packets, [RESPONSE, PWR_NOTIFY])
+		self.assertEqual(len(framer), 0)
+
+	def test_resync(self):
+		framer = sphero_driver.PacketFramer()
+		framer.feed('junk' + RESPONSE[:-1] + '\x00' + PWR_NOTIFY)
+		self.assertEqual(framer.next_packet().tobytes(), PWR_NOTIFY)
+		self.assertEqual(framer.bad_checksum, 1)
+		self.assertEqual(framer.skipped_bytes, 4 + len(RESPONSE))
+
+	def test_no_resync(self):
+		framer = sphero_driver.PacketFramer(resync = False)
+		framer.feed('junk' + RESPONSE)
+		self.assertRaises(RuntimeError, framer.next_packet)
+
+	def test_compaction(self):
+		framer = sphero_driver.PacketFramer(capacity = 16)
+		for i in range(20):
+			framer.feed(PWR_NOTIFY)
+			self.assertEqual(framer.next_packet().tobytes(), PWR_NOTIFY)
+
+class TestResponses(unittest.TestCase):
+	'''
+		Responses resolve the future
+		with the same sequence number.
+	'''
+	def test_resolve(self):
+		sphero = sphero_driver.Sphero()
+		future = sphero._add_pending_response(0x07)
+		sphero.framer.feed(RESPONSE)
+		sphero.handle_packet(sphero.framer.next_packet())
+		self.assertEqual(future.result(0), (0x00, 'B'))
+		self.assertTrue(future.ok())
+
+	def test_timeout(self):
+		sphero = sphero_driver.Sphero()
+		future = sphero._add_pending_response(0x01)
+		self.assertRaises(sphero_driver.ResponseTimeout, future.result, 0.01)
+
+ROLL = make_packet(0xfe, [0x02, 0x30, 0x00, 0x05, 0x80, 0x00, 0x10, 0x01])
+CONFIG = make_packet(0xfe, [0x02, 0x11, 0x00, 0x01, 0x00])
+CONFIG_RESPONSE = make_packet(0xff, [0x02, 0x11, 0x01, 0x01, 0x00])
+
+class TestSendQueue(unittest.TestCase):
+	'''
+		Only motion and LED commands without a
+		response request are ever dropped.
+	'''
+	def queue(self, policy, msgs):
+		queue = sphero_driver.SendQueue(None, maxsize = len(msgs), policy = policy)
+		for msg in msgs:
+			queue.put(msg)
+		return queue
+
+	def test_default_blocks(self):
+		self.assertEqual(sphero_driver.SendQueue(None).policy, 'block')
+
+	def test_drop_oldest(self):
+		queue = self.queue('drop_oldest', [CONFIG, ROLL, CONFIG_RESPONSE])
+		self.assertTrue(queue.put(CONFIG))
+		self.assertEqual([msg for queued, msg, droppable in queue._queue], [CONFIG, CONFIG_RESPONSE, CONFIG])
+		self.assertEqual(queue.dropped, 1)
+
+	def test_drop_newest(self):
+		queue = self.queue('drop_newest', [CONFIG, CONFIG_RESPONSE])
+		self.assertFalse(queue.put(ROLL))
+		self.assertEqual(len(queue), 2)
+
+	def test_never_drop_config(self):
+		queue = self.queue('drop_newest', [CONFIG, CONFIG_RESPONSE])
+		writer = threading.Thread(target = queue.put, args = (CONFIG,))
+		writer.daemon = True
+		writer.start()
+		writer.join(0.05)
+		# waits for room instead of dropping
+		self.assertTrue(writer.is_alive())
+		queue.write = lambda msg: None
+		queue.start()
+		writer.join(1)
+		queue.stop()
+		self.assertEqual(queue.dropped, 0)
+
+class RecordingLink(object):
+	def __init__(self):
+		self.sent = []
+
+	def send(self, data):
+		self.sent.append(data)
+
+class TestCommandTemplate(unittest.TestCase):
+	'''
+		Templates build the same packets as
+		pack_cmd and send.
+	'''
+	def check(self, name, values, payload, response):
+		sphero = sphero_driver.Sphero()
+		sphero.bt = RecordingLink()
+		sphero.send_template(name, response, *values)
+		sphero.seq -= 1
+		sphero.send(sphero.pack_cmd(sphero_driver.REQ[name], payload), response)
+		self.assertEqual(sphero.bt.sent[0], sphero.bt.sent[1])
+
+	def test_same_packets(self):
+		self.check('CMD_ROLL', (128, 300, 1), [128, 1, 44, 1], False)
+		self.check('CMD_ROLL', (255, 0, 0), [255, 0, 0, 0], True)
+		self.check('CMD_SET_HEADING', (359,), [1, 103], False)
+		self.check('CMD_SET_RGB_LED', (255, 0, 12, 1), [255, 0, 12, 1], False)
+		self.check('CMD_SET_BACK_LED', (200,), [200], True)
+		self.check('CMD_SET_RAW_MOTORS', (1, 120, 2, 60), [1, 120, 2, 60], False)
+
+	def test_sequence_wraps(self):
+		sphero = sphero_driver.Sphero()
+		sphero.bt = RecordingLink()
+		sphero.seq = 0xff
+		sphero.roll(10, 0, 1, False)
+		self.assertEqual(ord(sphero.bt.sent[0][4]), 0)
+
+	def test_sequence_lock(self):
+		sphero = sphero_driver.Sphero()
+		packed = []
+		packer = threading.Thread(target = lambda: packed.append(sphero.pack_cmd(sphero_driver.REQ['CMD_PING'], [])))
+		packer.daemon = True
+		# pack_cmd takes the sequence number under the lock of send_template
+		with sphero._seq_lock:
+			packer.start()
+			packer.join(0.05)
+			self.assertEqual(packed, [])
+			sphero.seq = 0x41
+		packer.join(1)
+		self.assertEqual(packed[0][2], 0x42)
+
+class TestMacroBuilder(unittest.TestCase):
+	'''
+		Steps are encoded into one macro that
+		is uploaded in a single packet.
+	'''
+	def test_encode(self):
+		macro = sphero_driver.MacroBuilder().roll(50, 300).delay(1500).set_rgb_led(0, 255, 0, 10).roll(0, 300)
+		self.assertEqual(macro.build(), [0x05, 50, 1, 44, 0, 0x0b, 5, 220, 0x07, 0, 255, 0, 10, 0x05, 0, 1, 44, 0, 0x00])
+
+	def test_full(self):
+		macro = sphero_driver.MacroBuilder()
+		while macro.space() >= 3:
+			macro.delay(10)
+		self.assertRaises(ValueError, macro.delay, 10)
+		sphero = sphero_driver.Sphero()
+		sphero.bt = RecordingLink()
+		sphero.save_temp_macro(macro, False)
+		packet = sphero.bt.sent[0]
+		self.assertEqual(packet[2:4], '\x02\x51')
+		self.assertTrue(ord(packet[5]) <= 0xff)
+		self.assertEqual(len(packet), 6 + ord(packet[5]))
+
+class TestDataStrm(unittest.TestCase):
+	'''
+		Decode every frame of a data
+		streaming packet.
+	'''
+	def setUp(self):
+		self.sphero = sphero_driver.Sphero()
+		mask1 = sphero_driver.STRM_MASK1['ACCEL_X_RAW'] | sphero_driver.STRM_MASK1['ACCEL_Y_RAW']
+		self.sphero.create_mask_list(mask1, sphero_driver.STRM_MASK2['ODOM_X'])
+		# two frames of three fields
+		self.packet = make_packet(0xfe, [0x03, 0x00, 13, 0, 1, 0, 2, 0xff, 0xfd, 0, 4, 0, 5, 0, 6])
+
+	def test_parse(self):
+		frames = self.sphero.parse_data_strm(self.packet, 13)
+		self.assertEqual(frames, [{'ACCEL_X_RAW': 1, 'ACCEL_Y_RAW': 2, 'ODOM_X': -3},
+			{'ACCEL_X_RAW': 4, 'ACCEL_Y_RAW': 5, 'ODOM_X': 6}])
+
+	def test_decode(self):
+		frames = self.sphero.decode_data_strm(self.packet, 13)
+		self.assertEqual(frames.shape, (2,))
+		self.assertEqual(list(frames['ODOM_X']), [-3, 6])
+		self.assertEqual(list(frames[1]), [4, 5, 6])
+
+class TestTelemetryBuffer(unittest.TestCase):
+	'''
+		Windows of the ring buffer stay in
+		order across the wrap around.
+	'''
+	def append(self, buf, values, host_time):
+		frames = np.zeros(len(values), [('ODOM_X', 'i2')])
+		frames['ODOM_X'] = values
+		buf.append(frames, host_time, 0.1)
+
+	def test_wrap_around(self):
+		buf = sphero_driver.TelemetryBuffer(['ODOM_X'], capacity = 4)
+		self.append(buf, [1, 2, 3], 10.2)
+		self.append(buf, [4, 5, 6], 10.5)
+		self.assertEqual(len(buf), 4)
+		self.assertEqual(list(buf.last()['ODOM_X']), [3, 4, 5, 6])
+		self.assertEqual(list(buf.last(2)['ODOM_X']), [5, 6])
+		self.assertEqual(list(buf.since(10.35)['ODOM_X']), [5, 6])
+
+	def test_views_and_copies(self):
+		buf = sphero_driver.TelemetryBuffer(['ODOM_X'], capacity = 4)
+		self.append(buf, [1, 2], 1.0)
+		view = buf.last()
+		self.assertTrue(view.base is not None)
+		self.assertTrue(buf.last_copy().base is None)
+
+class TestAsyncEventBus(unittest.TestCase):
+	'''
+		Every subscriber receives the events
+		from its own bounded queue.
+	'''
+	def test_two_subscribers(self):
+		sphero = sphero_driver.Sphero()
+		first = []
+		second = []
+		subscriptions = [sphero.events.subscribe(sphero_driver.IDCODE['PWR_NOTIFY'], first.append),
+			sphero.events.subscribe(sphero_driver.IDCODE['PWR_NOTIFY'], second.append)]
+		sphero.framer.feed(PWR_NOTIFY)
+		sphero.handle_packet(sphero.framer.next_packet())
+		end = time.time() + 1
+		while sum(s.delivered for s in subscriptions) < 2 and time.time() < end:
+			time.sleep(0.01)
+		sphero.events.close()
+		self.assertEqual(first, [2])
+		self.assertEqual(second, [2])
+
+	def test_drop_oldest(self):
+		release = threading.Event()
+		received = []
+		subscription = sphero_driver.AsyncSubscription('x', lambda event: (release.wait(1), received.append(event)), maxsize = 2)
+		for event in range(5):
+			subscription.put(event)
+		subscription.start()
+		release.set()
+		while subscription.delivered < 2:
+			time.sleep(0.01)
+		subscription.stop()
+		self.assertEqual(received, [3, 4])
+		self.assertEqual(subscription.dropped, 3)
+
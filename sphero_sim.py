@@ -0,0 +1,327 @@
+#!/usr/bin/python
+"""
+Simulated Sphero speaking the packet protocol of sphero_driver, to run
+the driver, its tests and benchmarks without a robot.
+
+The simulator answers commands sent with SOP2 = 0xff with a simple
+response echoing SEQ, streams DATA_STRM packets as configured with
+set_data_strm, sends collision packets after config_collision_detect
+and can corrupt outgoing packets on purpose.
+
+  sphero = sphero_driver.Sphero()
+  transport, sim = sphero_sim.loopback()
+  sphero.connect(transport)
+"""
+
+import os
+import pty
+import math
+import time
+import errno
+import random
+import select
+import socket
+import struct
+import threading
+import collections
+
+import sphero_driver
+import sphero_transport
+
+MRSP = sphero_driver.MRSP
+IDCODE = sphero_driver.IDCODE
+REQ = sphero_driver.REQ
+
+KNOWN_CMDS = set(tuple(cmd) for name, cmd in REQ.items() if name.startswith('CMD_'))
+
+
+class FdLink(object):
+  """
+  Socket like wrapper of a file descriptor, for the master side of a pty.
+  """
+
+  def __init__(self, fd):
+    self.fd = fd
+
+  def fileno(self):
+    return self.fd
+
+  def recv(self, num_bytes):
+    try:
+      return os.read(self.fd, num_bytes)
+    except OSError as error:
+      if error.errno == errno.EIO:
+        #the slave side was closed
+        return ''
+      raise
+
+  def sendall(self, data):
+    while data:
+      data = data[os.write(self.fd, data):]
+
+  def close(self):
+    os.close(self.fd)
+
+
+class SimulatedSphero(threading.Thread):
+  """
+  Serves one link until stop is called or the link is closed.
+
+  :param link: socket like object with recv, sendall, fileno and close.
+  :param sensor_rate: rate in Hz of the simulated control system,\
+  streaming runs at sensor_rate / sample_div samples per second. Set\
+  it above 400 to load the driver harder than a real Sphero does.
+  :param collision_rate: mean collisions per second once collision\
+  detection was configured.
+  :param corrupt_rate: probability that an outgoing packet gets one\
+  byte flipped.
+  :param seed: seed of the random generator, for repeatable runs.
+  """
+
+  def __init__(self, link, sensor_rate = sphero_driver.SENSOR_RATE, collision_rate = 0.0, corrupt_rate = 0.0, seed = None):
+    threading.Thread.__init__(self)
+    self.daemon = True
+    self.link = link
+    self.sensor_rate = sensor_rate
+    self.collision_rate = collision_rate
+    self.corrupt_rate = corrupt_rate
+    self.random = random.Random(seed)
+    self.shutdown = False
+    self._write_lock = threading.Lock()
+    self._buf = ''
+    #received commands by (DID, CID)
+    self.commands = collections.Counter()
+    self.bad_checksum = 0
+    self.packets_sent = 0
+    self.corrupted = 0
+    self.stream_fields = 0
+    self.stream_frames = 0
+    self.stream_period = None
+    self.stream_count = 0
+    self.next_stream = None
+    self.sample = 0
+    self.collisions = False
+    self.next_collision = None
+
+  def stop(self):
+    self.shutdown = True
+
+  def run(self):
+    try:
+      while not self.shutdown:
+        now = time.time()
+        due = [t for t in (self.next_stream, self.next_collision) if t is not None]
+        timeout = max(0.0, min(due) - now) if due else 0.1
+        readable = select.select([self.link], [], [], min(timeout, 0.1))[0]
+        if readable:
+          data = self.link.recv(4096)
+          if not data:
+            break
+          self._buf += data
+          self._handle_commands()
+        self._emit_due(time.time())
+    except (socket.error, OSError, select.error):
+      #the link was closed under us
+      pass
+    finally:
+      self.shutdown = True
+      self.link.close()
+
+  def _handle_commands(self):
+    buf = self._buf
+    while True:
+      start = buf.find('\xff')
+      if start < 0:
+        buf = ''
+        break
+      buf = buf[start:]
+      if len(buf) < 6:
+        break
+      if buf[1] not in '\xff\xfe':
+        buf = buf[1:]
+        continue
+      end = 6 + ord(buf[5])
+      if len(buf) < end:
+        break
+      packet, buf = buf[:end], buf[end:]
+      body = [ord(c) for c in packet[2:-1]]
+      did, cid, seq = body[0], body[1], body[2]
+      if ~sum(body) % 256 != ord(packet[-1]):
+        self.bad_checksum += 1
+        if packet[1] == '\xff':
+          self.respond(MRSP['ORBOTIX_RSP_CODE_ECHKSUM'], seq)
+        continue
+      self.commands[(did, cid)] += 1
+      mrsp = self.execute(did, cid, packet[6:-1])
+      if packet[1] == '\xff':
+        self.respond(mrsp, seq)
+    self._buf = buf
+
+  def execute(self, did, cid, data):
+    """
+    Apply a command, returns the MRSP code of the response.
+    """
+    cmd = [did, cid]
+    if tuple(cmd) not in KNOWN_CMDS:
+      return MRSP['ORBOTIX_RSP_CODE_EBAD_CMD']
+    if cmd == REQ['CMD_SET_DATA_STRM']:
+      if len(data) < 9:
+        return MRSP['ORBOTIX_RSP_CODE_EBAD_MSG']
+      div, frames, mask1, pcnt = struct.unpack_from('>HHIB', data)
+      mask2 = struct.unpack_from('>I', data, 9)[0] if len(data) >= 13 else 0
+      self.stream_fields = bin(mask1).count('1') + bin(mask2).count('1')
+      if div == 0 or frames == 0 or self.stream_fields == 0:
+        self.stream_period = self.next_stream = None
+      else:
+        self.stream_frames = frames
+        self.stream_period = div * frames / float(self.sensor_rate)
+        self.stream_count = pcnt
+        self.next_stream = time.time() + self.stream_period
+    elif cmd == REQ['CMD_CFG_COL_DET']:
+      self.collisions = len(data) > 0 and ord(data[0]) != 0
+      self._schedule_collision(time.time())
+    return MRSP['ORBOTIX_RSP_CODE_OK']
+
+  def _schedule_collision(self, now):
+    if self.collisions and self.collision_rate > 0:
+      self.next_collision = now + self.random.expovariate(self.collision_rate)
+    else:
+      self.next_collision = None
+
+  def _emit_due(self, now):
+    if self.next_stream is not None and now >= self.next_stream:
+      self.send_data_strm()
+      if self.stream_count == 1:
+        self.next_stream = None
+      else:
+        if self.stream_count > 1:
+          self.stream_count -= 1
+        #keep the schedule, as the robot does, unless far behind
+        self.next_stream = max(self.next_stream + self.stream_period, now - self.stream_period)
+    if self.next_collision is not None and now >= self.next_collision:
+      self.inject_collision()
+      self._schedule_collision(now)
+
+  def write(self, sop2, header, data):
+    """
+    Send a packet with checksum, maybe corrupted.
+    """
+    body = header + data
+    packet = bytearray(chr(0xff) + chr(sop2) + body + chr(~sum(bytearray(body)) % 256))
+    if self.corrupt_rate > 0 and self.random.random() < self.corrupt_rate:
+      pos = self.random.randrange(len(packet))
+      packet[pos] ^= 1 << self.random.randrange(8)
+      self.corrupted += 1
+    with self._write_lock:
+      self.link.sendall(str(packet))
+      self.packets_sent += 1
+
+  def respond(self, mrsp, seq, data = ''):
+    self.write(0xff, struct.pack('BBB', mrsp, seq, len(data) + 1), data)
+
+  def send_async(self, id_code, data):
+    self.write(0xfe, id_code + struct.pack('>H', len(data) + 1), data)
+
+  def send_data_strm(self):
+    values = []
+    for i in range(self.stream_frames):
+      #slow sine per field, so streamed values look like sensor data
+      value = int(1000 * math.sin(self.sample / 100.0))
+      values.extend(value + field for field in range(self.stream_fields))
+      self.sample += 1
+    self.send_async(IDCODE['DATA_STRM'], struct.pack('>%dh' % len(values), *values))
+
+  def inject_collision(self, x = 120, y = -40, z = 0, axis = 1, x_magnitude = 90, y_magnitude = 30, speed = 80):
+    timestamp = int(time.time() * 1000) & 0xffffffff
+    self.send_async(IDCODE['COLLISION'], struct.pack('>hhhbhhbI', x, y, z, axis, x_magnitude, y_magnitude, speed, timestamp))
+
+  def inject_power_state(self, state):
+    """
+    :param state: 1 charging, 2 OK, 3 low, 4 critical.
+    """
+    self.send_async(IDCODE['PWR_NOTIFY'], chr(state))
+
+
+def loopback(**kwargs):
+  """
+  Start a simulated Sphero on an in-process link.
+
+  :return: (LoopbackTransport for the driver, SimulatedSphero).
+  """
+  transport = sphero_transport.LoopbackTransport()
+  sim = SimulatedSphero(transport.peer, **kwargs)
+  sim.start()
+  return transport, sim
+
+
+def open_pty(**kwargs):
+  """
+  Start a simulated Sphero on the master side of a new pty.
+
+  :return: (path of the slave side for SerialTransport, SimulatedSphero).
+  """
+  master, slave = pty.openpty()
+  path = os.ttyname(slave)
+  sim = SimulatedSphero(FdLink(master), **kwargs)
+  sim.start()
+  #the slave stays open, or reads of the master fail with EIO until the
+  #driver opened it
+  return path, sim
+
+
+class SimulatorServer(threading.Thread):
+  """
+  Accept TCP connections and serve each with a new SimulatedSphero,
+  e.g. to test reconnecting with sphero_transport.TCPTransport.
+
+  :param port: TCP port, 0 to pick a free one (see self.port).
+  :param kwargs: arguments of SimulatedSphero.
+  """
+
+  def __init__(self, port = 5700, host = '127.0.0.1', **kwargs):
+    threading.Thread.__init__(self)
+    self.daemon = True
+    self.kwargs = kwargs
+    self.sims = []
+    self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    self.server.bind((host, port))
+    self.server.listen(1)
+    self.host, self.port = self.server.getsockname()
+
+  def run(self):
+    while True:
+      try:
+        conn, address = self.server.accept()
+      except socket.error:
+        #closed by stop
+        return
+      conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+      sim = SimulatedSphero(conn, **self.kwargs)
+      self.sims.append(sim)
+      sim.start()
+
+  def stop(self):
+    try:
+      #wakes up accept
+      self.server.shutdown(socket.SHUT_RDWR)
+    except socket.error:
+      pass
+    self.server.close()
+    for sim in self.sims:
+      sim.stop()
+
+
+def serve_tcp(port = 5700, host = '127.0.0.1', **kwargs):
+  """
+  Serve simulated Spheros over TCP until interrupted.
+  """
+  server = SimulatorServer(port, host, **kwargs)
+  server.start()
+  print "Simulated Sphero listening on %s:%d" % (server.host, server.port)
+  while server.is_alive():
+    server.join(1)
+
+if __name__ == '__main__':
+  import sys
+  serve_tcp(int(sys.argv[1]) if len(sys.argv) > 1 else 5700)
@@ -0,0 +1,118 @@
+#!/usr/bin/python
+import time
+import unittest
+import sphero_driver
+import sphero_sim
+import sphero_transport
+
+class TestSimulatedSphero(unittest.TestCase):
+	'''
+		Drive the simulated Sphero through the
+		driver over the different transports.
+	'''
+	def start(self, transport, sim):
+		self.sim = sim
+		self.sphero = sphero_driver.Sphero()
+		self.sphero.connect(transport)
+		self.sphero.start()
+
+	def tearDown(self):
+		self.sphero.disconnect()
+		self.sim.stop()
+		self.sphero.join(1)
+
+	def test_response_over_loopback(self):
+		self.start(*sphero_sim.loopback())
+		self.assertTrue(self.sphero.ping(True).ok(1))
+		self.assertTrue(self.sphero.roll(80, 90, 1, True).ok(1))
+		self.assertEqual(self.sim.commands[tuple(sphero_driver.REQ['CMD_ROLL'])], 1)
+
+	def test_response_over_pty(self):
+		path, sim = sphero_sim.open_pty()
+		self.start(sphero_transport.SerialTransport(path), sim)
+		self.assertTrue(self.sphero.ping(True).ok(1))
+
+	def test_data_strm(self):
+		self.start(*sphero_sim.loopback(sensor_rate = 4000.))
+		self.sphero.enable_telemetry()
+		self.sphero.set_filtered_data_strm(1, 4, 0, True).result(1)
+		time.sleep(0.1)
+		received = len(self.sphero.telemetry)
+		self.assertTrue(received > 100)
+		self.assertEqual(received % 4, 0)
+
+	def test_corruption_is_skipped(self):
+		self.start(*sphero_sim.loopback(sensor_rate = 4000., corrupt_rate = 0.2, seed = 1))
+		self.sphero.enable_telemetry()
+		self.sphero.set_filtered_data_strm(1, 1, 0, False)
+		time.sleep(0.2)
+		framer = self.sphero.framer
+		self.assertTrue(self.sim.corrupted > 0)
+		self.assertTrue(framer.bad_checksum + framer.skipped_bytes > 0)
+		self.assertTrue(len(self.sphero.telemetry) > 0)
+
+class TestReconnect(unittest.TestCase):
+	'''
+		A lost link is opened again and the data
+		streaming configuration is restored.
+	'''
+	def setUp(self):
+		self.server = sphero_sim.SimulatorServer(port = 0)
+		self.server.start()
+		self.sphero = sphero_driver.Sphero()
+		self.sphero.enable_reconnect(0.01, 0.1)
+		self.sphero.connect(sphero_transport.TCPTransport(port = self.server.port))
+		self.sphero.start()
+
+	def tearDown(self):
+		self.sphero.disconnect()
+		self.server.stop()
+		self.sphero.join(1)
+
+	def wait_for(self, condition):
+		end = time.time() + 2
+		while not condition() and time.time() < end:
+			time.sleep(0.01)
+		self.assertTrue(condition())
+
+	def test_reconnect(self):
+		self.sphero.backoff.initial_delay = 0.2
+		self.sphero.enable_send_queue()
+		self.sphero.set_raw_data_strm(40, 1, 0, True).result(1)
+		self.wait_for(lambda: len(self.server.sims) == 1)
+		self.server.sims[0].stop()
+		self.wait_for(lambda: self.sphero.state == 'reconnecting')
+		# held while reconnecting and sent on the new link
+		self.sphero.set_stablization(1, False)
+		# outdated by the time the link is back, dropped
+		self.sphero.roll(50, 0, 1, False)
+		self.wait_for(lambda: self.sphero.reconnects == 1)
+		self.assertEqual(self.sphero.state, 'connected')
+		self.assertTrue(self.sphero.ping(True).ok(1))
+		sim = self.server.sims[1]
+		self.assertEqual(sim.commands[tuple(sphero_driver.REQ['CMD_SET_STABILIZ'])], 1)
+		self.assertEqual(sim.commands.get(tuple(sphero_driver.REQ['CMD_ROLL']), 0), 0)
+		self.assertEqual(self.sphero.dropped_while_down, 1)
+		self.assertEqual(sim.stream_period, 40 / 400.)
+
+	def test_write_does_not_stall(self):
+		self.sphero.backoff.initial_delay = 0.5
+		self.wait_for(lambda: len(self.server.sims) == 1)
+		self.server.sims[0].stop()
+		self.wait_for(lambda: self.sphero.state == 'reconnecting')
+		# without a send queue the caller itself writes
+		start = time.time()
+		self.sphero.roll(50, 0, 1, False)
+		self.sphero.set_stablization(1, False)
+		self.assertTrue(time.time() - start < 0.4)
+		self.assertEqual(self.sphero.state, 'reconnecting')
+
+	def test_give_up(self):
+		self.sphero.backoff.max_attempts = 2
+		self.wait_for(lambda: len(self.server.sims) == 1)
+		self.server.stop()
+		self.wait_for(lambda: self.sphero.state == 'disconnected')
+		self.assertFalse(self.sphero.is_connected)
+
+if __name__ == '__main__':
+	unittest.main()
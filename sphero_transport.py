@@ -0,0 +1,359 @@
+#!/usr/bin/python
+"""
+Links over which sphero_driver.Sphero talks to a Sphero.
+
+Every transport offers the same small interface:
+
+* connect() - open the link, returns True when it is up, raises\
+  ConnectError otherwise.
+* reconnect() - open the link again after it was lost.
+* send(data) - write a packed message.
+* recv(num_bytes) - read at most num_bytes, an empty string once the\
+  link was closed by the other side.
+* fileno() - file descriptor, so the link can be polled.
+* close()
+
+BTInterface is the RFCOMM link to a real Sphero. SerialTransport,
+TCPTransport and LoopbackTransport connect to a serial port or pty,
+a TCP server or an in-process peer, such as the simulated Sphero in
+sphero_sim.
+"""
+
+import os
+import sys
+import json
+import socket
+
+#Addresses of the Sphero devices connected before, by target name.
+ADDRESS_CACHE = os.path.expanduser('~/.sphero_address')
+
+
+class ConnectError(IOError):
+  """
+  Raised when the link to Sphero can not be opened.
+  """
+
+
+class Transport(object):
+  """
+  Base class of the links. Subclasses implement connect, send, recv,
+  fileno and close; reconnect closes and connects again unless a
+  subclass knows a faster way.
+
+  Sphero writes from one thread and reads from another, so send and
+  recv have to work concurrently. recv blocks until data is available,
+  use fileno to poll first.
+  """
+
+  def connect(self):
+    """
+    Open the link, returns True when it is up, raises ConnectError otherwise.
+    """
+    raise NotImplementedError
+
+  def reconnect(self):
+    """
+    Open the link again after it was lost.
+    """
+    self.close()
+    return self.connect()
+
+  def send(self, data):
+    """
+    Write data, a packed message, raises IOError or OSError when the link is lost.
+    """
+    raise NotImplementedError
+
+  def recv(self, num_bytes):
+    """
+    Read at most num_bytes, an empty string once the other side closed the link.
+    """
+    raise NotImplementedError
+
+  def fileno(self):
+    """
+    File descriptor that is readable when recv has data.
+    """
+    raise NotImplementedError
+
+  def close(self):
+    """
+    Close the link.
+    """
+    raise NotImplementedError
+
+
+class BTInterface(Transport):
+  """
+  RFCOMM link found by Bluetooth discovery. lightblue is only imported
+  when connecting, so the driver can be used with the other transports
+  on machines without it.
+
+  The address of the device is kept in cache_path, and discovery is
+  skipped when the device at the cached address answers.
+
+  :param target_name: connect to a device whose name starts with this.
+  :param port: RFCOMM channel.
+  :param cache_path: file of the address cache, None to always discover.
+  """
+
+  def __init__(self, target_name = 'Sphero', port = 1, cache_path = ADDRESS_CACHE):
+      self.target_name = target_name
+      self.port = port
+      self.cache_path = cache_path
+      self.found_device = False
+      self.tries = 0
+      self.target_address = None
+      self.sock = None
+
+  def load_address(self):
+    """
+    :return: cached address for target_name, None if there is none.
+    """
+    if self.cache_path is None or not os.path.exists(self.cache_path):
+      return None
+    try:
+      with open(self.cache_path) as cache:
+        address = json.load(cache).get(self.target_name)
+    except (IOError, ValueError):
+      return None
+    return str(address) if address is not None else None
+
+  def save_address(self):
+    if self.cache_path is None:
+      return
+    addresses = {}
+    if os.path.exists(self.cache_path):
+      try:
+        with open(self.cache_path) as cache:
+          addresses = json.load(cache)
+      except (IOError, ValueError):
+        pass
+    addresses[self.target_name] = self.target_address
+    with open(self.cache_path, 'w') as cache:
+      json.dump(addresses, cache)
+
+  def connect(self):
+    address = self.target_address or self.load_address()
+    if address is not None:
+      try:
+        self.open(address)
+        return True
+      except IOError:
+        sys.stdout.write("No answer from %s.\n" % address)
+        sys.stdout.flush()
+    self.target_address = self.discover()
+    self.open(self.target_address)
+    self.save_address()
+    return True
+
+  def discover(self):
+    """
+    :return: address of the device named target_name.
+    """
+    # import bluetooth
+    # changed
+    import lightblue
+
+    sys.stdout.write("Searching for devices....")
+    sys.stdout.flush()
+
+    target_address = None
+    for i in range(10):
+      sys.stdout.write("....")
+      sys.stdout.flush()
+      # nearby_devices = bluetooth.discover_devices(lookup_names = True)
+      nearby_devices = lightblue.finddevices(getnames = True)
+
+      devs = {}
+      count = 0
+      if len(nearby_devices)>0:
+        # # for bdaddr, name in nearby_devices:
+        # for bdaddr, name, d_val in nearby_devices:
+        #   #look for a device name that starts with Sphero
+        #   if name.startswith(self.target_name):
+        #     self.found_device = True
+        #     self.target_address = bdaddr
+        #     break
+        for bdaddr, name, d_val in nearby_devices:
+          # look for a devic name that starts with Sphero
+          if name.startswith(self.target_name):
+            devs[name] = [bdaddr, name, d_val]
+            print "devices name = {}".format(name)
+            count += 1
+
+        if count == 1:
+          self.found_device = True
+          target_address = devs.values()[0][0]
+          break
+        elif count >= 1:
+          selected_dev = raw_input("Please enter name: ")
+          self.found_device = True
+          target_address = devs[selected_dev][0]
+          break
+        else:
+          pass
+
+      if self.found_device:
+        break
+
+
+    if target_address is not None:
+      sys.stdout.write("\nFound Sphero device with address: %s\n" %  (target_address))
+      sys.stdout.flush()
+    else:
+      sys.stdout.write("\nNo Sphero devices found.\n" )
+      sys.stdout.flush()
+      raise ConnectError("No Sphero devices found")
+    return target_address
+
+  def open(self, address):
+    import lightblue
+
+    try:
+      #self.sock=bluetooth.BluetoothSocket(bluetooth.RFCOMM)
+      #self.sock.connect((bdaddr,self.port))
+      self.sock = lightblue.socket()
+      self.sock.connect((address, self.port))
+    # except bluetooth.btcommon.BluetoothError as error:
+    except IOError as error:
+      raise ConnectError("Pairing with %s failed: %s" % (address, error))
+    self.target_address = address
+    sys.stdout.write("Paired with Sphero.\n")
+    sys.stdout.flush()
+
+  def reconnect(self):
+    """
+    Open the link to the known address again, without discovery.
+    """
+    self.close()
+    self.open(self.target_address)
+    return True
+
+  def send(self, data):
+    self.sock.send(data)
+
+  def recv(self, num_bytes):
+    return self.sock.recv(num_bytes)
+
+  def fileno(self):
+    return self.sock.fileno()
+
+  def close(self):
+    self.sock.close()
+
+
+class SocketTransport(Transport):
+  """
+  Link over a connected stream socket.
+
+  :param sock: connected socket, or None to create it in connect.
+  """
+
+  def __init__(self, sock = None):
+    self.sock = sock
+
+  def connect(self):
+    return self.sock is not None
+
+  def send(self, data):
+    self.sock.sendall(data)
+
+  def recv(self, num_bytes):
+    return self.sock.recv(num_bytes)
+
+  def fileno(self):
+    return self.sock.fileno()
+
+  def close(self):
+    try:
+      #wakes up a thread blocked in recv
+      self.sock.shutdown(socket.SHUT_RDWR)
+    except socket.error:
+      pass
+    self.sock.close()
+
+
+class TCPTransport(SocketTransport):
+  """
+  Link to a TCP server, such as sphero_sim.serve_tcp or a serial to
+  TCP bridge.
+
+  :param host: host name or address of the server.
+  :param port: TCP port of the server.
+  :param timeout: connect timeout in seconds.
+  """
+
+  def __init__(self, host = '127.0.0.1', port = 5700, timeout = 5.0):
+    SocketTransport.__init__(self)
+    self.address = (host, port)
+    self.timeout = timeout
+
+  def connect(self):
+    try:
+      self.sock = socket.create_connection(self.address, self.timeout)
+    except socket.error as error:
+      raise ConnectError("Connecting to %s:%d failed: %s" % (self.address + (error,)))
+    self.sock.settimeout(None)
+    #packets are small, send them right away
+    self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return True
+
+
+class LoopbackTransport(SocketTransport):
+  """
+  In-process link made of a connected socket pair. The driver uses
+  this end, the other end is self.peer.
+  """
+
+  def __init__(self):
+    sock, self.peer = socket.socketpair()
+    SocketTransport.__init__(self, sock)
+
+  def reconnect(self):
+    raise ConnectError("A loopback link can not be opened again")
+
+
+class SerialTransport(Transport):
+  """
+  Link over a serial device or pty, set to raw mode.
+
+  :param path: device path, e.g. /dev/rfcomm0 or a pty.
+  :param baudrate: line speed, ignored by ptys.
+  """
+
+  def __init__(self, path, baudrate = 115200):
+    self.path = path
+    self.baudrate = baudrate
+    self.fd = None
+
+  def connect(self):
+    import termios
+    import tty
+    try:
+      self.fd = os.open(self.path, os.O_RDWR | os.O_NOCTTY)
+    except OSError as error:
+      raise ConnectError("Opening %s failed: %s" % (self.path, error))
+    tty.setraw(self.fd)
+    attrs = termios.tcgetattr(self.fd)
+    speed = getattr(termios, 'B%d' % self.baudrate)
+    attrs[4] = attrs[5] = speed
+    termios.tcsetattr(self.fd, termios.TCSANOW, attrs)
+    return True
+
+  def send(self, data):
+    while data:
+      data = data[os.write(self.fd, data):]
+
+  def recv(self, num_bytes):
+    try:
+      return os.read(self.fd, num_bytes)
+    except OSError:
+      #reading a pty whose other side was closed
+      return ''
+
+  def fileno(self):
+    return self.fd
+
+  def close(self):
+    os.close(self.fd)
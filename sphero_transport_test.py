@@ -0,0 +1,36 @@
+#!/usr/bin/python
+import os
+import shutil
+import tempfile
+import unittest
+import sphero_transport
+
+class TestAddressCache(unittest.TestCase):
+	'''
+		Addresses are kept per target name.
+	'''
+	def setUp(self):
+		self.dir = tempfile.mkdtemp()
+		self.path = os.path.join(self.dir, 'sphero_address')
+
+	def tearDown(self):
+		shutil.rmtree(self.dir)
+
+	def test_round_trip(self):
+		bt = sphero_transport.BTInterface('Sphero-RGB', cache_path = self.path)
+		self.assertEqual(bt.load_address(), None)
+		bt.target_address = '68:86:e7:00:11:22'
+		bt.save_address()
+		other = sphero_transport.BTInterface('Sphero-YBR', cache_path = self.path)
+		other.target_address = '68:86:e7:00:33:44'
+		other.save_address()
+		self.assertEqual(sphero_transport.BTInterface('Sphero-RGB', cache_path = self.path).load_address(), '68:86:e7:00:11:22')
+		self.assertEqual(other.load_address(), '68:86:e7:00:33:44')
+
+	def test_broken_cache(self):
+		with open(self.path, 'w') as cache:
+			cache.write('not json')
+		self.assertEqual(sphero_transport.BTInterface(cache_path = self.path).load_address(), None)
+
+if __name__ == '__main__':
+	unittest.main()
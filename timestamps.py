@@ -0,0 +1,181 @@
+'''
+(*)~----------------------------------------------------------------------------------
+ Pupil - eye tracking platform
+ Copyright (C) 2012-2015  Pupil Labs
+
+ Distributed under the terms of the CC BY-NC-SA License.
+ License details are in the file license.txt, distributed as part of this software.
+----------------------------------------------------------------------------------~(*)
+'''
+
+import numpy as np
+#logging
+import logging
+
+logger = logging.getLogger(__name__)
+
+#samples marked around a bad timestamp
+DAMPING = 50
+
+
+def recent(triggers, window=DAMPING):
+    """
+    True where a trigger is among the last window entries, itself included.
+    """
+    counts = np.cumsum(triggers)
+    counts[window:] -= counts[:-window].copy()
+    return counts > 0
+
+def clean_mask(ts):
+    """
+    Timestamps not affected by a jump: the DAMPING timestamps from a non
+    monotonic step on and the DAMPING timestamps up to a forward jump of
+    more than one second are not clean. The last timestamp is always clean.
+    """
+    clean = np.ones((ts.shape[0]),dtype=np.bool)
+    if ts.shape[0] < 2:
+        return clean
+    #forward check for non monotonic increasing behaviour
+    not_increasing = ts[:-1] >= ts[1:]
+    #backward check to smooth timejumps forward
+    jumps = (ts[1:] - ts[:-1]) > 1
+    clean[:-1] = ~recent(not_increasing) & ~recent(jumps[::-1])[::-1]
+    return clean
+
+def clean_mask_loop(ts):
+    """
+    clean_mask as it was written before, one timestamp at a time. Kept
+    for comparing against clean_mask.
+    """
+    clean = np.ones((ts.shape[0]),dtype=np.bool)
+    damper  = 0
+    for idx in range(ts.shape[0]-1):
+        if ts[idx] >= ts[idx+1]: #not monotonically increasing timestamp
+            damper = DAMPING
+        clean[idx] = damper <= 0
+        damper -=1
+
+    damper  = 0
+    for idx in range(ts.shape[0]-1)[::-1]:
+        if ts[idx+1]-ts[idx]>1: #more than one second forward jump
+            damper = DAMPING
+        clean[idx] &= damper <= 0
+        damper -=1
+    return clean
+
+def sanitize_timestamps(ts, find_clean=clean_mask):
+    logger.debug("Checking %s timestamps for monotony in direction and smoothness"%ts.shape[0])
+    avg_frame_time = (ts[-1] - ts[0])/ts.shape[0]
+    logger.debug('average_frame_time: %s'%(1./avg_frame_time))
+
+    raw_ts = ts #only needed for visualization
+    runs = 0
+    while True:
+        clean = find_clean(ts)
+
+        if clean.all() == True:
+            if runs >0:
+                logger.debug("Timestamps were bad but are ok now. Correction runs: %s"%runs)
+                # from matplotlib import pyplot as plt
+                # plt.plot(frames,raw_ts)
+                # plt.plot(frames,ts)
+                # # plt.scatter(frames[~clean],ts[~clean])
+                # plt.show()
+            else:
+                logger.debug("Timestamps are clean.")
+            return ts
+
+        runs +=1
+        if runs > 4:
+            logger.error("Timestamps could not be fixed!")
+            return ts
+
+        logger.warning("Timestamps are not sane. We detected non monotitc or jumpy timestamps. Fixing them now")
+        #scipy is only needed for repairs
+        from scipy.interpolate import UnivariateSpline
+        frames = np.arange(len(ts))
+        s = UnivariateSpline(frames[clean],ts[clean],s=0)
+        ts = s(frames)
+
+
+class TimestampMonitor(object):
+    """
+    Check world timestamps while recording, one frame at a time.
+
+    Every timestamp is compared with the one before, so non monotonic
+    steps and forward jumps of more than one second are reported as they
+    happen. The damping windows clean_mask would mark around them are
+    kept as merged (start, end) index ranges, and repair only refits the
+    timestamps inside them, from the clean ones around.
+    """
+    def __init__(self, margin=2*DAMPING):
+        self.margin = margin
+        self.count = 0
+        self.glitches = 0
+        self.windows = []
+        self._last = None
+
+    def _flag(self, start, end):
+        start = max(start, 0)
+        if self.windows and start <= self.windows[-1][1] + 1:
+            last_start, last_end = self.windows[-1]
+            self.windows[-1] = (min(last_start, start), max(last_end, end))
+        else:
+            self.windows.append((start, end))
+
+    def add(self, ts):
+        index = self.count - 1
+        if self._last is not None:
+            if self._last >= ts:
+                self.glitches += 1
+                logger.warning("World timestamp of frame %s does not increase" % (index + 1))
+                self._flag(index, index + DAMPING - 1)
+            elif ts - self._last > 1:
+                self.glitches += 1
+                logger.warning("World timestamps jump %.1fs forward at frame %s" % (ts - self._last, index + 1))
+                self._flag(index - DAMPING + 1, index)
+        self._last = ts
+        self.count += 1
+
+    def bad_mask(self, n):
+        """
+        Timestamps of a series of n the monitored ones marked as bad, the
+        negation of clean_mask.
+        """
+        bad = np.zeros(n, dtype=np.bool)
+        for start, end in self.windows:
+            #the last timestamp is always clean
+            bad[start:min(end + 1, n - 1)] = True
+        return bad
+
+    def repair(self, ts):
+        """
+        sanitize_timestamps for the monitored timestamps, with the spline
+        fitted only around the flagged windows. Falls back to
+        sanitize_timestamps when the windows cannot be fixed that way.
+        """
+        if not self.windows:
+            logger.debug("Timestamps are clean.")
+            return ts
+        logger.warning("Fixing %s bad world timestamps around %s glitches" % (self.bad_mask(len(ts)).sum(), self.glitches))
+        #scipy is only needed for repairs
+        from scipy.interpolate import UnivariateSpline
+        n = ts.shape[0]
+        clean = ~self.bad_mask(n)
+        fixed = ts.copy()
+        for start, end in self.windows:
+            end = min(end, n - 2)
+            if start > end:
+                continue
+            low = max(0, start - self.margin)
+            high = min(n, end + 1 + self.margin)
+            frames = np.arange(low, high)
+            around = clean[low:high]
+            if around.sum() < 4:
+                return sanitize_timestamps(ts)
+            s = UnivariateSpline(frames[around], ts[low:high][around], s=0)
+            fixed[start:end + 1] = s(np.arange(start, end + 1))
+        if not clean_mask(fixed).all():
+            logger.warning("Timestamps still not sane after fixing the bad regions, fixing the whole series.")
+            return sanitize_timestamps(ts)
+        return fixed
@@ -0,0 +1,115 @@
+#!/usr/bin/python
+import logging
+import unittest
+import numpy as np
+import timestamps
+
+try:
+	import scipy
+except ImportError:
+	scipy = None
+
+def world_timestamps(count, seed = 0):
+	# 60 fps with a little jitter
+	random = np.random.RandomState(seed)
+	return 1534. + np.arange(count) / 60. + random.uniform(0, 0.002, count)
+
+class TestCleanMask(unittest.TestCase):
+	'''
+		The vectorized mask is the one of the loops,
+		bad steps and jumps anywhere in the series.
+	'''
+	def check(self, ts):
+		self.assertTrue(np.array_equal(timestamps.clean_mask(ts), timestamps.clean_mask_loop(ts)))
+
+	def test_clean(self):
+		ts = world_timestamps(1000)
+		self.check(ts)
+		self.assertTrue(timestamps.clean_mask(ts).all())
+
+	def test_glitches(self):
+		random = np.random.RandomState(1)
+		for run in range(20):
+			ts = world_timestamps(2000, run)
+			for index in random.randint(0, len(ts), random.randint(1, 6)):
+				if random.uniform() < 0.5:
+					# step backwards
+					ts[index] -= random.uniform(0, 0.5)
+				else:
+					# jump forward by seconds
+					ts[index:] += random.uniform(1, 5)
+			self.check(ts)
+
+	def test_edges(self):
+		ts = world_timestamps(200)
+		ts[0] += 1
+		ts[-1] += 10
+		ts[120] = ts[119]
+		self.check(ts)
+		for count in (0, 1, 2, 49, 50, 51):
+			self.check(world_timestamps(count)[::-1])
+
+	def test_damping(self):
+		ts = world_timestamps(200)
+		ts[100] = ts[99]
+		clean = timestamps.clean_mask(ts)
+		self.assertEqual(list(np.flatnonzero(~clean)), range(99, 99 + timestamps.DAMPING))
+
+	def test_sanitize_clean(self):
+		ts = world_timestamps(1000)
+		self.assertTrue(timestamps.sanitize_timestamps(ts) is ts)
+
+class TestTimestampMonitor(unittest.TestCase):
+	'''
+		Frame by frame the monitor flags what
+		clean_mask flags over the whole series.
+	'''
+	def setUp(self):
+		logging.disable(logging.WARNING)
+
+	def tearDown(self):
+		logging.disable(logging.NOTSET)
+
+	def monitor(self, ts):
+		monitor = timestamps.TimestampMonitor()
+		for t in ts:
+			monitor.add(t)
+		return monitor
+
+	def test_windows(self):
+		random = np.random.RandomState(2)
+		for run in range(20):
+			ts = world_timestamps(random.randint(0, 2000), run)
+			for index in random.randint(0, max(len(ts), 1), random.randint(0, 6)):
+				if random.uniform() < 0.5:
+					ts[index] -= random.uniform(0, 0.5)
+				else:
+					ts[index:] += random.uniform(1, 5)
+			monitor = self.monitor(ts)
+			self.assertTrue(np.array_equal(monitor.bad_mask(len(ts)), ~timestamps.clean_mask(ts)))
+
+	def test_glitches(self):
+		ts = world_timestamps(1000)
+		ts[300] = ts[299]
+		ts[700:] += 3
+		monitor = self.monitor(ts)
+		self.assertEqual(monitor.glitches, 2)
+		self.assertEqual(monitor.windows, [(299, 299 + timestamps.DAMPING - 1), (699 - timestamps.DAMPING + 1, 699)])
+
+	def test_repair_clean(self):
+		ts = world_timestamps(1000)
+		self.assertTrue(self.monitor(ts).repair(ts) is ts)
+
+	@unittest.skipIf(scipy is None, 'needs scipy')
+	def test_repair(self):
+		ts = world_timestamps(3000)
+		ts[500] -= 0.2
+		ts[2000:] += 2
+		fixed = self.monitor(ts).repair(ts)
+		self.assertTrue(timestamps.clean_mask(fixed).all())
+		# timestamps away from the glitches are kept
+		self.assertTrue(np.array_equal(fixed[:400], ts[:400]))
+		self.assertTrue(np.array_equal(fixed[1000:1900], ts[1000:1900]))
+
+if __name__ == '__main__':
+	unittest.main()